@@ -15,6 +15,8 @@ import qtree.operators as ops
 import qtree.optimizer as opt
 import qtree.graph_model as gm
 import qtree.np_framework as npfr
+import qtree.np_plan as npp
+import qtree.np_parallel as nppar
 
 try:
     import tensorflow as tf
@@ -23,7 +25,10 @@ except ImportError:
     print('Tensorflow can not be imported. Interface disabled')
 import qtree.utils as utils
 
-from mpi4py import MPI
+try:
+    from mpi4py import MPI
+except ImportError:
+    print('MPI can not be imported. Use eval_with_np_parallel_local')
 
 
 def get_amplitudes_from_cirq(filename, initial_state=0):
@@ -238,6 +243,46 @@ def eval_with_np_parallel_mpi(filename, initial_state=0):
                      - np.array(amplitudes_reference)))
 
 
+def eval_with_np_parallel_local(filename, initial_state=0,
+                                n_processes=None):
+    """
+    Evaluate quantum circuit using a local pool of processes
+    to parallelize over some of the variables. Unlike
+    :py:meth:`eval_with_np_parallel_mpi` the environment is not
+    pickled to every worker: the compiled contraction and the data
+    are placed in shared memory.
+    """
+    n_var_parallel = 2
+    env = prepare_parallel_evaluation_np(filename, n_var_parallel)
+
+    bra_vars = env['bra_vars']
+    ket_vars = env['ket_vars']
+    vars_parallel = env['vars_parallel']
+
+    slice_dict = utils.slice_from_bits(initial_state, ket_vars)
+    slice_dict.update(utils.slice_from_bits(0, bra_vars))
+    slice_dict.update(utils.slice_from_bits(0, vars_parallel))
+    plan = npp.compile_buckets(env['buckets'], slice_dict)
+
+    amplitudes = []
+    with nppar.SliceExecutor(plan, env['data_dict'],
+                             n_processes=n_processes) as executor:
+        for target_state in range(2**len(bra_vars)):
+            slice_dict.update(
+                utils.slice_from_bits(target_state, bra_vars))
+            result = executor.run(slice_dict, vars_parallel)
+            amplitudes.append(result.data)
+
+    amplitudes_reference = get_amplitudes_from_cirq(filename)
+    print('Result:')
+    print(np.round(np.array(amplitudes), 3))
+    print('Reference:')
+    print(np.round(amplitudes_reference, 3))
+    print('Max difference:')
+    print(np.max(np.array(amplitudes)
+                 - np.array(amplitudes_reference)))
+
+
 def eval_with_tf(filename, initial_state=0):
     """
     Loads circuit from file and evaluates all amplitudes
@@ -683,5 +728,6 @@ if __name__ == "__main__":
     eval_with_np('inst_2x2_7_0.txt')
     eval_with_tf_parallel_mpi('inst_2x2_7_0.txt')
     eval_with_np_parallel_mpi('inst_2x2_7_0.txt')
+    eval_with_np_parallel_local('inst_2x2_7_0.txt')
     eval_contraction_cost('inst_2x2_7_0.txt')
     eval_with_multiamp_np('inst_2x2_7_0.txt')
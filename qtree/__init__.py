@@ -4,4 +4,11 @@ from . import operators_full_matrix
 # operators = operators_full_matrix
 from . import optimizer
 from . import utils
+from . import contraction_path
 from . import np_framework
+from . import np_plan
+from . import np_parallel
+from . import circuit_passes
+from . import expectation
+from . import tensor_cache
+from . import sampling
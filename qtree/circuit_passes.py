@@ -0,0 +1,586 @@
+"""
+This module implements optional passes over circuits in the form
+of a list of layers (as returned by
+:py:meth:`operators.read_circuit_file` or
+:py:meth:`operators.from_qiskit_circuit`). The passes are applied
+before the circuit is converted to buckets or a graph with
+:py:meth:`optimizer.circ2buckets` or
+:py:meth:`graph_model.circ2graph`.
+"""
+
+import numpy as np
+
+import qtree.operators as ops
+import qtree.system_defs as defs
+
+from qtree.logger_setup import log
+
+# Gates which are their own inverse
+SELF_INVERSE_GATES = (ops.H, ops.X, ops.Y, ops.Z,
+                      ops.cX, ops.cZ, ops.ccX, ops.SWAP)
+
+# Gates with a symmetric action on their qubits
+SYMMETRIC_GATES = (ops.cZ, ops.SWAP)
+
+# Diagonal one qubit gates diag(1, exp(i*pi*alpha)), same as ZPhase
+Z_PHASES = {ops.Z: 1., ops.S: 0.5, ops.Sdag: -0.5,
+            ops.T: 0.25, ops.Tdag: -0.25}
+
+
+def get_gate_matrix(op):
+    """
+    Builds the full operator of a gate on its qubits
+
+    Parameters
+    ----------
+    op : operators.Gate
+            gate
+
+    Returns
+    -------
+    matrix : numpy.array
+            tensor of shape [2]*(2*n) with indices
+            (out_1, ..., out_n, in_1, ..., in_n) in the order
+            of the gate's qubits
+    """
+    n_qubits = len(op.qubits)
+    changed = set(op.changed_qubits)
+
+    subscripts = []
+    deltas = []
+    for pos, qubit in enumerate(op.qubits):
+        out_idx, in_idx = pos, n_qubits + pos
+        if qubit in changed:
+            subscripts.extend([out_idx, in_idx])
+        else:
+            subscripts.append(out_idx)
+            deltas.extend([np.eye(2), [out_idx, in_idx]])
+
+    return np.einsum(np.asarray(op.gen_tensor(), dtype=defs.NP_GATE_TYPE),
+                     subscripts, *deltas, list(range(2 * n_qubits)))
+
+
+def _is_fusable(op):
+    """
+    SWAPs are applied by relabeling of variables and unresolved
+    parametric gates have no tensor, so they are not fused
+    """
+    if isinstance(op, ops.SWAP):
+        return False
+    return not any(isinstance(value, ops.placeholder)
+                   for value in op.parameters.values())
+
+
+def fuse_operators(gates):
+    """
+    Multiplies gates into a single :class:`operators.FusedGate`.
+    Qubits on which all gates are diagonal stay diagonal
+    in the fused gate.
+
+    Parameters
+    ----------
+    gates : list
+            gates in the order of application
+
+    Returns
+    -------
+    gate : operators.FusedGate
+    """
+    qubits = sorted(set(qubit for op in gates for qubit in op.qubits))
+    position = {qubit: pos for pos, qubit in enumerate(qubits)}
+    n_qubits = len(qubits)
+
+    # full operator with indices (out..., in...)
+    total = np.eye(2**n_qubits, dtype=defs.NP_GATE_TYPE).reshape(
+        [2] * (2 * n_qubits))
+    for op in gates:
+        matrix = get_gate_matrix(op)
+        n_op = len(op.qubits)
+        # contract inputs of the gate with outputs of the total
+        op_out = [2 * n_qubits + pos for pos in range(n_op)]
+        op_in = [position[qubit] for qubit in op.qubits]
+        result = list(range(2 * n_qubits))
+        for pos, qubit in enumerate(op.qubits):
+            result[position[qubit]] = op_out[pos]
+        total = np.einsum(matrix, op_out + op_in,
+                          total, list(range(2 * n_qubits)), result)
+
+    changed = set(qubit for op in gates for qubit in op.changed_qubits)
+    return _gate_from_matrix(qubits, total, changed)
+
+
+def _gate_from_matrix(qubits, matrix, changed):
+    """
+    Builds a :class:`operators.FusedGate` from its full operator with
+    indices (out..., in...). The operator has to be diagonal
+    along qubits not in changed
+    """
+    n_qubits = len(qubits)
+    subscripts = []
+    for pos, qubit in enumerate(qubits):
+        if qubit in changed:
+            subscripts.extend([pos, n_qubits + pos])
+        else:
+            subscripts.append(pos)
+    # take the diagonal along unchanged qubits
+    input_subscripts = [pos if qubits[pos] not in changed else
+                        n_qubits + pos for pos in range(n_qubits)]
+    tensor = np.einsum(matrix, list(range(n_qubits)) + input_subscripts,
+                       subscripts)
+
+    changes_qubits = [pos for pos, qubit in enumerate(qubits)
+                      if qubit in changed]
+    return ops.FusedGate(*qubits, tensor=tensor,
+                         changes_qubits=changes_qubits,
+                         matrix=matrix.reshape(2**n_qubits, 2**n_qubits))
+
+
+def layer_circuit(gates):
+    """
+    Packs gates into layers as soon as possible, keeping the
+    order of gates on every qubit
+
+    Parameters
+    ----------
+    gates : list
+            gates in the order of application
+
+    Returns
+    -------
+    circuit : list of lists
+    """
+    circuit = []
+    depth = {}
+    for op in gates:
+        layer = max((depth.get(qubit, 0) for qubit in op.qubits),
+                    default=0)
+        if layer == len(circuit):
+            circuit.append([])
+        circuit[layer].append(op)
+        for qubit in op.qubits:
+            depth[qubit] = layer + 1
+    return circuit
+
+
+def fuse_gates(circuit, max_qubits=2):
+    """
+    Merges runs of gates acting on at most max_qubits qubits into
+    single gates with precomputed tensors. This reduces the number
+    of tensors and variables of the tensor network.
+
+    Groups of gates are built greedily in the order of the circuit:
+    a gate joins the groups sharing qubits with it if all of them
+    together act on no more than max_qubits qubits, otherwise these
+    groups are closed.
+
+    Parameters
+    ----------
+    circuit : list of lists
+            quantum circuit
+    max_qubits : int, default 2
+            maximal number of qubits of a fused gate
+
+    Returns
+    -------
+    circuit : list of lists
+            circuit with fused gates
+    """
+    output = []
+    # open groups act on disjoint sets of qubits
+    groups = {}
+    group_of_qubit = {}
+
+    def close(group_id):
+        gates = groups.pop(group_id)
+        qubits = set(qubit for op in gates for qubit in op.qubits)
+        for qubit in qubits:
+            del group_of_qubit[qubit]
+        if len(gates) == 1:
+            output.append(gates[0])
+        else:
+            output.append(fuse_operators(gates))
+
+    for layer in circuit:
+        for op in layer:
+            touched = sorted(set(group_of_qubit[qubit]
+                                 for qubit in op.qubits
+                                 if qubit in group_of_qubit))
+            qubits = set(op.qubits)
+            for group_id in touched:
+                qubits.update(qubit for gate in groups[group_id]
+                              for qubit in gate.qubits)
+
+            if not _is_fusable(op) or len(op.qubits) > max_qubits:
+                for group_id in touched:
+                    close(group_id)
+                output.append(op)
+                continue
+
+            if len(qubits) <= max_qubits:
+                # merge groups, they commute as they are disjoint
+                gates = []
+                for group_id in touched:
+                    gates.extend(groups.pop(group_id))
+            else:
+                for group_id in touched:
+                    close(group_id)
+                gates = []
+            gates.append(op)
+
+            group_id = id(op)
+            groups[group_id] = gates
+            for gate in gates:
+                for qubit in gate.qubits:
+                    group_of_qubit[qubit] = group_id
+
+    for group_id in list(groups):
+        close(group_id)
+
+    return layer_circuit(output)
+
+
+def _is_plain(op):
+    """
+    True if the gate is an instance of the library class as is,
+    with numeric parameters
+    """
+    if op.name != type(op).__name__:
+        return False
+    return not any(isinstance(value, ops.placeholder)
+                   for value in op.parameters.values())
+
+
+def _is_diagonal(op):
+    # SWAP has no changed qubits, but it is not diagonal
+    return op.is_diagonal and not isinstance(op, ops.SWAP)
+
+
+def _commutes(first, second):
+    """
+    Conservative check that two gates commute
+    """
+    if not set(first.qubits) & set(second.qubits):
+        return True
+    return _is_diagonal(first) and _is_diagonal(second)
+
+
+def _same_qubits(first, second):
+    if isinstance(first, SYMMETRIC_GATES):
+        return set(first.qubits) == set(second.qubits)
+    if isinstance(first, ops.ccX):
+        return (set(first.qubits[:2]) == set(second.qubits[:2])
+                and first.qubits[2] == second.qubits[2])
+    return first.qubits == second.qubits
+
+
+def _is_zero_angle(angle, period):
+    remainder = np.mod(angle, period)
+    return np.isclose(remainder, 0) or np.isclose(remainder, period)
+
+
+def _z_phase(alpha, qubit):
+    """
+    Returns a diagonal gate diag(1, exp(i*pi*alpha)) on the qubit,
+    a named gate if there is one
+    """
+    if _is_zero_angle(alpha, 2):
+        return []
+    for cls, phase in Z_PHASES.items():
+        if _is_zero_angle(alpha - phase, 2):
+            return [cls(qubit)]
+    return [ops.ZPhase(qubit, alpha=alpha)]
+
+
+def _merge_u(first, second):
+    """
+    Merges two U gates U(t, p, l) = Rz(p) Ry(t) Rz(l) if
+    the rotations between them sum up exactly
+    """
+    t1, p1, l1 = (first.parameters[key]
+                  for key in ('theta', 'phi', 'lambda_param'))
+    t2, p2, l2 = (second.parameters[key]
+                  for key in ('theta', 'phi', 'lambda_param'))
+    # Rz and Ry have the period of 4*pi
+    if _is_zero_angle(t1, 4 * np.pi):
+        theta, phi, lambda_param = t2, p2, l2 + p1 + l1
+    elif _is_zero_angle(t2, 4 * np.pi):
+        theta, phi, lambda_param = t1, p2 + l2 + p1, l1
+    elif _is_zero_angle(l2 + p1, 4 * np.pi):
+        theta, phi, lambda_param = t1 + t2, p2, l1
+    else:
+        return None
+    if (_is_zero_angle(theta, 4 * np.pi)
+            and _is_zero_angle(phi + lambda_param, 4 * np.pi)):
+        return []
+    return [ops.U(*first.qubits, theta=theta, phi=phi,
+                  lambda_param=lambda_param)]
+
+
+def combine_gates(first, second):
+    """
+    Tries to replace two gates acting on the same qubits
+    by fewer gates
+
+    Parameters
+    ----------
+    first : operators.Gate
+            gate applied first
+    second : operators.Gate
+            gate applied second
+
+    Returns
+    -------
+    gates : list or None
+            gates replacing the pair (empty if they cancel),
+            or None if the pair can not be simplified
+    """
+    if not (_is_plain(first) and _is_plain(second)):
+        return None
+    if set(first.qubits) != set(second.qubits):
+        return None
+
+    first_cls, second_cls = type(first), type(second)
+    if (first_cls is second_cls and first_cls in SELF_INVERSE_GATES
+            and _same_qubits(first, second)):
+        return []
+
+    if len(first.qubits) != 1:
+        return None
+    qubit = first.qubits[0]
+
+    alphas = []
+    for op in (first, second):
+        if type(op) in Z_PHASES:
+            alphas.append(Z_PHASES[type(op)])
+        elif isinstance(op, ops.ZPhase):
+            alphas.append(op.parameters['alpha'])
+    if len(alphas) == 2:
+        return _z_phase(sum(alphas), qubit)
+
+    if first_cls is second_cls is ops.XPhase:
+        alpha = first.parameters['alpha'] + second.parameters['alpha']
+        if _is_zero_angle(alpha, 2):
+            return []
+        return [ops.XPhase(qubit, alpha=alpha)]
+
+    if first_cls is second_cls is ops.U:
+        return _merge_u(first, second)
+
+    if first_cls is ops.I:
+        return [second]
+    if second_cls is ops.I:
+        return [first]
+    return None
+
+
+def dagger_gate(op):
+    """
+    Returns the inverse (Hermitian conjugate) of a gate. Library
+    gates are inverted by their class and parameters, other gates
+    are returned as :class:`operators.FusedGate` with the same
+    diagonal qubits.
+
+    Parameters
+    ----------
+    op : operators.Gate
+            gate with numerical parameters
+
+    Returns
+    -------
+    gate : operators.Gate
+    """
+    if any(isinstance(value, ops.placeholder)
+           for value in op.parameters.values()):
+        raise ValueError(f'Can not invert gate {op} with placeholders')
+
+    if _is_plain(op):
+        cls = type(op)
+        if cls in SELF_INVERSE_GATES or cls is ops.I:
+            return cls(*op.qubits)
+        if cls in Z_PHASES:
+            return _z_phase(-Z_PHASES[cls], op.qubits[0])[0]
+        if cls in (ops.ZPhase, ops.XPhase):
+            return cls(*op.qubits, alpha=-op.parameters['alpha'])
+        if cls is ops.U:
+            return ops.U(*op.qubits,
+                         theta=-op.parameters['theta'],
+                         phi=-op.parameters['lambda_param'],
+                         lambda_param=-op.parameters['phi'])
+
+    n_qubits = len(op.qubits)
+    matrix = get_gate_matrix(op).reshape(2**n_qubits, 2**n_qubits)
+    matrix = matrix.conj().T.reshape([2] * (2 * n_qubits))
+    return _gate_from_matrix(op.qubits, matrix, set(op.changed_qubits))
+
+
+def count_variables(circuit):
+    """
+    Number of variables the gates of the circuit introduce
+    in the tensor network, see :py:meth:`optimizer.circ2buckets`
+    """
+    return sum(len(op.changed_qubits) for layer in circuit
+               for op in layer if not isinstance(op, ops.SWAP))
+
+
+def simplify_circuit(circuit):
+    """
+    Peephole simplification of a circuit. Diagonal gates are
+    commuted through each other, adjacent inverse gates
+    (like H H, cX cX, T Tdag, SWAP SWAP) are cancelled and rotations
+    (ZPhase and other diagonal one qubit gates, XPhase, U)
+    are merged by summing their angles. The result is exactly
+    equal to the original circuit, including the global phase.
+
+    Parameters
+    ----------
+    circuit : list of lists
+            quantum circuit
+
+    Returns
+    -------
+    circuit : list of lists
+            simplified circuit
+    report : dict
+            numbers of removed gates ('gates') and variables of
+            the tensor network ('variables')
+    """
+    gates = []
+    # positions of gates acting on every qubit, in order
+    history = {}
+
+    def find_partner(op):
+        partner = None
+        for qubit in op.qubits:
+            candidate = None
+            for idx in reversed(history.get(qubit, [])):
+                other = gates[idx]
+                if other is None:
+                    continue
+                if combine_gates(other, op) is not None:
+                    candidate = idx
+                    break
+                if not _commutes(other, op):
+                    break
+            if candidate is None or (partner is not None
+                                     and candidate != partner):
+                return None
+            partner = candidate
+        return partner
+
+    for layer in circuit:
+        for op in layer:
+            idx = find_partner(op)
+            if idx is None:
+                for qubit in op.qubits:
+                    history.setdefault(qubit, []).append(len(gates))
+                gates.append(op)
+                continue
+            # move the gate back to its partner
+            replacement = combine_gates(gates[idx], op)
+            gates[idx] = replacement[0] if replacement else None
+
+    result = layer_circuit([op for op in gates if op is not None])
+
+    report = {
+        'gates': (sum(len(layer) for layer in circuit)
+                  - sum(len(layer) for layer in result)),
+        'variables': count_variables(circuit) - count_variables(result)}
+    log.info('Simplifier removed {} gates and {} variables'.format(
+        report['gates'], report['variables']))
+    return result, report
+
+
+def test_fuse_gates():
+    """
+    Compares amplitudes of fused and original circuits
+    """
+    import functools
+    import qtree.graph_model as gm
+    import qtree.simulator as sim
+
+    n_qubits = 5
+    circuit = ops.get_random_circuit(n_qubits, 6)
+    circuit.append([ops.cX(0, 2), ops.ZPhase(3, alpha=0.2)])
+    circuit.append([ops.ccX(1, 3, 4), ops.SWAP(0, 2)])
+    circuit.append([ops.T(0), ops.Z(1), ops.cZ(2, 3)])
+    n_gates = sum(len(layer) for layer in circuit)
+
+    peo_function = functools.partial(gm.get_upper_bound_peo,
+                                     method='min_fill')
+    bitstrings = np.arange(2**n_qubits)
+
+    def get_amplitudes(circuit):
+        return sim.eval_amplitudes_batch(
+            n_qubits, circuit, bitstrings, batch_qubits=range(n_qubits),
+            peo_function=peo_function, dtype=np.complex128)
+
+    reference = get_amplitudes(circuit)
+    for max_qubits in (1, 2, 3):
+        fused = fuse_gates(circuit, max_qubits=max_qubits)
+        assert sum(len(layer) for layer in fused) < n_gates
+        assert any(isinstance(op, ops.SWAP)
+                   for layer in fused for op in layer)
+        assert np.allclose(get_amplitudes(fused), reference)
+
+    # diagonal gates are fused into a diagonal gate
+    fused = fuse_gates([[ops.T(0), ops.Z(1)], [ops.cZ(0, 1)]])
+    assert len(fused) == 1 and len(fused[0]) == 1
+    assert fused[0][0].is_diagonal
+
+
+def test_simplify_circuit():
+    """
+    Checks cancellations and compares amplitudes of
+    simplified and original circuits
+    """
+    import functools
+    import qtree.graph_model as gm
+    import qtree.simulator as sim
+
+    n_qubits = 3
+    circuit = [[ops.H(qubit) for qubit in range(n_qubits)],
+               [ops.T(1)], [ops.cZ(0, 1)], [ops.Tdag(1)],
+               [ops.cX(0, 2)], [ops.cX(0, 2)],
+               [ops.SWAP(1, 2)], [ops.SWAP(2, 1)],
+               [ops.ZPhase(0, alpha=0.3)], [ops.Z(0)],
+               [ops.ZPhase(0, alpha=0.7)],
+               [ops.XPhase(1, alpha=0.5)], [ops.XPhase(1, alpha=0.25)],
+               [ops.H(2)], [ops.X(2)], [ops.X(2)], [ops.H(2)],
+               [ops.u1([0.4], 0)], [ops.u3([0.2, 0.1, -0.5], 0)],
+               [ops.u3([0.3, 0.2, 0.1], 1)],
+               [ops.u3([0.5, 0.6, -0.2], 1)],
+               [ops.cX(1, 2)], [ops.T(0)], [ops.S(0)]]
+
+    simplified, report = simplify_circuit(circuit)
+    names = [op.name for layer in simplified for op in layer]
+    # H(2) cancels after cX and SWAP pairs are removed
+    assert names.count('H') == 3
+    assert names.count('cZ') == 1
+    assert names.count('cX') == 1
+    for name in ('T', 'Tdag', 'S', 'Z', 'SWAP', 'X'):
+        assert name not in names
+    assert names.count('XPhase') == 1
+    # T S is merged, ZPhase Z ZPhase cancels
+    assert names.count('ZPhase') == 1
+    assert names.count('U') == 2
+    assert report['gates'] == 17
+    assert report['variables'] == 9
+
+    peo_function = functools.partial(gm.get_upper_bound_peo,
+                                     method='min_fill')
+    bitstrings = np.arange(2**n_qubits)
+
+    def get_amplitudes(circuit):
+        return sim.eval_amplitudes_batch(
+            n_qubits, circuit, bitstrings, batch_qubits=range(n_qubits),
+            peo_function=peo_function, dtype=np.complex128)
+
+    assert np.allclose(get_amplitudes(simplified),
+                       get_amplitudes(circuit))
+
+    # cZ gates of the random circuit commute and cancel
+    circuit = ops.get_random_circuit(n_qubits, 6)
+    simplified, report = simplify_circuit(circuit)
+    assert report['gates'] > 0
+    assert np.allclose(get_amplitudes(simplified),
+                       get_amplitudes(circuit))
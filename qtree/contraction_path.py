@@ -0,0 +1,335 @@
+"""
+This module implements the search of the pairwise contraction order
+of the tensors inside a single bucket. Tensors are described only by
+their indices, so the functions here do not depend on the framework.
+
+A path is a list of pairs (i, j), i < j, in the format used by
+opt_einsum: operands i and j are removed from the list of operands
+and their contraction result is appended at the end. An index
+is summed over as soon as no other remaining operand holds it and
+it is not in the output.
+"""
+
+import itertools
+from functools import reduce
+from operator import mul
+
+# Buckets up to this size are ordered by exhaustive search
+MAX_EXHAUSTIVE_SIZE = 6
+
+
+def _get_size_dict(operands, size_dict):
+    """
+    Collects sizes of indices. If no dictionary is supplied indices
+    are assumed to be :py:class:`optimizer.Var` objects
+    """
+    if size_dict is not None:
+        return size_dict
+    return {int(idx): idx.size
+            for indices in operands for idx in indices}
+
+
+def _size(indices, size_dict):
+    return reduce(mul, (size_dict[idx] for idx in indices), 1)
+
+
+def _result_indices(a, b, others, output):
+    """
+    Indices of the contraction of a and b, which have
+    to be kept because they are needed later
+    """
+    needed = set(output)
+    for indices in others:
+        needed.update(indices)
+    return frozenset(idx for idx in a | b if idx in needed)
+
+
+def get_sequential_path(n_operands):
+    """
+    Returns a path which contracts the operands left to right
+    """
+    if n_operands < 2:
+        return []
+    path = [(0, 1)]
+    for n in range(n_operands - 2):
+        path.append((0, n_operands - 2 - n))
+    return path
+
+
+def get_greedy_path(operands, output, size_dict):
+    """
+    Greedy path: at each step contract the pair of operands
+    giving the smallest intermediate. Ties are broken by the number
+    of operations.
+
+    Parameters
+    ----------
+    operands : list of frozensets
+           indices of the operands (integers)
+    output : frozenset
+           indices of the result
+    size_dict : dict
+           sizes of the indices
+
+    Returns
+    -------
+    path : list of pairs
+    """
+    operands = list(operands)
+    path = []
+    while len(operands) > 1:
+        best = None
+        for i, j in itertools.combinations(range(len(operands)), 2):
+            others = (operands[k] for k in range(len(operands))
+                      if k != i and k != j)
+            result = _result_indices(operands[i], operands[j],
+                                     others, output)
+            key = (_size(result, size_dict),
+                   _size(operands[i] | operands[j], size_dict))
+            if best is None or key < best[0]:
+                best = (key, i, j, result)
+        _, i, j, result = best
+        path.append((i, j))
+        operands.pop(j)
+        operands.pop(i)
+        operands.append(result)
+    return path
+
+
+def get_optimal_path(operands, output, size_dict):
+    """
+    Exhaustive search over all contraction trees by dynamic
+    programming over subsets of operands. Minimizes the number of
+    operations, ties are broken by the size of the largest
+    intermediate. Feasible only for a small number of operands.
+
+    Parameters
+    ----------
+    operands : list of frozensets
+           indices of the operands (integers)
+    output : frozenset
+           indices of the result
+    size_dict : dict
+           sizes of the indices
+
+    Returns
+    -------
+    path : list of pairs
+    """
+    n_operands = len(operands)
+    if n_operands < 2:
+        return []
+    full = (1 << n_operands) - 1
+
+    def indices_of(subset):
+        inside = set()
+        outside = set(output)
+        for k in range(n_operands):
+            if subset >> k & 1:
+                inside.update(operands[k])
+            else:
+                outside.update(operands[k])
+        return frozenset(inside & outside)
+
+    # best[subset] = ((flops, max_size), indices, split)
+    best = {}
+    for k in range(n_operands):
+        best[1 << k] = ((0, 0), operands[k], None)
+
+    for subset in range(1, full + 1):
+        if subset in best:
+            continue
+        indices = indices_of(subset)
+        choice = None
+        # enumerate splits, each unordered pair once
+        low = subset & -subset
+        left = (subset - 1) & subset
+        while left > 0:
+            right = subset ^ left
+            if left & low:
+                (flops_l, mem_l), idx_l, _ = best[left]
+                (flops_r, mem_r), idx_r, _ = best[right]
+                flops = flops_l + flops_r + _size(idx_l | idx_r,
+                                                  size_dict)
+                mem = max(mem_l, mem_r, _size(indices, size_dict))
+                if choice is None or (flops, mem) < choice[0]:
+                    choice = ((flops, mem), indices, (left, right))
+            left = (left - 1) & subset
+        best[subset] = choice
+
+    # Convert the tree to the linear path
+    path = []
+    positions = [1 << k for k in range(n_operands)]
+
+    def emit(subset):
+        _, _, split = best[subset]
+        if split is None:
+            return
+        left, right = split
+        emit(left)
+        emit(right)
+        i, j = sorted((positions.index(left), positions.index(right)))
+        path.append((i, j))
+        positions.pop(j)
+        positions.pop(i)
+        positions.append(subset)
+
+    emit(full)
+    return path
+
+
+def get_contraction_path(operands, output, size_dict=None,
+                         method='auto'):
+    """
+    Finds the pairwise order of contraction of tensors.
+
+    Parameters
+    ----------
+    operands : list
+           indices of the operands. Either
+           :py:class:`optimizer.Var` objects or integers
+           (then size_dict is required)
+    output : iterable
+           indices kept in the result
+    size_dict : dict, optional
+           sizes of the indices {int(index): size}
+    method : str, default 'auto'
+           one of {'sequential', 'greedy', 'optimal', 'auto'}.
+           'auto' uses the exhaustive search for small
+           number of operands and the greedy algorithm otherwise
+
+    Returns
+    -------
+    path : list of pairs
+    """
+    n_operands = len(operands)
+    if method == 'auto':
+        method = ('optimal' if n_operands <= MAX_EXHAUSTIVE_SIZE
+                  else 'greedy')
+    if method == 'sequential':
+        return get_sequential_path(n_operands)
+
+    size_dict = _get_size_dict(operands, size_dict)
+    operands = [frozenset(map(int, indices)) for indices in operands]
+    output = frozenset(map(int, output))
+
+    if method == 'greedy':
+        return get_greedy_path(operands, output, size_dict)
+    elif method == 'optimal':
+        return get_optimal_path(operands, output, size_dict)
+    else:
+        raise ValueError(f'Unknown method: {method}')
+
+
+def get_path_steps(operands, output, path):
+    """
+    Expands a path into contraction steps. Resulting indices
+    of each step are sorted by their integer values, as
+    expected by the bucket elimination.
+
+    Parameters
+    ----------
+    operands : list
+           indices of the operands
+    output : iterable
+           indices kept in the result
+    path : list of pairs
+           contraction path
+
+    Returns
+    -------
+    steps : list
+           triples (i, j, result_indices)
+    """
+    operands = [tuple(indices) for indices in operands]
+    output_ints = set(map(int, output))
+    steps = []
+    for i, j in path:
+        a, b = operands[i], operands[j]
+        others = [operands[k] for k in range(len(operands))
+                  if k != i and k != j]
+        needed = set(output_ints)
+        for indices in others:
+            needed.update(map(int, indices))
+        result = {int(idx): idx for idx in a + b if int(idx) in needed}
+        result = tuple(result[key] for key in sorted(result))
+        steps.append((i, j, result))
+        operands.pop(j)
+        operands.pop(i)
+        operands.append(result)
+    return steps
+
+
+def get_path_cost(operands, output, path, size_dict=None):
+    """
+    Calculates the cost of a path
+
+    Parameters
+    ----------
+    operands : list
+           indices of the operands
+    output : iterable
+           indices kept in the result
+    path : list of pairs
+           contraction path
+    size_dict : dict, optional
+           sizes of the indices {int(index): size}
+
+    Returns
+    -------
+    flops : int
+           number of multiplications
+    max_size : int
+           size of the largest intermediate
+    """
+    size_dict = _get_size_dict(operands, size_dict)
+    operands = [frozenset(map(int, indices)) for indices in operands]
+    output = frozenset(map(int, output))
+
+    flops = 0
+    max_size = 0
+    for i, j in path:
+        a, b = operands[i], operands[j]
+        others = [operands[k] for k in range(len(operands))
+                  if k != i and k != j]
+        result = _result_indices(a, b, others, output)
+        flops += _size(a | b, size_dict)
+        max_size = max(max_size, _size(result, size_dict))
+        operands.pop(j)
+        operands.pop(i)
+        operands.append(result)
+    return flops, max_size
+
+
+def test_contraction_path():
+    """
+    Checks that optimized paths are not worse than the sequential one
+    and that the exhaustive search is not worse than the greedy one
+    """
+    import random
+    random.seed(0)
+    size_dict = {idx: 2 for idx in range(12)}
+
+    for _ in range(20):
+        n_operands = random.randint(2, 6)
+        operands = [
+            (0, ) + tuple(random.sample(range(1, 12),
+                                        random.randint(0, 4)))
+            for _ in range(n_operands)]
+        output = sorted(set(itertools.chain(*operands)) - {0})
+
+        costs = {}
+        for method in ('sequential', 'greedy', 'optimal'):
+            path = get_contraction_path(operands, output,
+                                        size_dict, method=method)
+            assert len(path) == n_operands - 1
+            costs[method] = get_path_cost(operands, output,
+                                          path, size_dict)
+        assert costs['optimal'][0] <= costs['greedy'][0]
+        assert costs['optimal'][0] <= costs['sequential'][0]
+
+    # Outer product of disjoint tensors is avoided
+    operands = [(0, 1, 2, 3), (0, 4, 5, 6), (0, 1)]
+    path = get_contraction_path(operands, range(1, 7), size_dict,
+                                method='greedy')
+    assert path[0] == (0, 2)
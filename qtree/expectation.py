@@ -0,0 +1,316 @@
+"""
+This module implements the evaluation of expectation values
+<psi|O|psi> of local Pauli observables in the state prepared by
+a circuit from :math:`|0...0>`. For each term O only the backward
+light cone of its qubits is kept: the gates outside of it cancel
+with their conjugates in U^+ O U. The doubled network of the
+light cone is built with :py:meth:`optimizer.circ2buckets` and
+contracted. Terms with identical light cone structure share
+the contraction order.
+
+>>> evaluator = ExpectationEvaluator(n_qubits, circuit)
+>>> energy = sum(coeff * evaluator.eval_term(term)
+...              for coeff, term in hamiltonian)
+"""
+
+import copy
+import numpy as np
+
+import qtree.operators as ops
+import qtree.optimizer as opt
+import qtree.graph_model as gm
+import qtree.np_framework as npfr
+import qtree.circuit_passes as passes
+import qtree.utils as utils
+
+from qtree.logger_setup import log
+
+PAULI_GATES = {'X': ops.X, 'Y': ops.Y, 'Z': ops.Z}
+
+
+def get_light_cone(circuit, qubits):
+    """
+    Finds the gates in the backward light cone of the qubits
+
+    Parameters
+    ----------
+    circuit : list of lists
+            quantum circuit
+    qubits : iterable
+            qubits measured at the end of the circuit
+
+    Returns
+    -------
+    gates : list
+            gates of the light cone in the order of application
+    cone_qubits : list
+            sorted qubits touched by the light cone
+    """
+    cone_qubits = set(qubits)
+    gates = []
+    for layer in reversed(circuit):
+        for op in reversed(layer):
+            if cone_qubits.intersection(op.qubits):
+                cone_qubits.update(op.qubits)
+                gates.append(op)
+    return gates[::-1], sorted(cone_qubits)
+
+
+def _remap_gate(op, mapping, pdict):
+    """
+    Copies a gate to new qubits, filling placeholders
+    """
+    op = copy.copy(op)
+    op._qubits = tuple(mapping[qubit] for qubit in op.qubits)
+    op._parameters = {
+        par: (pdict[value] if isinstance(value, ops.placeholder)
+              else value)
+        for par, value in op.parameters.items()}
+    return op
+
+
+def get_doubled_circuit(circuit, term, pdict={}):
+    """
+    Builds the circuit U^+ O U restricted to the light cone
+    of the term. Qubits of the light cone are renumbered
+    consecutively.
+
+    Parameters
+    ----------
+    circuit : list of lists
+            quantum circuit U
+    term : dict
+            Pauli observable O as {qubit: 'X' | 'Y' | 'Z'}
+    pdict : dict, default {}
+            values of the placeholders
+
+    Returns
+    -------
+    n_qubits : int
+            number of qubits in the light cone
+    doubled_circuit : list of lists
+    """
+    for pauli in term.values():
+        if pauli not in PAULI_GATES:
+            raise ValueError(f'Unknown Pauli operator: {pauli}')
+
+    gates, cone_qubits = get_light_cone(circuit, term.keys())
+    mapping = {qubit: pos for pos, qubit in enumerate(cone_qubits)}
+    gates = [_remap_gate(op, mapping, pdict) for op in gates]
+
+    doubled = (gates
+               + [PAULI_GATES[pauli](mapping[qubit])
+                  for qubit, pauli in sorted(term.items())]
+               + [passes.dagger_gate(op) for op in reversed(gates)])
+    return len(cone_qubits), passes.layer_circuit(doubled)
+
+
+def get_structure_key(n_qubits, circuit):
+    """
+    Key which is equal for circuits with the same tensor network
+    graph, as produced by :py:meth:`optimizer.circ2buckets`
+    """
+    return (n_qubits, tuple(
+        (type(op) is ops.SWAP, op.qubits, op.changed_qubits)
+        for layer in circuit for op in layer))
+
+
+class ExpectationEvaluator(object):
+    """
+    Evaluates expectation values of Pauli terms in the state
+    U|0...0> prepared by a circuit. Contraction orders are cached by
+    the structure of the (simplified) light cone network, so terms
+    with equivalent light cones are ordered once.
+
+    Parameters
+    ----------
+    n_qubits : int
+            number of qubits in the circuit
+    circuit : list of lists
+            quantum circuit U
+    pdict : dict, default {}
+            values of the placeholders
+    peo_function : function, default :py:meth:`graph_model.get_peo`
+            function to calculate PEO. Should have signature
+            lambda (graph): return peo, treewidth
+    simplify : bool, default True
+            run :py:meth:`circuit_passes.simplify_circuit` on the
+            doubled circuits. Gates commuting with the observable
+            then cancel with their conjugates
+    dtype : numpy.dtype, optional
+            precision of the calculation. Defaults to
+            :py:data:`system_defs.NP_ARRAY_TYPE`
+    """
+    def __init__(self, n_qubits, circuit, pdict={},
+                 peo_function=gm.get_peo, simplify=True, dtype=None):
+        self.n_qubits = n_qubits
+        self.circuit = circuit
+        self.pdict = pdict
+        self.peo_function = peo_function
+        self.simplify = simplify
+        self.dtype = dtype
+        # {structure key: peo}
+        self.orders = {}
+        self.cache_hits = 0
+
+    def eval_term(self, term):
+        """
+        Evaluates <psi|O|psi> for a single Pauli term
+
+        Parameters
+        ----------
+        term : dict
+                Pauli observable O as {qubit: 'X' | 'Y' | 'Z'}.
+                An empty term is the identity
+
+        Returns
+        -------
+        value : float
+                the expectation value
+        """
+        if not set(term).issubset(range(self.n_qubits)):
+            raise ValueError(f'Term qubits outside allowed range: {term}')
+        if len(term) == 0:
+            return 1.
+
+        n_qubits, circuit = get_doubled_circuit(
+            self.circuit, term, self.pdict)
+        if self.simplify:
+            circuit, _ = passes.simplify_circuit(circuit)
+
+        buckets, data_dict, bra_vars, ket_vars = opt.circ2buckets(
+            n_qubits, circuit, dtype=self.dtype)
+
+        key = get_structure_key(n_qubits, circuit)
+        if key in self.orders:
+            peo = self.orders[key]
+            self.cache_hits += 1
+        else:
+            graph = gm.buckets2graph(
+                buckets, ignore_variables=bra_vars+ket_vars)
+            peo, _ = self.peo_function(graph)
+            self.orders[key] = peo
+
+        perm_buckets, perm_dict = opt.reorder_buckets(
+            buckets, bra_vars + ket_vars + peo)
+        ket_vars = [perm_dict[var] for var in ket_vars]
+        bra_vars = [perm_dict[var] for var in bra_vars]
+
+        slice_dict = utils.slice_from_bits(0, ket_vars)
+        slice_dict.update(utils.slice_from_bits(0, bra_vars))
+        sliced_buckets = npfr.get_sliced_np_buckets(
+            perm_buckets, data_dict, slice_dict)
+        result = opt.bucket_elimination(
+            sliced_buckets, npfr.process_bucket_np)
+
+        # the term is Hermitian, the imaginary part is a rounding error
+        return float(np.real(result.data))
+
+    def eval_terms(self, terms):
+        """
+        Evaluates expectation values of several Pauli terms
+
+        Parameters
+        ----------
+        terms : list
+                Pauli terms, see :py:meth:`eval_term`
+
+        Returns
+        -------
+        values : numpy.array
+        """
+        values = np.array([self.eval_term(term) for term in terms])
+        log.info(f'Evaluated {len(terms)} terms with'
+                 f' {len(self.orders)} contraction orders')
+        return values
+
+
+def eval_expectation(n_qubits, circuit, observable, pdict={},
+                     peo_function=gm.get_peo, dtype=None):
+    """
+    Evaluates <psi|O|psi> for a sum of Pauli terms
+    O = sum_k c_k P_k in the state U|0...0>
+
+    Parameters
+    ----------
+    n_qubits : int
+            number of qubits in the circuit
+    circuit : list of lists
+            quantum circuit U
+    observable : list
+            pairs (coefficient, term), see
+            :py:meth:`ExpectationEvaluator.eval_term`
+    pdict : dict, default {}
+            values of the placeholders
+    peo_function : function, default :py:meth:`graph_model.get_peo`
+            function to calculate PEO
+    dtype : numpy.dtype, optional
+            precision of the calculation
+
+    Returns
+    -------
+    value : float or complex
+    """
+    evaluator = ExpectationEvaluator(
+        n_qubits, circuit, pdict=pdict, peo_function=peo_function,
+        dtype=dtype)
+    coefficients = [coeff for coeff, _ in observable]
+    values = evaluator.eval_terms([term for _, term in observable])
+    return np.dot(coefficients, values)
+
+
+def test_expectation():
+    """
+    Compares expectation values with the ones evaluated
+    from the full state vector
+    """
+    import functools
+    import itertools
+    import qtree.simulator as sim
+
+    n_qubits = 6
+    circuit = ops.get_random_circuit(n_qubits, 4)
+    circuit.append([ops.ZPhase(qubit, alpha=0.1 * qubit)
+                    for qubit in range(n_qubits)])
+    circuit.append([ops.cZ(0, 1), ops.cZ(2, 3), ops.cZ(4, 5)])
+    peo_function = functools.partial(gm.get_upper_bound_peo,
+                                     method='min_fill')
+
+    amplitudes = sim.eval_amplitudes_batch(
+        n_qubits, circuit, np.arange(2**n_qubits),
+        batch_qubits=range(n_qubits), peo_function=peo_function,
+        dtype=np.complex128)
+    state = amplitudes.reshape([2] * n_qubits)
+
+    def reference(term):
+        other = state
+        for qubit, pauli in term.items():
+            matrix = passes.get_gate_matrix(PAULI_GATES[pauli](0))
+            other = np.moveaxis(
+                np.tensordot(matrix, other, axes=([1], [qubit])),
+                0, qubit)
+        return np.vdot(state, other).real
+
+    terms = [{}, {0: 'Z'}, {5: 'Z'}, {1: 'X'}, {1: 'Y'},
+             {2: 'Z', 3: 'Z'}, {0: 'Y', 4: 'X'}]
+    terms += [{qubit: pauli} for qubit, pauli in itertools.product(
+        range(n_qubits), 'XZ')]
+
+    evaluator = ExpectationEvaluator(n_qubits, circuit,
+                                     peo_function=peo_function,
+                                     dtype=np.complex128)
+    values = evaluator.eval_terms(terms)
+    assert np.allclose(values, [reference(term) for term in terms])
+    assert evaluator.cache_hits > 0
+
+    # the last layers are diagonal and commute with Z
+    _, doubled = get_doubled_circuit(circuit, {0: 'Z'})
+    simplified, report = passes.simplify_circuit(doubled)
+    assert report['gates'] > 0
+
+    observable = [(0.5, {0: 'Z', 1: 'Z'}), (-1., {2: 'X'})]
+    energy = eval_expectation(n_qubits, circuit, observable,
+                              peo_function=peo_function,
+                              dtype=np.complex128)
+    assert np.isclose(energy, 0.5 * reference({0: 'Z', 1: 'Z'})
+                      - reference({2: 'X'}))
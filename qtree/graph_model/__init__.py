@@ -7,9 +7,12 @@ from .base import (wrap_general_graph_for_qtree,
                    make_clique_on,
                    relabel_graph_nodes,
                    get_contraction_costs,
+                   get_live_memory,
                    eliminate_node,
                    draw_graph)
 from .peo_calculation import (get_upper_bound_peo,
+                              get_upper_bound_peo_multistart,
+                              get_cost_from_peo,
                               get_peo,
                               get_treewidth_from_peo)
 from .peo_reordering import get_equivalent_peo
@@ -18,3 +21,5 @@ from .splitters import (split_graph_by_metric,
                         split_graph_by_tree_trimming)
 
 from .importers import buckets2graph, circ2graph
+from .hypergraph import TensorHypergraph
+from .cost_estimator import CostEstimator, estimate_contraction_costs
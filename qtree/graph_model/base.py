@@ -8,6 +8,8 @@ from functools import reduce
 
 import matplotlib.pyplot as plt
 from qtree.logger_setup import log
+from qtree.graph_model.hypergraph import TensorHypergraph
+from qtree.graph_model.cost_estimator import estimate_contraction_costs
 
 random.seed(0)
 
@@ -107,7 +109,7 @@ def eliminate_node(graph, node, self_loops=True):
 
     Parameters
     ----------
-    graph : networkx.Graph or networkx.MultiGraph
+    graph : networkx.Graph, networkx.MultiGraph or TensorHypergraph
             Graph containing the information about the contraction
             GETS MODIFIED IN THIS FUNCTION
     node : node to contract (such that graph can be indexed by it)
@@ -118,6 +120,9 @@ def eliminate_node(graph, node, self_loops=True):
     -------
     None
     """
+    if isinstance(graph, TensorHypergraph):
+        return graph.eliminate_node(node, self_loops=self_loops)
+
     # Delete node itself from the list of its neighbors.
     # This eliminates possible self loop
     neighbors_wo_node = list(graph[node])
@@ -168,7 +173,7 @@ def remove_node(graph, node, self_loops=True):
 
     Parameters
     ----------
-    graph : networkx.Graph or networkx.MultiGraph
+    graph : networkx.Graph, networkx.MultiGraph or TensorHypergraph
             Graph containing the information about the contraction
             GETS MODIFIED IN THIS FUNCTION
     node : node to contract (such that graph can be indexed by it)
@@ -179,6 +184,9 @@ def remove_node(graph, node, self_loops=True):
     -------
     None
     """
+    if isinstance(graph, TensorHypergraph):
+        return graph.remove_node(node, self_loops=self_loops)
+
     # Delete node itself from the list of its neighbors.
     # This eliminates possible self loop
     neighbors_wo_node = list(graph[node])
@@ -221,7 +229,7 @@ def get_cost_by_node(graph, node):
 
     Parameters
     ----------
-    graph : networkx.MultiGraph
+    graph : networkx.MultiGraph or TensorHypergraph
                Graph containing the information about the contraction
 
     node : node of the graph (such that graph can be indexed by it)
@@ -233,6 +241,9 @@ def get_cost_by_node(graph, node):
     flops : int
               Flop cost for contraction of node
     """
+    if isinstance(graph, TensorHypergraph):
+        return graph.get_cost_by_node(node)
+
     neighbors_with_size = {neighbor: graph.nodes[neighbor]['size']
                            for neighbor in graph[node]}
 
@@ -346,10 +357,12 @@ def get_contraction_costs(old_graph, free_vars=[]):
     Estimates the cost of the bucket elimination algorithm.
     The order of elimination is defined by node order (if ints are
     used as nodes then it will be the values of integers).
+    See :py:class:`cost_estimator.CostEstimator` to evaluate many
+    orders or sliced variables on the same graph.
 
     Parameters
     ----------
-    old_graph : networkx.Graph or networkx.MultiGraph
+    old_graph : networkx.Graph, networkx.MultiGraph or TensorHypergraph
                Graph containing the information about the contraction
     free_vars : list, optional
                Nodes that will be skipped
@@ -360,43 +373,68 @@ def get_contraction_costs(old_graph, free_vars=[]):
     flops : list
               Flop cost for steps of the bucket elimination algorithm
     """
-    graph = copy.deepcopy(old_graph)
-    nodes = sorted(graph.nodes, key=int)
-    free_vars = [int(var) for var in free_vars]
-
     # Early return if graph is empty
-    if len(nodes) == 0:
+    if old_graph.number_of_nodes() == 0:
         return [1], [1]
 
-    results = []
-    for n, node in enumerate(nodes):
-        if node not in free_vars:
-            memory, flops = get_cost_by_node(graph, node)
-            results.append((memory, flops))
-            eliminate_node(graph, node)
-
-    # Estimate cost of the last tensor product if subsets of
-    # amplitudes were evaluated
-    if len(free_vars) > 0:
-        size_of_the_result = len(free_vars)
-        tensor_orders = [
-            subgraph.number_of_nodes()
-            for subgraph
-            in nx.components.connected_component_subgraphs(graph)]
-        # memory estimation: the size of the result + all sizes of terms
-        memory = 2**size_of_the_result
-        for order in tensor_orders:
-            memory += 2**order
-        # there are number of tensors - 1 multiplications
-        n_multiplications = len(tensor_orders) - 1
-
-        # There are n_multiplications repeated size of the result
-        # times
-        flops = 2**size_of_the_result*n_multiplications
-
-        results.append((memory, flops))
-
-    return tuple(zip(*results))
+    memory, flops = estimate_contraction_costs(old_graph,
+                                               free_vars=free_vars)
+    return tuple(memory.tolist()), tuple(flops.tolist())
+
+
+def get_live_memory(graph, free_vars=[]):
+    """
+    Estimates the memory of live intermediates during the
+    bucket elimination. The order of elimination is defined by node
+    order, as in :py:meth:`get_contraction_costs`. The result of each
+    step is alive until the bucket of its lowest variable is
+    processed, so unlike the sum of memory costs this estimates the
+    peak memory actually used, which is what
+    :py:class:`optimizer.MemoryTracker` measures.
+
+    Parameters
+    ----------
+    graph : networkx.Graph or networkx.MultiGraph
+               Graph containing the information about the contraction
+    free_vars : list, optional
+               Nodes that will be skipped
+
+    Returns
+    -------
+    memory : list
+              Number of elements in live intermediates after each
+              step of the bucket elimination algorithm
+    """
+    free_vars = set(int(var) for var in free_vars)
+    sizes = {node: graph.nodes[node]['size'] for node in graph.nodes}
+    adjacency = {node: set(graph[node]) - {node} for node in graph.nodes}
+
+    waiting = {}
+    live = 0
+    memory = []
+    for node in sorted(graph.nodes, key=int):
+        if int(node) in free_vars:
+            continue
+        neighbors = adjacency.pop(node)
+        size_of_the_result = reduce(
+            mul, [sizes[neighbor] for neighbor in neighbors], 1)
+        live += size_of_the_result
+        memory.append(live)
+
+        # inputs of this bucket are released
+        live -= waiting.pop(node, 0)
+        if len(neighbors) > 0:
+            target = min(neighbors, key=int)
+            waiting[target] = waiting.get(target, 0) + size_of_the_result
+        else:
+            live -= size_of_the_result
+
+        for neighbor in neighbors:
+            adjacency[neighbor].update(neighbors)
+            adjacency[neighbor].discard(neighbor)
+            adjacency[neighbor].discard(node)
+
+    return memory
 
 
 def draw_graph(graph, filename=''):
@@ -0,0 +1,295 @@
+"""
+This module implements a fast estimator of the cost of the bucket
+elimination. The graph is converted once into a compact form: a list
+of tensors, each a tuple of variable positions, and an array of
+variable sizes. Each estimate is then a symbolic bucket elimination
+over sets, which neither copies nor modifies a graph, so many orders
+or sets of sliced variables can be evaluated cheaply. Costs are
+the same as reported by :py:meth:`base.get_contraction_costs`.
+
+>>> estimator = CostEstimator(graph)
+>>> memory, flops = estimator.get_costs(peo, log2=True)
+"""
+
+import math
+import numpy as np
+
+from functools import reduce
+from operator import mul
+
+from qtree.graph_model.hypergraph import (TensorHypergraph,
+                                          get_graph_tensors)
+
+
+class CostEstimator(object):
+    """
+    Compact model of a tensor network for cost estimation
+
+    Parameters
+    ----------
+    graph : networkx.Graph, networkx.MultiGraph or TensorHypergraph
+            graph of the network
+    """
+    def __init__(self, graph):
+        if isinstance(graph, TensorHypergraph):
+            self.labels = graph.nodes
+            self._sizes = [graph.size(label) for label in self.labels]
+            graph_tensors = graph.tensors()
+        else:
+            self.labels = sorted(int(node) for node in graph.nodes)
+            self._sizes = [graph.nodes[label].get('size', 2)
+                           for label in self.labels]
+            graph_tensors = get_graph_tensors(graph)
+        self._positions = {label: pos for pos, label
+                           in enumerate(self.labels)}
+
+        self._tensors = [
+            (tensor['name'],
+             tuple(self._positions[idx] for idx in tensor['indices']),
+             tensor['data_key'])
+            for tensor in graph_tensors]
+
+        # identical tensors are counted once, as in the graph model
+        self._unique_positions = [positions for _, positions, _
+                                  in dict.fromkeys(self._tensors)]
+        self._unique_sizes = self._get_sizes(self._unique_positions)
+
+    def _get_sizes(self, tensor_positions):
+        """
+        Sizes of tensors as Python ints
+        """
+        if len(tensor_positions) == 0:
+            return []
+        lengths = np.array([len(positions)
+                            for positions in tensor_positions])
+        flat = np.array([pos for positions in tensor_positions
+                         for pos in positions], dtype=np.int64)
+        sizes = np.array(self._sizes, dtype=object)[flat]
+        # empty tensors are scalars
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        nonempty = lengths > 0
+        result = np.ones(len(tensor_positions), dtype=object)
+        if np.any(nonempty):
+            result[nonempty] = np.multiply.reduceat(
+                sizes, starts[nonempty])
+        return result.tolist()
+
+    def _get_tensors(self, removed):
+        """
+        Positions and sizes of the tensors after the removed
+        variables are sliced, as :py:meth:`base.remove_node` does
+        """
+        if len(removed) == 0:
+            return self._unique_positions, self._unique_sizes
+
+        tensors = {}
+        for name, positions, data_key in self._tensors:
+            if not removed.isdisjoint(positions):
+                positions = tuple(pos for pos in positions
+                                  if pos not in removed)
+                # the data of this tensor is a slice
+                data_key = None
+                if len(positions) == 0:
+                    continue
+            tensors.setdefault((name, positions, data_key), positions)
+        tensor_positions = list(tensors.values())
+        return tensor_positions, self._get_sizes(tensor_positions)
+
+    def get_costs(self, peo=None, free_vars=[], removed_vars=[],
+                  log2=False):
+        """
+        Estimates the cost of the bucket elimination
+
+        Parameters
+        ----------
+        peo : list, optional
+                elimination order. By default the variables are
+                eliminated in the order of their labels
+        free_vars : list, optional
+                variables which are not eliminated. The cost of the
+                final product over them is added as the last step
+        removed_vars : list, optional
+                variables with fixed values (sliced)
+        log2 : bool, default False
+                return log2 of the costs instead of exact values
+
+        Returns
+        -------
+        memory : numpy.array
+                Memory cost for steps of the bucket elimination
+                algorithm. Python ints, or floats if log2 is True
+        flops : numpy.array
+                Flop cost for steps of the bucket elimination algorithm
+        """
+        removed = set(self._positions[int(var)] for var in removed_vars)
+        free = set(self._positions[int(var)] for var in free_vars)
+        free -= removed
+        if peo is None:
+            order = [pos for pos in range(len(self.labels))
+                     if pos not in free and pos not in removed]
+        else:
+            order = [self._positions[int(var)] for var in peo]
+            order = [pos for pos in order
+                     if pos not in free and pos not in removed]
+
+        n_steps = len(order)
+        rank = [n_steps] * len(self.labels)
+        for step, pos in enumerate(order):
+            rank[pos] = step
+
+        # the bucket of a tensor is its first eliminated variable
+        bucket_indices = [[] for _ in range(n_steps + 1)]
+        bucket_sizes = [[] for _ in range(n_steps + 1)]
+        for positions, size in zip(*self._get_tensors(removed)):
+            step = min(rank[pos] for pos in positions)
+            bucket_indices[step].append(positions)
+            bucket_sizes[step].append(size)
+
+        sizes = self._sizes
+        memory = []
+        flops = []
+        for step, pos in enumerate(order):
+            result = set().union(*bucket_indices[step])
+            result.discard(pos)
+            size_of_the_result = reduce(
+                mul, [sizes[other] for other in result], 1)
+            memory.append(size_of_the_result + sum(bucket_sizes[step]))
+            n_multiplications = max(len(bucket_sizes[step]) - 1, 0)
+            flops.append(size_of_the_result
+                         * sizes[pos] * (sizes[pos] + n_multiplications))
+
+            if len(result) > 0:
+                target = min(rank[other] for other in result)
+                bucket_indices[target].append(tuple(result))
+                bucket_sizes[target].append(size_of_the_result)
+
+        # Estimate cost of the last tensor product if subsets of
+        # amplitudes were evaluated
+        if len(free) > 0:
+            parents = {pos: pos for pos in free}
+
+            def find(pos):
+                while parents[pos] != pos:
+                    parents[pos] = parents[parents[pos]]
+                    pos = parents[pos]
+                return pos
+
+            for positions in bucket_indices[n_steps]:
+                for other in positions[1:]:
+                    parents[find(other)] = find(positions[0])
+            component_sizes = {}
+            for pos in free:
+                root = find(pos)
+                component_sizes[root] = component_sizes.get(root, 0) + 1
+
+            size_of_the_result = 2**len(free)
+            memory.append(size_of_the_result + sum(
+                2**order for order in component_sizes.values()))
+            flops.append(size_of_the_result * (len(component_sizes) - 1))
+
+        if log2:
+            return (np.array([_log2(value) for value in memory]),
+                    np.array([_log2(value) for value in flops]))
+        return np.array(memory, dtype=object), np.array(flops, dtype=object)
+
+
+def _log2(value):
+    return math.log2(value) if value > 0 else -np.inf
+
+
+def estimate_contraction_costs(graph, peo=None, free_vars=[], log2=False):
+    """
+    Estimates the cost of the bucket elimination algorithm.
+    See :py:meth:`CostEstimator.get_costs`
+
+    Parameters
+    ----------
+    graph : networkx.Graph, networkx.MultiGraph or TensorHypergraph
+            graph of the network
+    peo : list, optional
+            elimination order. By default the variables are
+            eliminated in the order of their labels
+    free_vars : list, optional
+            variables which are not eliminated
+    log2 : bool, default False
+            return log2 of the costs instead of exact values
+
+    Returns
+    -------
+    memory : numpy.array
+            Memory cost for steps of the bucket elimination algorithm
+    flops : numpy.array
+            Flop cost for steps of the bucket elimination algorithm
+    """
+    return CostEstimator(graph).get_costs(peo, free_vars=free_vars,
+                                          log2=log2)
+
+
+def test_cost_estimator():
+    """
+    Compares the estimates with the elimination in the graph model
+    """
+    import copy
+    import qtree.operators as ops
+    import qtree.optimizer as opt
+    from qtree.graph_model.base import (eliminate_node, remove_node,
+                                        get_cost_by_node)
+    from qtree.graph_model.importers import buckets2graph
+
+    def get_reference(graph, peo):
+        graph = copy.deepcopy(graph)
+        results = []
+        for node in peo:
+            results.append(get_cost_by_node(graph, node))
+            eliminate_node(graph, node)
+        return [list(values) for values in zip(*results)]
+
+    n_qubits = 6
+    circuit = ops.get_random_circuit(n_qubits, 12)
+    buckets, _, bra_vars, ket_vars = opt.circ2buckets(n_qubits, circuit)
+    graph = buckets2graph(buckets, ignore_variables=bra_vars+ket_vars)
+    # repeated identical tensors are counted once
+    node = next(iter(graph.nodes))
+    graph.add_edge(node, node, tensor={'name': 'T', 'indices': (node,),
+                                       'data_key': 0})
+    graph.add_edge(node, node, tensor={'name': 'T', 'indices': (node,),
+                                       'data_key': 0})
+    for node in list(graph.nodes)[::4]:
+        graph.nodes[node]['size'] = 3
+
+    estimator = CostEstimator(graph)
+    nodes = sorted(graph.nodes)
+    memory, flops = estimator.get_costs()
+    assert [memory.tolist(), flops.tolist()] == get_reference(graph, nodes)
+
+    peo = list(np.random.RandomState(0).permutation(nodes))
+    memory, flops = estimator.get_costs(peo)
+    assert [memory.tolist(), flops.tolist()] == get_reference(graph, peo)
+    memory_log, flops_log = estimator.get_costs(peo, log2=True)
+    assert np.allclose(memory_log, np.log2(memory.astype(float)))
+    assert np.allclose(flops_log, np.log2(flops.astype(float)))
+
+    # sliced variables
+    removed = nodes[1::5]
+    reduced_graph = copy.deepcopy(graph)
+    for node in removed:
+        remove_node(reduced_graph, node)
+    memory, flops = estimator.get_costs(removed_vars=removed)
+    assert [memory.tolist(), flops.tolist()] == get_reference(
+        reduced_graph, sorted(reduced_graph.nodes))
+
+    # the hypergraph gives the same estimates
+    hypergraph = TensorHypergraph.from_buckets(
+        buckets, ignore_variables=bra_vars+ket_vars)
+    assert np.array_equal(
+        estimate_contraction_costs(hypergraph)[1],
+        estimate_contraction_costs(
+            buckets2graph(buckets, ignore_variables=bra_vars+ket_vars))[1])
+
+    # free variables form a final product
+    free_vars = nodes[-3:]
+    memory, flops = estimator.get_costs(free_vars=free_vars)
+    reference = get_reference(graph, nodes[:-3])
+    assert memory.tolist()[:-1] == reference[0]
+    assert flops.tolist()[:-1] == reference[1]
+    assert len(memory) == len(nodes) - 2
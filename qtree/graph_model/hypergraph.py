@@ -0,0 +1,609 @@
+"""
+This module implements an array-backed hypergraph model of a tensor
+network. In contrast to the networkx.MultiGraph used elsewhere in
+:py:mod:`graph_model`, where a tensor with k indices is stored as
+k(k-1)/2 edges each carrying a copy of the tensor dictionary, here
+every tensor is stored once:
+
+- tensor -> indices in CSR-like arrays, with the indices of the
+  tensors appended to a single buffer
+- index -> tensors as linked lists threaded through the same buffer
+- adjacency of the indices as bitsets (Python ints), stored relative
+  to the lowest neighbor so their size follows the span of the
+  neighborhood and not the size of the graph
+
+Elimination and removal of a node cost O(deg^2) bitset operations,
+and copies are a handful of array copies.
+
+>>> graph = TensorHypergraph.from_buckets(buckets)
+>>> graph.eliminate_node(node)
+>>> nx_graph = graph.to_graph()
+"""
+
+import itertools
+import numpy as np
+import networkx as nx
+
+from functools import reduce
+from operator import mul
+
+
+def _get_positions(bits, offset=0):
+    """
+    Positions of the set bits in ascending order
+    """
+    positions = []
+    while bits:
+        low = bits & -bits
+        positions.append(offset + low.bit_length() - 1)
+        bits ^= low
+    return positions
+
+
+def _get_bitset(positions):
+    """
+    Bitset of positions, relative to the lowest one
+    """
+    if len(positions) == 0:
+        return 0, 0
+    lowest = min(positions)
+    bits = 0
+    for position in positions:
+        bits |= 1 << (position - lowest)
+    return lowest, bits
+
+
+def _union(lowest_a, bits_a, lowest_b, bits_b):
+    if bits_a == 0:
+        return lowest_b, bits_b
+    if bits_b == 0:
+        return lowest_a, bits_a
+    lowest = min(lowest_a, lowest_b)
+    return lowest, ((bits_a << (lowest_a - lowest))
+                    | (bits_b << (lowest_b - lowest)))
+
+
+def _normalize(lowest, bits):
+    if bits == 0:
+        return 0, 0
+    shift = (bits & -bits).bit_length() - 1
+    return lowest + shift, bits >> shift
+
+
+def _grow(array, size):
+    """
+    Enlarges a buffer to hold at least size elements
+    """
+    if size <= len(array):
+        return array
+    new_array = np.empty(max(size, 2 * len(array)), dtype=array.dtype)
+    new_array[:len(array)] = array
+    return new_array
+
+
+def get_graph_tensors(graph):
+    """
+    Extracts the tensors of a networkx graph from :py:mod:`graph_model`.
+    Parallel copies of a tensor are recovered from the number of
+    edges carrying it. Edges without tensors are treated as
+    two-index tensors
+
+    Parameters
+    ----------
+    graph : networkx.Graph or networkx.MultiGraph
+
+    Returns
+    -------
+    tensors : list of dict
+            tensors as {'name': ..., 'indices': ..., 'data_key': ...}
+    """
+    edge_counts = {}
+    for *edge, tensor in graph.edges(data='tensor'):
+        if tensor is None:
+            tensor = {'name': 'W', 'indices': tuple(edge),
+                      'data_key': None}
+        key = (tensor['name'], tuple(map(int, tensor['indices'])),
+               tensor['data_key'])
+        edge_counts[key] = edge_counts.get(key, 0) + 1
+
+    tensors = []
+    for (name, indices, data_key), count in edge_counts.items():
+        n_edges = max(1, len(indices) * (len(indices) - 1) // 2)
+        for _ in range(max(1, count // n_edges)):
+            tensors.append({'name': name, 'indices': indices,
+                            'data_key': data_key})
+    return tensors
+
+
+class TensorHypergraph(object):
+    """
+    Hypergraph of a tensor network. Nodes are the variables
+    (indices) of the network, labeled by ints, and hyperedges
+    are the tensors. The node set can only shrink.
+
+    Use :py:meth:`from_buckets` or :py:meth:`from_graph` to
+    construct it.
+
+    Parameters
+    ----------
+    labels : sequence of int
+            labels of the nodes
+    sizes : sequence of int
+            sizes of the variables
+    names : sequence of str
+            names of the variables
+    tensors : sequence of dict
+            tensors as {'name': ..., 'indices': (label, ...),
+            'data_key': ...}
+    """
+    def __init__(self, labels, sizes, names, tensors):
+        labels = [int(label) for label in labels]
+        order = sorted(range(len(labels)), key=lambda ii: labels[ii])
+        # the immutable part is shared between copies
+        self._labels = np.array([labels[ii] for ii in order],
+                                dtype=np.int64)
+        self._sizes = np.array([sizes[ii] for ii in order],
+                               dtype=np.int64)
+        self._size_list = self._sizes.tolist()
+        self._names = [names[ii] for ii in order]
+        self._positions = {label: pos for pos, label
+                           in enumerate(self._labels.tolist())}
+        if len(self._positions) != len(labels):
+            raise ValueError('Node labels are not unique')
+
+        n_nodes = len(labels)
+        self._alive = np.ones(n_nodes, dtype=bool)
+        self._n_alive = n_nodes
+
+        tensors = list(tensors)
+        lengths = np.array([len(tensor['indices']) for tensor in tensors],
+                           dtype=np.int64)
+        slots = np.array(
+            [self._positions[int(idx)] for tensor in tensors
+             for idx in tensor['indices']], dtype=np.int64)
+
+        # tensor -> indices
+        self._n_tensors = len(tensors)
+        self._starts = np.concatenate(
+            ([0], np.cumsum(lengths)[:-1])).astype(np.int64)
+        self._lengths = lengths
+        self._tensor_alive = np.ones(len(tensors), dtype=bool)
+        self._tensor_names = [tensor['name'] for tensor in tensors]
+        self._tensor_keys = [tensor['data_key'] for tensor in tensors]
+
+        # index -> tensors, linked through the slots in ascending order
+        self._n_slots = len(slots)
+        self._slots = slots
+        self._slot_tensors = np.repeat(
+            np.arange(len(tensors), dtype=np.int64), lengths)
+        self._next = np.full(len(slots), -1, dtype=np.int64)
+        self._heads = np.full(n_nodes, -1, dtype=np.int64)
+        if len(slots) > 0:
+            by_node = np.argsort(slots, kind='stable')
+            same = slots[by_node[:-1]] == slots[by_node[1:]]
+            self._next[by_node[:-1][same]] = by_node[1:][same]
+            first = np.concatenate(([True], ~same))
+            self._heads[slots[by_node[first]]] = by_node[first]
+
+        # adjacency bitsets, excluding the node itself
+        self._adj_lowest = [0] * n_nodes
+        self._adj_bits = [0] * n_nodes
+        for tensor in range(len(tensors)):
+            positions = self._get_tensor_positions(tensor)
+            if len(positions) < 2:
+                continue
+            lowest, bits = _get_bitset(positions)
+            for pos in positions:
+                self._adj_lowest[pos], self._adj_bits[pos] = _union(
+                    self._adj_lowest[pos], self._adj_bits[pos],
+                    lowest, bits)
+        for pos in range(n_nodes):
+            self._remove_neighbors(pos, (pos,))
+
+    @classmethod
+    def from_buckets(cls, buckets, ignore_variables=[]):
+        """
+        Builds the hypergraph of buckets, as
+        :py:meth:`importers.buckets2graph` does
+
+        Parameters
+        ----------
+        buckets : list of lists
+        ignore_variables : list, optional
+                variables to remove from the resulting graph
+
+        Returns
+        -------
+        graph : TensorHypergraph
+        """
+        variables = {}
+        tensors = []
+        for bucket in buckets:
+            for tensor in bucket:
+                for idx in tensor.indices:
+                    variables[int(idx)] = idx
+                tensors.append({
+                    'name': tensor.name,
+                    'indices': tuple(map(int, tensor.indices)),
+                    'data_key': tensor.data_key})
+        graph = cls(variables.keys(),
+                    [var.size for var in variables.values()],
+                    [var.name for var in variables.values()],
+                    tensors)
+        for var in ignore_variables:
+            graph.remove_node(int(var))
+        return graph
+
+    @classmethod
+    def from_graph(cls, graph):
+        """
+        Converts a networkx graph from :py:mod:`graph_model`.
+        Tensors are extracted with :py:meth:`get_graph_tensors`
+
+        Parameters
+        ----------
+        graph : networkx.Graph or networkx.MultiGraph
+
+        Returns
+        -------
+        graph : TensorHypergraph
+        """
+        tensors = get_graph_tensors(graph)
+        nodes = list(graph.nodes)
+        return cls(nodes,
+                   [graph.nodes[node].get('size', 2) for node in nodes],
+                   [graph.nodes[node].get('name', f'v_{node}')
+                    for node in nodes],
+                   tensors)
+
+    def to_graph(self):
+        """
+        Converts to the networkx.MultiGraph used in
+        :py:mod:`graph_model`, as produced by
+        :py:meth:`importers.buckets2graph`
+
+        Returns
+        -------
+        graph : networkx.MultiGraph
+        """
+        graph = nx.MultiGraph()
+        for pos in np.flatnonzero(self._alive):
+            graph.add_node(int(self._labels[pos]), name=self._names[pos],
+                           size=int(self._sizes[pos]))
+        for tensor in np.flatnonzero(self._tensor_alive[:self._n_tensors]):
+            tensor_dict = self._get_tensor_dict(tensor)
+            indices = tensor_dict['indices']
+            if len(indices) > 1:
+                edges = itertools.combinations(indices, 2)
+            else:
+                edges = [(indices[0], indices[0])]
+            graph.add_edges_from(edges, tensor=tensor_dict)
+        return graph
+
+    def copy(self):
+        """
+        Returns an independent copy of the graph
+        """
+        new_graph = object.__new__(type(self))
+        new_graph.__dict__.update(self.__dict__)
+        for name in ('_alive', '_heads'):
+            setattr(new_graph, name, getattr(self, name).copy())
+        for name in ('_starts', '_lengths', '_tensor_alive'):
+            setattr(new_graph, name,
+                    getattr(self, name)[:self._n_tensors].copy())
+        for name in ('_slots', '_slot_tensors', '_next'):
+            setattr(new_graph, name,
+                    getattr(self, name)[:self._n_slots].copy())
+        for name in ('_tensor_names', '_tensor_keys',
+                     '_adj_lowest', '_adj_bits'):
+            setattr(new_graph, name, list(getattr(self, name)))
+        return new_graph
+
+    def __copy__(self):
+        return self.copy()
+
+    def __deepcopy__(self, memo):
+        return self.copy()
+
+    @property
+    def nodes(self):
+        """
+        Labels of the nodes in ascending order
+        """
+        return self._labels[self._alive].tolist()
+
+    def number_of_nodes(self):
+        return self._n_alive
+
+    def number_of_tensors(self):
+        return int(np.count_nonzero(
+            self._tensor_alive[:self._n_tensors]))
+
+    def __len__(self):
+        return self._n_alive
+
+    def __contains__(self, node):
+        pos = self._positions.get(int(node))
+        return pos is not None and bool(self._alive[pos])
+
+    def _get_position(self, node):
+        pos = self._positions.get(int(node))
+        if pos is None or not self._alive[pos]:
+            raise KeyError(f'Node {node} is not in the graph')
+        return pos
+
+    def _get_tensor_positions(self, tensor):
+        start = self._starts[tensor]
+        return self._slots[start:start + self._lengths[tensor]].tolist()
+
+    def _get_tensor_dict(self, tensor):
+        return {'name': self._tensor_names[tensor],
+                'indices': tuple(
+                    self._labels[self._get_tensor_positions(tensor)]
+                    .tolist()),
+                'data_key': self._tensor_keys[tensor]}
+
+    def _get_incident_tensors(self, pos):
+        tensors = []
+        slot = self._heads[pos]
+        while slot >= 0:
+            tensor = self._slot_tensors[slot]
+            if self._tensor_alive[tensor]:
+                tensors.append(int(tensor))
+            slot = self._next[slot]
+        return tensors
+
+    def _get_neighbor_positions(self, pos):
+        return _get_positions(self._adj_bits[pos], self._adj_lowest[pos])
+
+    def _remove_neighbors(self, pos, positions):
+        lowest, bits = self._adj_lowest[pos], self._adj_bits[pos]
+        for other in positions:
+            if lowest <= other:
+                bits &= ~(1 << (other - lowest))
+        self._adj_lowest[pos], self._adj_bits[pos] = _normalize(
+            lowest, bits)
+
+    def _add_tensor(self, name, positions, data_key):
+        tensor = self._n_tensors
+        self._n_tensors += 1
+        for attr in ('_starts', '_lengths', '_tensor_alive'):
+            setattr(self, attr, _grow(getattr(self, attr),
+                                      self._n_tensors))
+        self._starts[tensor] = self._n_slots
+        self._lengths[tensor] = len(positions)
+        self._tensor_alive[tensor] = True
+        self._tensor_names.append(name)
+        self._tensor_keys.append(data_key)
+
+        slots = np.arange(self._n_slots, self._n_slots + len(positions))
+        self._n_slots += len(positions)
+        for attr in ('_slots', '_slot_tensors', '_next'):
+            setattr(self, attr, _grow(getattr(self, attr), self._n_slots))
+        positions = np.array(positions, dtype=np.int64)
+        self._slots[slots] = positions
+        self._slot_tensors[slots] = tensor
+        self._next[slots] = self._heads[positions]
+        self._heads[positions] = slots
+
+    def _kill_node(self, pos):
+        self._alive[pos] = False
+        self._n_alive -= 1
+        self._heads[pos] = -1
+        self._adj_lowest[pos], self._adj_bits[pos] = 0, 0
+
+    def neighbors(self, node):
+        """
+        Labels of the neighbors of the node, excluding the node itself
+        """
+        pos = self._get_position(node)
+        return self._labels[self._get_neighbor_positions(pos)].tolist()
+
+    def degree(self, node):
+        """
+        Number of neighbors of the node, excluding the node itself
+        """
+        pos = self._get_position(node)
+        return bin(self._adj_bits[pos]).count('1')
+
+    def size(self, node):
+        return self._size_list[self._get_position(node)]
+
+    def name(self, node):
+        return self._names[self._get_position(node)]
+
+    def tensors(self, node=None):
+        """
+        Tensors of the graph, or the ones containing a node
+
+        Parameters
+        ----------
+        node : int, optional
+
+        Returns
+        -------
+        tensors : list of dict
+                tensors as {'name': ..., 'indices': ..., 'data_key': ...}
+        """
+        if node is None:
+            tensors = np.flatnonzero(self._tensor_alive[:self._n_tensors])
+        else:
+            tensors = sorted(
+                self._get_incident_tensors(self._get_position(node)))
+        return [self._get_tensor_dict(tensor) for tensor in tensors]
+
+    def eliminate_node(self, node, self_loops=True):
+        """
+        Eliminates node according to the tensor contraction rules.
+        All tensors containing the node are replaced with a single
+        tensor over its neighbors, as in
+        :py:meth:`base.eliminate_node`
+
+        Parameters
+        ----------
+        node : int
+                node to contract
+        self_loops : bool, default True
+                whether to keep a single-index result tensor if the
+                node had one neighbor
+        """
+        pos = self._get_position(node)
+        for tensor in self._get_incident_tensors(pos):
+            self._tensor_alive[tensor] = False
+
+        lowest, bits = self._adj_lowest[pos], self._adj_bits[pos]
+        neighbors = _get_positions(bits, lowest)
+        self._kill_node(pos)
+
+        # neighbors form a clique
+        for neighbor in neighbors:
+            self._adj_lowest[neighbor], self._adj_bits[neighbor] = _union(
+                self._adj_lowest[neighbor], self._adj_bits[neighbor],
+                lowest, bits)
+            self._remove_neighbors(neighbor, (neighbor, pos))
+
+        if len(neighbors) > 1 or (len(neighbors) == 1 and self_loops):
+            self._add_tensor(f'E{int(node)}', neighbors, None)
+
+    def remove_node(self, node, self_loops=True):
+        """
+        Eliminates node if its value was fixed. The node is
+        dropped from all tensors containing it, as in
+        :py:meth:`base.remove_node`
+
+        Parameters
+        ----------
+        node : int
+                node to remove
+        self_loops : bool, default True
+                whether to keep tensors left with a single index
+        """
+        pos = self._get_position(node)
+        tensors = self._get_incident_tensors(pos)
+        neighbors = self._get_neighbor_positions(pos)
+        self._kill_node(pos)
+
+        for tensor in tensors:
+            self._tensor_alive[tensor] = False
+            positions = [other for other
+                         in self._get_tensor_positions(tensor)
+                         if other != pos]
+            if len(positions) > 1 or (len(positions) == 1 and self_loops):
+                # the data of this tensor is a slice
+                self._add_tensor(self._tensor_names[tensor], positions,
+                                 None)
+
+        for neighbor in neighbors:
+            self._remove_neighbors(neighbor, (pos,))
+
+    def get_cost_by_node(self, node):
+        """
+        Outputs the cost corresponding to the contraction of the node,
+        as :py:meth:`base.get_cost_by_node` does
+
+        Parameters
+        ----------
+        node : int
+
+        Returns
+        -------
+        memory : int
+                Memory cost for contraction of node
+        flops : int
+                Flop cost for contraction of node
+        """
+        pos = self._get_position(node)
+        # identical tensors are counted once, as in the graph model
+        tensors = set()
+        for tensor in self._get_incident_tensors(pos):
+            tensors.add((self._tensor_names[tensor],
+                         tuple(self._get_tensor_positions(tensor)),
+                         self._tensor_keys[tensor]))
+
+        sizes = self._size_list
+        size_of_the_result = reduce(
+            mul, [sizes[other] for other
+                  in self._get_neighbor_positions(pos)], 1)
+        memory = size_of_the_result
+        for _, positions, _ in tensors:
+            memory += reduce(mul, [sizes[other] for other in positions], 1)
+
+        n_unique_tensors = len(tensors)
+        assert n_unique_tensors > 0
+        n_multiplications = n_unique_tensors - 1
+        flops = (size_of_the_result
+                 * sizes[pos] * (sizes[pos] + n_multiplications))
+        return memory, flops
+
+
+def test_hypergraph():
+    """
+    Compares the hypergraph with the networkx graph model
+    """
+    import copy
+    import qtree.operators as ops
+    import qtree.optimizer as opt
+    from qtree.graph_model.base import (eliminate_node, remove_node,
+                                        get_cost_by_node,
+                                        get_contraction_costs)
+    from qtree.graph_model.importers import buckets2graph
+
+    def get_tensors(graph):
+        if isinstance(graph, TensorHypergraph):
+            tensors = graph.tensors()
+        else:
+            tensors = TensorHypergraph.from_graph(graph).tensors()
+        # indices of the results are ordered differently
+        return sorted((tensor['name'], tuple(sorted(tensor['indices'])))
+                      for tensor in tensors)
+
+    def get_adjacency(graph):
+        return {node: sorted(set(graph[node]) - {node})
+                for node in graph.nodes}
+
+    n_qubits = 5
+    circuit = ops.get_random_circuit(n_qubits, 8)
+    buckets, _, bra_vars, ket_vars = opt.circ2buckets(n_qubits, circuit)
+    nx_graph = buckets2graph(buckets, ignore_variables=bra_vars+ket_vars)
+    graph = TensorHypergraph.from_buckets(
+        buckets, ignore_variables=bra_vars+ket_vars)
+
+    assert graph.nodes == sorted(nx_graph.nodes)
+    assert get_tensors(graph) == get_tensors(nx_graph)
+    # conversions in both directions preserve the graph
+    assert get_tensors(TensorHypergraph.from_graph(nx_graph)) \
+        == get_tensors(graph)
+    assert get_tensors(graph.to_graph()) == get_tensors(nx_graph)
+    assert get_adjacency(graph.to_graph()) == get_adjacency(nx_graph)
+    assert nx_graph.number_of_edges() == graph.to_graph().number_of_edges()
+
+    for node in graph.nodes:
+        assert get_cost_by_node(graph, node) \
+            == get_cost_by_node(nx_graph, node)
+
+    # costs of the full elimination agree
+    assert get_contraction_costs(graph) == get_contraction_costs(nx_graph)
+
+    # eliminate and remove nodes in the same order in both models
+    other = copy.deepcopy(graph)
+    rng = np.random.RandomState(0)
+    for step, node in enumerate(rng.permutation(graph.nodes)):
+        node = int(node)
+        if step % 3 == 0:
+            remove_node(graph, node)
+            remove_node(nx_graph, node)
+        else:
+            eliminate_node(graph, node)
+            eliminate_node(nx_graph, node)
+        assert get_adjacency(graph.to_graph()) == get_adjacency(nx_graph)
+        assert get_tensors(graph) == get_tensors(nx_graph)
+        assert graph.nodes == sorted(nx_graph.nodes)
+        if len(graph) > 0:
+            assert {n: graph.degree(n) for n in graph.nodes} == {
+                n: len(neighbors) for n, neighbors
+                in get_adjacency(nx_graph).items()}
+
+    assert len(graph) == 0
+    # the copy is not affected
+    assert other.nodes == sorted(buckets2graph(
+        buckets, ignore_variables=bra_vars+ket_vars).nodes)
@@ -2,6 +2,7 @@
 Conversion from other data structures to the graphs supported by
 qtree
 """
+import numpy as np
 import networkx as nx
 import itertools
 import re
@@ -14,7 +15,7 @@ from qtree.logger_setup import log
 
 
 def circ2graph(qubit_count, circuit, pdict={}, max_depth=None,
-               omit_terminals=True):
+               omit_terminals=True, dtype=None):
     """
     Constructs a graph from a circuit in the form of a
     list of lists.
@@ -34,19 +35,29 @@ def circ2graph(qubit_count, circuit, pdict={}, max_depth=None,
     omit_terminals : bool, default True
             If terminal nodes should be excluded from the final
             graph.
+    dtype : numpy.dtype, optional
+            Precision of the tensor data. Defaults to
+            :py:data:`system_defs.NP_ARRAY_TYPE`
 
     Returns
     -------
     graph : networkx.MultiGraph
             Graph which corresponds to the circuit
     data_dict : dict
-            Dictionary with all tensor data
+            Dictionary with all tensor data. The arrays are
+            read-only and shared with other circuits through
+            :py:mod:`tensor_cache`. Copy an array before
+            modifying it
     """
     import functools
     import qtree.operators as ops
+    import qtree.system_defs as defs
+    import qtree.tensor_cache as tc
 
     if max_depth is None:
         max_depth = len(circuit)
+    if dtype is None:
+        dtype = defs.NP_ARRAY_TYPE
 
     data_dict = {}
 
@@ -111,7 +122,7 @@ def circ2graph(qubit_count, circuit, pdict={}, max_depth=None,
                       'data_key': data_key}
 
             # Insert tensor data into data dict
-            data_dict[data_key] = op.gen_tensor()
+            data_dict[data_key] = tc.get_gate_tensor(op, dtype)
 
             if len(variables) > 1:
                 edges = itertools.combinations(variables, 2)
@@ -11,6 +11,9 @@ import os
 import sys
 import functools
 import itertools
+import collections
+import multiprocessing
+import heapq
 
 import time
 
@@ -19,8 +22,11 @@ from qtree.graph_model.exporters import (generate_cnf_file, generate_gr_file)
 from qtree.graph_model.importers import read_td_file, get_stats_from_td_file
 
 from qtree.optimizer import Var
+from qtree.logger_setup import log
 from qtree.graph_model.base import (
     eliminate_node, relabel_graph_nodes, get_simple_graph)
+from qtree.graph_model.hypergraph import TensorHypergraph
+from qtree.graph_model.cost_estimator import CostEstimator
 
 
 def get_treewidth_from_peo(old_graph, peo):
@@ -110,9 +116,8 @@ def get_node_min_fill_heuristic(graph, randomize=False):
     # Either choose the node at random among equivalent or use
     # the last one
     if randomize:
-        min_fill_nodes_d = dict(min_fill_nodes)
-        node = np.random.choice(min_fill_nodes_d)
-        degree = min_fill_nodes_d[node]
+        node, degree = min_fill_nodes[
+            np.random.randint(len(min_fill_nodes))]
     else:
         node, degree = min_fill_nodes[-1]
     return node, degree
@@ -185,6 +190,7 @@ def get_node_max_cardinality_heuristic(graph, randomize=False):
         degree = graph.degree(node)
         if cardinality > max_cardinality:
             max_cardinality_nodes = [(node, degree)]
+            max_cardinality = cardinality
         elif cardinality == max_cardinality:
             max_cardinality_nodes.append((node, degree))
         else:
@@ -192,9 +198,8 @@ def get_node_max_cardinality_heuristic(graph, randomize=False):
     # Either choose the node at random among equivalent or use
     # the last one
     if randomize:
-        max_cardinality_nodes_d = dict(max_cardinality_nodes)
-        node = np.random.choice(max_cardinality_nodes_d)
-        degree = max_cardinality_nodes_d[node]
+        node, degree = max_cardinality_nodes[
+            np.random.randint(len(max_cardinality_nodes))]
     else:
         node, degree = max_cardinality_nodes[-1]
 
@@ -206,7 +211,8 @@ def get_node_max_cardinality_heuristic(graph, randomize=False):
     return node, degree
 
 
-def get_upper_bound_peo_builtin(old_graph, method="min_fill"):
+def get_upper_bound_peo_builtin(old_graph, method="min_fill",
+                                randomize=False):
     """
     Calculates an upper bound on treewidth using one of the
     heuristics.
@@ -221,6 +227,8 @@ def get_upper_bound_peo_builtin(old_graph, method="min_fill"):
            graph to estimate
     method : str
            one of {"min_fill", "min_degree", "cardinality"}
+    randomize : bool, default False
+           if ties are broken at random
 
     Returns
     -------
@@ -245,12 +253,12 @@ def get_upper_bound_peo_builtin(old_graph, method="min_fill"):
     # Remove selfloops and parallel edges. Critical
     graph = get_simple_graph(graph)
 
-    node, max_degree = node_heuristic_fn(graph)
+    node, max_degree = node_heuristic_fn(graph, randomize=randomize)
     peo = [node]
     eliminate_node(graph, node, self_loops=False)
 
     for ii in range(graph.number_of_nodes()):
-        node, degree = node_heuristic_fn(graph)
+        node, degree = node_heuristic_fn(graph, randomize=randomize)
         peo.append(node)
         max_degree = max(max_degree, degree)
         eliminate_node(graph, node, self_loops=False)
@@ -260,6 +268,418 @@ def get_upper_bound_peo_builtin(old_graph, method="min_fill"):
     return peo, max_degree  # this is clique size - 1
 
 
+class _BucketQueue(object):
+    """
+    Priority queue of nodes with integer scores. Nodes with equal
+    scores are kept in a list, so updates, removals and random
+    choices among the best nodes take O(1)
+
+    Parameters
+    ----------
+    scores : dict
+           initial scores of the nodes {node: score}
+    random_state : numpy.random.RandomState, default None
+           if given, ties are broken at random. Otherwise the
+           last node inserted with the minimal score is taken
+    """
+    def __init__(self, scores, random_state=None):
+        self._buckets = {}
+        self._scores = {}
+        self._index = {}
+        self._min_score = None
+        self._random = random_state
+        for node, score in scores.items():
+            self.push(node, score)
+
+    def push(self, node, score):
+        bucket = self._buckets.setdefault(score, [])
+        self._index[node] = len(bucket)
+        bucket.append(node)
+        self._scores[node] = score
+        if self._min_score is None or score < self._min_score:
+            self._min_score = score
+
+    def remove(self, node):
+        score = self._scores.pop(node)
+        bucket = self._buckets[score]
+        idx = self._index.pop(node)
+        last = bucket.pop()
+        if last != node:
+            bucket[idx] = last
+            self._index[last] = idx
+        if len(bucket) == 0:
+            del self._buckets[score]
+            if score == self._min_score:
+                self._min_score = (min(self._buckets)
+                                   if len(self._buckets) > 0 else None)
+
+    def update(self, node, score):
+        if self._scores[node] != score:
+            self.remove(node)
+            self.push(node, score)
+
+    def score(self, node):
+        return self._scores[node]
+
+    def pop(self):
+        """
+        Removes and returns a node with the minimal score
+        """
+        score = self._min_score
+        bucket = self._buckets[score]
+        if self._random is None:
+            node = bucket[-1]
+        else:
+            node = bucket[self._random.randint(len(bucket))]
+        self.remove(node)
+        return node, score
+
+    def __len__(self):
+        return len(self._scores)
+
+
+def _get_simple_adjacency(graph):
+    """
+    Adjacency sets of a networkx graph or a TensorHypergraph,
+    without selfloops. Nodes are sorted, so the result does not
+    depend on the insertion order
+    """
+    if isinstance(graph, TensorHypergraph):
+        return {node: set(graph.neighbors(node)) for node in graph.nodes}
+    return {int(node): set(map(int, graph[node])) - {int(node)}
+            for node in sorted(graph.nodes, key=int)}
+
+
+def _get_fill(adjacency, node):
+    """
+    Number of edges missing in the neighborhood of the node
+    """
+    neighbors = adjacency[node]
+    # the difference contains the neighbor itself
+    n_missing = sum(len(neighbors - adjacency[neighbor]) - 1
+                    for neighbor in neighbors)
+    return n_missing // 2
+
+
+def _get_degree(adjacency, node):
+    return len(adjacency[node])
+
+
+def get_upper_bound_peo_incremental(graph, method="min_fill",
+                                    randomize=False, seed=None):
+    """
+    Calculates an upper bound on treewidth with the min-fill or
+    min-degree heuristic. In contrast to
+    :py:meth:`get_upper_bound_peo_builtin`, scores are kept in a
+    bucketed priority queue and only the scores of the nodes
+    touched by an elimination are updated: the neighbors of the
+    eliminated node, and the common neighbors of the endpoints of
+    each fill edge. The graph is not copied.
+
+    Parameters
+    ----------
+    graph : networkx.Graph, networkx.MultiGraph or TensorHypergraph
+           graph to estimate
+    method : str, default "min_fill"
+           one of {"min_fill", "min_degree"}
+    randomize : bool, default False
+           if ties are broken at random
+    seed : int, default None
+           seed of the random number generator
+
+    Returns
+    -------
+    peo : list
+           list of nodes in perfect elimination order
+    treewidth : int
+           treewidth corresponding to peo
+    """
+    methods = {"min_fill": _get_fill,
+               "min_degree": _get_degree}
+    if method not in methods:
+        raise ValueError(f'Unknown method: {method}')
+    score_fn = methods[method]
+
+    adjacency = _get_simple_adjacency(graph)
+    random_state = np.random.RandomState(seed) if randomize else None
+    queue = _BucketQueue(
+        {node: score_fn(adjacency, node) for node in adjacency},
+        random_state)
+
+    peo = []
+    treewidth = 0
+    while len(queue) > 0:
+        node, _ = queue.pop()
+        neighbors = adjacency.pop(node)
+        peo.append(node)
+        treewidth = max(treewidth, len(neighbors))
+        for neighbor in neighbors:
+            adjacency[neighbor].discard(node)
+
+        # make a clique on the neighbors
+        for first in neighbors:
+            missing = neighbors - adjacency[first]
+            missing.discard(first)
+            for second in missing:
+                if method == "min_fill":
+                    # the new edge fills the neighborhoods
+                    # of the common neighbors
+                    common = adjacency[first] & adjacency[second]
+                    for other in common - neighbors:
+                        queue.update(other, queue.score(other) - 1)
+                adjacency[first].add(second)
+                adjacency[second].add(first)
+
+        for neighbor in neighbors:
+            queue.update(neighbor, score_fn(adjacency, neighbor))
+
+    return peo, treewidth
+
+
+def get_upper_bound_peo_greedy(graph, method="min_flops",
+                               memory_weight=1., randomize=False,
+                               seed=None):
+    """
+    Greedy ordering which eliminates the node with the cheapest
+    contraction next. The cost of a node is the one reported by
+    :py:meth:`base.get_cost_by_node`, so it accounts for the sizes
+    of the variables and the number of tensors in the bucket.
+    Only the costs of the neighbors of an eliminated node change,
+    so only they are recomputed.
+
+    Parameters
+    ----------
+    graph : networkx.Graph, networkx.MultiGraph or TensorHypergraph
+           graph to estimate. It is not modified
+    method : str, default "min_flops"
+           one of {"min_flops", "min_memory", "min_cost"}. "min_cost"
+           minimizes flops + memory_weight * memory
+    memory_weight : float, default 1.
+           weight of the memory for the "min_cost" method
+    randomize : bool, default False
+           if ties are broken at random
+    seed : int, default None
+           seed of the random number generator
+
+    Returns
+    -------
+    peo : list
+           list of nodes in perfect elimination order
+    treewidth : int
+           treewidth corresponding to peo
+    """
+    methods = {"min_flops": lambda memory, flops: flops,
+               "min_memory": lambda memory, flops: memory,
+               "min_cost": lambda memory, flops: (
+                   flops + memory_weight * memory)}
+    if method not in methods:
+        raise ValueError(f'Unknown method: {method}')
+    score_fn = methods[method]
+
+    if isinstance(graph, TensorHypergraph):
+        graph = graph.copy()
+    else:
+        graph = TensorHypergraph.from_graph(graph)
+    random_state = np.random.RandomState(seed) if randomize else None
+
+    # heap of (score, tie breaker, node), outdated entries are skipped
+    scores = {}
+    heap = []
+
+    def push(node):
+        score = score_fn(*graph.get_cost_by_node(node))
+        scores[node] = score
+        tie_breaker = (node if random_state is None
+                       else random_state.random_sample())
+        heapq.heappush(heap, (score, tie_breaker, node))
+
+    for node in graph.nodes:
+        push(node)
+
+    peo = []
+    treewidth = 0
+    while len(heap) > 0:
+        score, _, node = heapq.heappop(heap)
+        if scores.get(node) != score:
+            continue
+        del scores[node]
+        neighbors = graph.neighbors(node)
+        peo.append(node)
+        treewidth = max(treewidth, len(neighbors))
+        graph.eliminate_node(node)
+        for neighbor in neighbors:
+            push(neighbor)
+
+    return peo, treewidth
+
+
+def _run_heuristic(graph, method, randomize=False, seed=None):
+    """
+    Runs one of the incremental or greedy heuristics
+    """
+    if method in {"min_fill", "min_degree"}:
+        return get_upper_bound_peo_incremental(
+            graph, method, randomize=randomize, seed=seed)
+    return get_upper_bound_peo_greedy(
+        graph, method, randomize=randomize, seed=seed)
+
+
+def get_cost_from_peo(graph, peo):
+    """
+    Estimates the cost of the bucket elimination in the order
+    given by peo, as :py:meth:`base.get_contraction_costs` does
+    for the order of the node labels
+
+    Parameters
+    ----------
+    graph : networkx.Graph, networkx.MultiGraph, TensorHypergraph
+            or cost_estimator.CostEstimator
+           graph of the network. It is not modified
+    peo : list
+           nodes in the elimination order
+
+    Returns
+    -------
+    memory : list
+           Memory cost for steps of the bucket elimination algorithm
+    flops : list
+           Flop cost for steps of the bucket elimination algorithm
+    """
+    if not isinstance(graph, CostEstimator):
+        graph = CostEstimator(graph)
+    memory, flops = graph.get_costs(peo)
+    return memory.tolist(), flops.tolist()
+
+
+# graph of the worker processes of the multi-start ordering
+_worker_graph = None
+_worker_estimator = None
+
+
+def _init_ordering_worker(graph):
+    global _worker_graph, _worker_estimator
+    _worker_graph = graph
+    _worker_estimator = None if graph is None else CostEstimator(graph)
+
+
+def _run_ordering(task):
+    """
+    Runs a single ordering and evaluates its cost
+    """
+    method, randomize, seed = task
+    peo, treewidth = _run_heuristic(
+        _worker_graph, method, randomize=randomize, seed=seed)
+    memory, flops = get_cost_from_peo(_worker_estimator, peo)
+    return peo, treewidth, sum(flops), max(memory, default=0)
+
+
+def _get_ordering_key(result):
+    _, treewidth, flops, memory = result
+    return flops, memory, treewidth
+
+
+def get_upper_bound_peo_multistart(graph, method="min_fill", n_starts=16,
+                                   time_budget=None, n_processes=None,
+                                   seed=0, start_method=None):
+    """
+    Runs a heuristic several times with different tie-breaking
+    and returns the order with the lowest contraction cost. The
+    first run is deterministic, so the result is never worse than
+    a single run of the heuristic. Orderings are
+    compared by the total number of flops, then by the peak
+    memory of a step, then by treewidth.
+
+    Parameters
+    ----------
+    graph : networkx.Graph, networkx.MultiGraph or TensorHypergraph
+           graph to estimate
+    method : str, default "min_fill"
+           one of {"min_fill", "min_degree"}, see
+           :py:meth:`get_upper_bound_peo_incremental`, or
+           {"min_flops", "min_memory", "min_cost"}, see
+           :py:meth:`get_upper_bound_peo_greedy`
+    n_starts : int, default 16
+           maximal number of runs. If None, runs continue until
+           the time budget is exhausted
+    time_budget : float, default None
+           time in seconds after which no new runs are started
+           and pending ones are discarded. At least one run
+           is always finished
+    n_processes : int, default None
+           number of worker processes. Defaults to the number of
+           CPUs. With 1, the runs are done in this process
+    seed : int, default 0
+           seed of the randomized runs
+    start_method : str, optional
+           start method of the processes, see
+           :py:meth:`multiprocessing.get_context`
+
+    Returns
+    -------
+    peo : list
+           list of nodes in perfect elimination order
+    treewidth : int
+           treewidth corresponding to peo
+    """
+    if n_starts is None and time_budget is None:
+        raise ValueError('Either n_starts or time_budget is required')
+    if n_processes is None:
+        n_processes = multiprocessing.cpu_count()
+    if not isinstance(graph, TensorHypergraph):
+        graph = TensorHypergraph.from_graph(graph)
+
+    indices = itertools.count() if n_starts is None else range(n_starts)
+    tasks = ((method, idx > 0, seed + idx) for idx in indices)
+    start_time = time.time()
+
+    def time_left():
+        if time_budget is None:
+            return None
+        return max(0., time_budget - (time.time() - start_time))
+
+    best = None
+    n_runs = 0
+    if n_processes == 1:
+        _init_ordering_worker(graph)
+        for task in tasks:
+            if best is not None and time_left() == 0:
+                break
+            result = _run_ordering(task)
+            n_runs += 1
+            if best is None or _get_ordering_key(result) \
+                    < _get_ordering_key(best):
+                best = result
+        _init_ordering_worker(None)
+    else:
+        context = multiprocessing.get_context(start_method)
+        with context.Pool(n_processes, initializer=_init_ordering_worker,
+                          initargs=(graph,)) as pool:
+            pending = collections.deque()
+            for task in itertools.islice(tasks, 2 * n_processes):
+                pending.append(pool.apply_async(_run_ordering, (task,)))
+            while len(pending) > 0:
+                try:
+                    result = pending[0].get(
+                        None if best is None else time_left())
+                except multiprocessing.TimeoutError:
+                    break
+                pending.popleft()
+                n_runs += 1
+                if best is None or _get_ordering_key(result) \
+                        < _get_ordering_key(best):
+                    best = result
+                if time_left() == 0:
+                    break
+                for task in itertools.islice(tasks, 1):
+                    pending.append(pool.apply_async(_run_ordering, (task,)))
+            # the pool is terminated on exit, dropping pending runs
+
+    peo, treewidth, flops, memory = best
+    log.info(f'Best of {n_runs} orderings: {flops:e} flops,'
+             f' treewidth {treewidth}')
+    return peo, treewidth
+
+
 def get_upper_bound_peo_pace2017_interactive(
         old_graph, method="tamaki", max_time=60, max_width=None, print_stats=False):
     """
@@ -505,18 +925,26 @@ def get_upper_bound_peo(graph, method='tamaki', **kwargs):
     Run one of the heuristics to get PEO and treewidth
     Parameters:
     -----------
-    graph: networkx.Graph
-           graph to calculate PEO
+    graph: networkx.Graph or TensorHypergraph
+           graph to calculate PEO. Only the "min_fill", "min_degree",
+           "min_flops", "min_memory" and "min_cost" methods accept
+           a TensorHypergraph
     method: str, default 'tamaki'
            solver to use
     **kwargs: default {}
            optional keyword arguments to pass to the solver
     """
-    builtin_heuristics = {"min_fill", "min_degree", "cardinality"}
+    incremental_heuristics = {"min_fill", "min_degree"}
+    greedy_heuristics = {"min_flops", "min_memory", "min_cost"}
+    builtin_heuristics = {"cardinality"}
     pace_heuristics = {"tamaki"}
 
     if method in pace_heuristics:
         peo, tw = get_upper_bound_peo_pace2017(graph, method, **kwargs)
+    elif method in incremental_heuristics:
+        peo, tw = get_upper_bound_peo_incremental(graph, method, **kwargs)
+    elif method in greedy_heuristics:
+        peo, tw = get_upper_bound_peo_greedy(graph, method, **kwargs)
     elif method in builtin_heuristics:
         peo, tw = get_upper_bound_peo_builtin(graph, method)
     elif method == "quickbb":
@@ -524,9 +952,13 @@ def get_upper_bound_peo(graph, method='tamaki', **kwargs):
     else:
         raise ValueError(f'Unknown method: {method}')
 
-    peo_vars = [Var(var, size=graph.nodes[var]['size'],
-                    name=graph.nodes[var]['name'])
-                for var in peo]
+    if isinstance(graph, TensorHypergraph):
+        peo_vars = [Var(var, size=graph.size(var), name=graph.name(var))
+                    for var in peo]
+    else:
+        peo_vars = [Var(var, size=graph.nodes[var]['size'],
+                        name=graph.nodes[var]['name'])
+                    for var in peo]
 
     return peo_vars, tw
 
@@ -625,6 +1057,144 @@ def test_method(method=get_upper_bound_peo_builtin):
     print(f'      peo: {peo1}\nreference: {peo2}')
 
 
+def test_upper_bound_peo_incremental():
+    """
+    Checks that the incremental heuristics choose a node
+    with the minimal score at every step
+    """
+    from qtree.graph_model.base import wrap_general_graph_for_qtree
+    from qtree.graph_model.generators import generate_erdos_graph
+    from qtree.graph_model.importers import buckets2graph
+    import qtree.operators as ops
+    import qtree.optimizer as opt
+
+    def check_peo(graph, peo, treewidth, score_fn):
+        adjacency = _get_simple_adjacency(graph)
+        assert sorted(peo) == sorted(adjacency)
+        max_degree = 0
+        for node in peo:
+            best = min(score_fn(adjacency, other) for other in adjacency)
+            assert score_fn(adjacency, node) == best
+            neighbors = adjacency.pop(node)
+            max_degree = max(max_degree, len(neighbors))
+            for neighbor in neighbors:
+                adjacency[neighbor] |= neighbors
+                adjacency[neighbor] -= {neighbor, node}
+        assert treewidth == max_degree
+
+    n_qubits = 6
+    circuit = ops.get_random_circuit(n_qubits, 10)
+    buckets, _, bra_vars, ket_vars = opt.circ2buckets(n_qubits, circuit)
+    graphs = [wrap_general_graph_for_qtree(generate_erdos_graph(40, 0.2)),
+              buckets2graph(buckets, ignore_variables=bra_vars+ket_vars),
+              TensorHypergraph.from_buckets(
+                  buckets, ignore_variables=bra_vars+ket_vars)]
+
+    for graph in graphs:
+        for method, score_fn in (("min_fill", _get_fill),
+                                 ("min_degree", _get_degree)):
+            for randomize in (False, True):
+                peo, treewidth = get_upper_bound_peo_incremental(
+                    graph, method, randomize=randomize, seed=0)
+                check_peo(graph, peo, treewidth, score_fn)
+                if not isinstance(graph, TensorHypergraph):
+                    assert treewidth == get_treewidth_from_peo(graph, peo)
+
+    peo_vars, treewidth = get_upper_bound_peo(graphs[2], method='min_fill')
+    peo, _ = get_upper_bound_peo_incremental(graphs[1])
+    assert [int(var) for var in peo_vars] == peo
+    assert peo_vars[0].name == graphs[1].nodes[peo[0]]['name']
+
+
+def test_upper_bound_peo_multistart():
+    """
+    Checks that the multi-start ordering is not worse than
+    a single deterministic run
+    """
+    from qtree.graph_model.base import get_contraction_costs
+    from qtree.graph_model.importers import buckets2graph
+    import qtree.operators as ops
+    import qtree.optimizer as opt
+
+    n_qubits = 6
+    circuit = ops.get_random_circuit(n_qubits, 12)
+    buckets, _, bra_vars, ket_vars = opt.circ2buckets(n_qubits, circuit)
+    graph = buckets2graph(buckets, ignore_variables=bra_vars+ket_vars)
+    peo, treewidth = get_upper_bound_peo_incremental(graph)
+    _, flops = get_cost_from_peo(graph, peo)
+
+    # the cost estimate agrees with the one of the graph model
+    relabeled, _ = relabel_graph_nodes(
+        graph, {node: num for num, node in enumerate(peo)})
+    assert get_contraction_costs(relabeled)[1] == tuple(flops)
+
+    serial_peo, serial_treewidth = get_upper_bound_peo_multistart(
+        graph, n_starts=8, n_processes=1)
+    assert sorted(serial_peo) == sorted(graph.nodes)
+    assert sum(get_cost_from_peo(graph, serial_peo)[1]) <= sum(flops)
+    assert serial_treewidth == get_treewidth_from_peo(graph, serial_peo)
+
+    parallel_peo, _ = get_upper_bound_peo_multistart(
+        graph, n_starts=8, n_processes=2)
+    assert sum(get_cost_from_peo(graph, parallel_peo)[1]) \
+        == sum(get_cost_from_peo(graph, serial_peo)[1])
+
+    # with a time budget at least one ordering is produced
+    budget_peo, _ = get_upper_bound_peo_multistart(
+        graph, n_starts=None, time_budget=0.5, n_processes=2)
+    assert sorted(budget_peo) == sorted(graph.nodes)
+
+    # randomized builtin heuristics work
+    for method in ("min_fill", "min_degree", "cardinality"):
+        peo, _ = get_upper_bound_peo_builtin(graph, method, randomize=True)
+        assert sorted(peo) == sorted(graph.nodes)
+
+
+def test_upper_bound_peo_greedy():
+    """
+    Checks that the greedy orderings choose the cheapest node
+    at every step
+    """
+    from qtree.graph_model.importers import buckets2graph
+    import qtree.operators as ops
+    import qtree.optimizer as opt
+
+    n_qubits = 6
+    circuit = ops.get_random_circuit(n_qubits, 12)
+    buckets, _, bra_vars, ket_vars = opt.circ2buckets(n_qubits, circuit)
+    graph = buckets2graph(buckets, ignore_variables=bra_vars+ket_vars)
+    # variables of different sizes change the costs
+    for node in list(graph.nodes)[::3]:
+        graph.nodes[node]['size'] = 3
+
+    for method, score_fn in (
+            ("min_flops", lambda memory, flops: flops),
+            ("min_memory", lambda memory, flops: memory),
+            ("min_cost", lambda memory, flops: flops + 0.5 * memory)):
+        kwargs = {'memory_weight': 0.5} if method == "min_cost" else {}
+        peo, treewidth = get_upper_bound_peo_greedy(graph, method,
+                                                    **kwargs)
+        assert sorted(peo) == sorted(graph.nodes)
+        assert treewidth == get_treewidth_from_peo(graph, peo)
+
+        hypergraph = TensorHypergraph.from_graph(graph)
+        for node in peo:
+            best = min(score_fn(*hypergraph.get_cost_by_node(other))
+                       for other in hypergraph.nodes)
+            assert score_fn(*hypergraph.get_cost_by_node(node)) == best
+            hypergraph.eliminate_node(node)
+
+    peo, _ = get_upper_bound_peo_greedy(graph, randomize=True, seed=1)
+    assert sorted(peo) == sorted(graph.nodes)
+    peo_vars, _ = get_upper_bound_peo(graph, method="min_memory")
+    assert [int(var) for var in peo_vars] == get_upper_bound_peo_greedy(
+        graph, "min_memory")[0]
+    peo, _ = get_upper_bound_peo_multistart(
+        graph, method="min_flops", n_starts=4, n_processes=1)
+    assert sum(get_cost_from_peo(graph, peo)[1]) <= sum(
+        get_cost_from_peo(graph, get_upper_bound_peo_greedy(graph)[0])[1])
+
+
 def test_get_treewidth_from_peo():
     from qtree.graph_model.generators import generate_erdos_graph
     graph = generate_erdos_graph(50, 0.5)
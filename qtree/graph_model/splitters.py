@@ -13,8 +13,10 @@ from qtree.optimizer import Var
 from qtree.logger_setup import log
 from qtree.graph_model.base import (remove_node,
                                     get_contraction_costs,
+                                    get_live_memory,
                                     relabel_graph_nodes,
                                     get_simple_graph)
+from qtree.graph_model.cost_estimator import CostEstimator
 from qtree.graph_model.peo_calculation import (get_peo,
                                                get_upper_bound_peo,
                                                get_treewidth_from_peo)
@@ -117,17 +119,15 @@ def get_node_by_mem_reduction(old_graph):
     nodes_by_mem_reduction : dict
     """
 
-    graph = copy.deepcopy(old_graph)
+    estimator = CostEstimator(old_graph)
 
     # Get flop cost of the bucket elimination
-    initial_mem, initial_flop = get_contraction_costs(graph)
+    initial_mem, initial_flop = estimator.get_costs()
 
     nodes_by_mem_reduction = []
-    for node in graph.nodes(data=False):
-        reduced_graph = copy.deepcopy(graph)
+    for node in old_graph.nodes(data=False):
         # Take out one node
-        remove_node(reduced_graph, node)
-        mem, flop = get_contraction_costs(reduced_graph)
+        mem, flop = estimator.get_costs(removed_vars=[node])
         delta = sum(initial_mem) - sum(mem)
 
         nodes_by_mem_reduction.append((node, delta))
@@ -238,6 +238,16 @@ def split_graph_by_metric(
     return idx_parallel_var, graph
 
 
+def get_peak_memory(graph):
+    """
+    Peak number of elements in live intermediates of the contraction
+    of the graph in the order of its nodes.
+    See :py:meth:`base.get_live_memory`
+    """
+    memory = get_live_memory(graph)
+    return max(memory) if memory else 0
+
+
 def split_graph_with_mem_constraint_greedy(
         old_graph,
         n_var_parallel_min=0,
@@ -246,7 +256,8 @@ def split_graph_with_mem_constraint_greedy(
         n_var_parallel_max=None,
         metric_fn=get_node_by_mem_reduction,
         forbidden_nodes=(),
-        peo_function=get_peo):
+        peo_function=get_peo,
+        mem_fn=get_peak_memory):
     """
     This function splits graph by greedily selecting next nodes
     up to the n_var_parallel
@@ -274,6 +285,12 @@ def split_graph_with_mem_constraint_greedy(
     peo_function: function
            function to calculate PEO. Should have signature
            lambda (graph): return peo, treewidth
+    mem_fn: function, default :py:meth:`get_peak_memory`
+           function to calculate the memory of the task in
+           elements. Should have signature lambda (graph): return
+           memory. The default constrains the peak of live
+           intermediates, which the memory tracker of
+           :py:meth:`optimizer.bucket_elimination` measures
     Returns
     -------
     idx_parallel : list
@@ -289,8 +306,7 @@ def split_graph_with_mem_constraint_greedy(
     if n_var_parallel_max is None:
         n_var_parallel_max = n_var_total
 
-    mem_cost, flop_cost = get_contraction_costs(graph)
-    max_mem = sum(mem_cost)
+    max_mem = mem_fn(graph)
 
     idx_parallel = []
     idx_parallel_var = []
@@ -344,9 +360,7 @@ def split_graph_with_mem_constraint_greedy(
                               range(len(graph.nodes()))))
 
         graph_relabelled, _ = relabel_graph_nodes(graph, label_dict)
-        mem_cost, flop_cost = get_contraction_costs(graph_relabelled)
-
-        max_mem = sum(mem_cost)
+        max_mem = mem_fn(graph_relabelled)
 
         if (max_mem <= mem_constraint
            and len(idx_parallel) >= n_var_parallel_min):
@@ -599,3 +613,36 @@ def split_graph_by_tree_trimming_width(
     graph.remove_nodes_from(eliminated_nodes)
 
     return eliminated_nodes, graph
+
+
+def test_split_graph_with_peak_memory():
+    """
+    Splits a graph with the constraint on the peak of live memory
+    """
+    import functools
+    import qtree.operators as ops
+    from qtree.graph_model.importers import circ2graph
+
+    n_qubits = 8
+    circuit = ops.get_random_circuit(n_qubits, 10)
+    graph, *_ = circ2graph(n_qubits, circuit)
+    peo_function = functools.partial(get_upper_bound_peo,
+                                     method='min_fill')
+    peo, _ = peo_function(graph)
+    graph, _ = relabel_graph_nodes(
+        graph, dict(zip(peo, range(len(peo)))))
+
+    peak = get_peak_memory(graph)
+    mem_cost, _ = get_contraction_costs(graph)
+    assert max(mem_cost) <= sum(mem_cost)
+    assert 0 < peak <= sum(mem_cost)
+
+    mem_constraint = peak // 4
+    idx_parallel, reduced_graph = split_graph_with_mem_constraint_greedy(
+        graph, mem_constraint=mem_constraint, step_by=1,
+        peo_function=peo_function)
+    assert len(idx_parallel) > 0
+    peo, _ = peo_function(reduced_graph)
+    reduced_graph, _ = relabel_graph_nodes(
+        reduced_graph, dict(zip(peo, range(len(peo)))))
+    assert get_peak_memory(reduced_graph) <= mem_constraint
@@ -4,11 +4,31 @@ simulator. It's main use is in conjunction with the :py:mod:`optimizer`
 module, and example programs are listed in :py:mod:`simulator` module.
 """
 
+import os
+import tempfile
 import numpy as np
 import copy
+import itertools
+import functools
 import qtree.operators as ops
 import qtree.optimizer as opt
 import qtree.utils as utils
+import qtree.tensor_cache as tc
+import qtree.contraction_path as cp
+
+# Maximal number of dimensions of a numpy array
+_NP_MAXDIMS = 64 if int(np.__version__.split('.')[0]) >= 2 else 32
+
+# Maximal number of distinct indices supported by numpy.einsum.
+# Labels are limited to [a-zA-Z] and einsum can not iterate over
+# more than MAXDIMS dimensions
+MAX_EINSUM_INDICES = min(52, _NP_MAXDIMS)
+
+# Results of buckets larger than this (in bytes) are stored on disk
+# by process_bucket_np_ooc
+SPILL_THRESHOLD = 2**30
+# Prefix of the names of files holding spilled tensors
+SPILL_PREFIX = 'qtree_spill_'
 
 
 def get_np_buckets(buckets, data_dict):
@@ -120,8 +140,6 @@ def get_sliced_np_buckets(buckets, data_dict, slice_dict):
             # get data
             # sort tensor dimensions
             transpose_order = np.argsort(list(map(int, tensor.indices)))
-            data = np.transpose(data_dict[tensor.data_key],
-                                transpose_order)
             # transpose indices
             indices_sorted = [tensor.indices[pp]
                               for pp in transpose_order]
@@ -134,7 +152,9 @@ def get_sliced_np_buckets(buckets, data_dict, slice_dict):
                 except KeyError:
                     slice_bounds.append(slice(None))
 
-            data = data[tuple(slice_bounds)]
+            data = tc.get_tensor_variant(
+                tensor.data_key, data_dict[tensor.data_key],
+                transpose_order, slice_bounds)
 
             # update indices
             indices_sliced = [idx.copy(size=size) for idx, size in
@@ -149,6 +169,187 @@ def get_sliced_np_buckets(buckets, data_dict, slice_dict):
     return sliced_buckets
 
 
+def broadcast_data(data, indices, target_indices):
+    """
+    Transposes and reshapes data so it broadcasts against an array
+    with target_indices. Indices have to be a subset of the target
+    """
+    positions = {int(idx): pos for pos, idx in enumerate(indices)}
+    order = [positions[int(idx)] for idx in target_indices
+             if int(idx) in positions]
+    shape = [data.shape[positions[int(idx)]] if int(idx) in positions
+             else 1 for idx in target_indices]
+    return np.transpose(data, order).reshape(shape)
+
+
+def apply_diagonal_factors(bucket):
+    """
+    Multiplies diagonal tensors on the same (or nested) indices
+    together and applies them to the smallest dense tensor of
+    the bucket which holds all their indices, by elementwise
+    multiplication with broadcasting. Diagonal factors
+    which do not fit in any dense tensor are left in the bucket.
+
+    Parameters
+    ----------
+    bucket : list
+           List of tensors with data
+
+    Returns
+    -------
+    bucket : list
+           New list of tensors. Input tensors are not modified
+    """
+    diagonal = [tensor for tensor in bucket if tensor.kind == 'diagonal']
+    if len(diagonal) == 0:
+        return bucket
+    dense = [tensor for tensor in bucket if tensor.kind != 'diagonal']
+
+    # premultiply diagonal factors, larger ones absorb smaller ones
+    merged = []
+    for tensor in sorted(diagonal, key=lambda t: -len(t.indices)):
+        indices = set(map(int, tensor.indices))
+        for pos, other in enumerate(merged):
+            if indices <= set(map(int, other.indices)):
+                merged[pos] = other.copy(data=other.data * broadcast_data(
+                    tensor.data, tensor.indices, other.indices))
+                break
+        else:
+            merged.append(tensor)
+
+    for tensor in merged:
+        indices = set(map(int, tensor.indices))
+        candidates = [pos for pos, other in enumerate(dense)
+                      if indices <= set(map(int, other.indices))]
+        if candidates:
+            pos = min(candidates, key=lambda pos: dense[pos].data.size)
+            other = dense[pos]
+            dense[pos] = other.copy(data=other.data * broadcast_data(
+                tensor.data, tensor.indices, other.indices))
+        else:
+            dense.append(tensor)
+    return dense
+
+
+def _reindex_data(data, indices, var, selector, selector_indices):
+    """
+    Substitutes var in the tensor by the array of its values
+    ``selector`` defined over selector_indices. Returns the new data
+    and its indices (integers): the indices of the tensor without
+    var and the selector indices, sorted
+    """
+    indices = [int(idx) for idx in indices]
+    selector_ints = [int(idx) for idx in selector_indices]
+    out = [idx for idx in indices
+           if idx != int(var) and idx not in selector_ints]
+    out_ints = out + selector_ints
+    n_out = len(out_ints)
+
+    def arange_at(pos, size):
+        shape = [1] * n_out
+        shape[pos] = size
+        return np.arange(size).reshape(shape)
+
+    index = []
+    for axis, idx in enumerate(indices):
+        if idx == int(var):
+            index.append(selector.reshape(
+                [1] * len(out) + list(selector.shape)))
+        else:
+            index.append(arange_at(out_ints.index(idx),
+                                   data.shape[axis]))
+    # keep the indices sorted as the other tensors of the buckets
+    data = data[tuple(index)]
+    order = sorted(range(n_out), key=lambda pos: out_ints[pos])
+    return data.transpose(order), [out_ints[pos] for pos in order]
+
+
+def substitute_permutation(bucket):
+    """
+    Eliminates the variable of the bucket without summation if the
+    bucket holds a permutation tensor P in which the variable v is
+    determined by the other indices w, i.e. P(v, w) is nonzero only
+    for v = f(w). Then
+
+        sum_v P(v, w) T_1(v, ...) ... T_n(v, ...) =
+            P(f(w), w) T_1(f(w), ...) ... T_n(f(w), ...)
+
+    and every tensor is reindexed with fancy indexing.
+
+    Parameters
+    ----------
+    bucket : list
+           List of tensors with data
+
+    Returns
+    -------
+    bucket : list
+           tensors without the variable of the bucket, which have
+           to be multiplied without summation, or the
+           original bucket if no permutation tensor applies
+    eliminated : bool
+           True if the variable was eliminated
+    """
+    all_indices = sorted(set(itertools.chain.from_iterable(
+        tensor.indices for tensor in bucket)), key=int)
+    if len(all_indices) == 0:
+        return bucket, False
+    var = all_indices[0]
+
+    for num, tensor in enumerate(bucket):
+        if tensor.kind != 'permutation':
+            continue
+        positions = [int(idx) for idx in tensor.indices]
+        if int(var) not in positions:
+            continue
+        axis = positions.index(int(var))
+        nonzero = (tensor.data != 0)
+        if not np.all(nonzero.sum(axis=axis) == 1):
+            continue
+
+        # var is a function of the other indices of the tensor
+        selector = np.argmax(nonzero, axis=axis)
+        values = np.take_along_axis(
+            tensor.data, np.expand_dims(selector, axis), axis=axis
+        ).squeeze(axis)
+        selector_indices = tuple(idx for idx in tensor.indices
+                                 if int(idx) != int(var))
+
+        new_bucket = []
+        for other in bucket[:num] + bucket[num+1:]:
+            if int(var) not in map(int, other.indices):
+                new_bucket.append(other)
+                continue
+            data, out_ints = _reindex_data(other.data, other.indices,
+                                           var, selector,
+                                           selector_indices)
+            lookup = {int(idx): idx for idx in
+                      other.indices + selector_indices}
+            new_bucket.append(other.copy(
+                indices=tuple(lookup[idx] for idx in out_ints),
+                data=data, kind='dense'))
+        if len(new_bucket) == 0 or not np.all(values == 1):
+            new_bucket.append(opt.Tensor(
+                tensor.name, selector_indices, data=values,
+                kind='diagonal'))
+        return new_bucket, True
+
+    return bucket, False
+
+
+def _detach(data, bucket):
+    """
+    Copies the result of a bucket if it is a view of the input data,
+    which may be read-only gate tensors shared through
+    :py:mod:`tensor_cache`
+    """
+    if any(isinstance(tensor.data, np.ndarray)
+           and np.may_share_memory(data, tensor.data)
+           for tensor in bucket):
+        return np.array(data)
+    return data
+
+
 def process_bucket_np(bucket, no_sum=False):
     """
     Process bucket in the bucket elimination algorithm.
@@ -169,39 +370,22 @@ def process_bucket_np(bucket, no_sum=False):
     tensor : optimizer.Tensor
            wrapper tensor object holding the result
     """
+    if not no_sum:
+        bucket, no_sum = substitute_permutation(bucket)
+    bucket = apply_diagonal_factors(bucket)
     result_indices = bucket[0].indices
     result_data = bucket[0].data
 
     for tensor in bucket[1:]:
-        """
         next_result_indices = tuple(sorted(
             set(result_indices + tensor.indices),
             key=int)
         )
-        ixc = list(map(int, next_result_indices))
-        idx_to_least_idx = {old_idx: new_idx for new_idx, old_idx
-                        in enumerate(ixc)}
-
-        ixa, ixb = list(map(int, result_indices)), list(map(int, tensor.indices))
-        ixa, ixb = list(map(lambda x: idx_to_least_idx[x], ixa)), list(map(lambda x: idx_to_least_idx[x], ixb))
-        print(len(ixa), len(ixb), len(ixc))
-        #print(result_data.shape, len(ixb), len(ixc))
-        ixc = list(map(lambda x: idx_to_least_idx[x], ixc))
+        result_data = einsum_sublist(
+            [(result_data, result_indices), (tensor.data, tensor.indices)],
+            next_result_indices)
 
-        result_data = np.einsum(result_data, ixa, tensor.data, ixb, ixc)
         result_indices = next_result_indices
-        """
-        expr = utils.get_einsum_expr(
-            list(map(int, result_indices)), list(map(int, tensor.indices))
-        )
-
-        result_data = np.einsum(expr, result_data, tensor.data)
-
-        # Merge and sort indices and shapes
-        result_indices = tuple(sorted(
-            set(result_indices + tensor.indices),
-            key=int)
-        )
 
     if len(result_indices) > 0:
         if not no_sum:  # trim first index
@@ -216,8 +400,994 @@ def process_bucket_np(bucket, no_sum=False):
     # reduce
     if no_sum:
         result = opt.Tensor(f'E{tag}', result_indices,
-                            data=result_data)
+                            data=_detach(result_data, bucket))
     else:
         result = opt.Tensor(f'E{tag}', result_indices,
                             data=np.sum(result_data, axis=0))
     return result
+
+
+def einsum_sublist(operands, output_indices):
+    """
+    Evaluates einsum over operands given as pairs (data, indices)
+    using integer subscripts. Indices are remapped to the smallest
+    integers, as einsum does not like large numbers. If the
+    expression has more than :py:data:`MAX_EINSUM_INDICES` distinct
+    indices, which :py:meth:`numpy.einsum` does not support,
+    operands are contracted pairwise with matrix multiplications.
+
+    Parameters
+    ----------
+    operands : list
+           pairs (data, indices). Indices can be
+           :py:class:`optimizer.Var` objects or integers
+    output_indices : list
+           indices of the result
+
+    Returns
+    -------
+    result : numpy.array
+    """
+    idx_to_least_idx = {}
+    args = []
+    for data, indices in operands:
+        subscripts = []
+        for idx in indices:
+            subscripts.append(idx_to_least_idx.setdefault(
+                int(idx), len(idx_to_least_idx)))
+        args.append(data)
+        args.append(subscripts)
+
+    if len(idx_to_least_idx) > MAX_EINSUM_INDICES:
+        return _contract_wide(operands, output_indices)
+
+    args.append([idx_to_least_idx[int(idx)] for idx in output_indices])
+    return np.einsum(*args)
+
+
+def _contract_wide(operands, output_indices):
+    """
+    Contracts operands given as pairs (data, indices) left to right
+    with :py:meth:`numpy.matmul`. There is no limit on the number
+    of distinct indices.
+    """
+    output_ints = set(map(int, output_indices))
+    data, indices = operands[0]
+    indices = tuple(indices)
+    for n, (other, other_indices) in enumerate(operands[1:], 2):
+        keep = set(output_ints)
+        for _, rest_indices in operands[n:]:
+            keep.update(map(int, rest_indices))
+        data, indices = _gemm_pair(data, indices,
+                                   other, tuple(other_indices), keep)
+
+    data, indices = _sum_private_axes(data, indices, (), output_ints)
+    positions = {int(idx): pos for pos, idx in enumerate(indices)}
+    return data.transpose([positions[int(idx)] for idx in output_indices])
+
+
+def process_bucket_np_path(bucket, no_sum=False, method='auto'):
+    """
+    Process bucket in the bucket elimination algorithm.
+    Same as :py:meth:`process_bucket_np`, but the tensors are
+    contracted pairwise in the order found by
+    :py:meth:`contraction_path.get_contraction_path` and the
+    variable of the bucket is summed over in the last
+    pairwise contraction.
+
+    Parameters
+    ----------
+    bucket : list
+           List containing tuples of tensors (gates) with their indices.
+
+    no_sum : bool
+           If no summation should be done over the buckets's variable
+    method : str, default 'auto'
+           method to find the contraction path
+
+    Returns
+    -------
+    tensor : optimizer.Tensor
+           wrapper tensor object holding the result
+    """
+    if not no_sum:
+        bucket, no_sum = substitute_permutation(bucket)
+    bucket = apply_diagonal_factors(bucket)
+    indices_list = [tensor.indices for tensor in bucket]
+    all_indices = tuple(sorted(
+        set(itertools.chain.from_iterable(indices_list)), key=int))
+    output = all_indices if no_sum else all_indices[1:]
+
+    path = cp.get_contraction_path(indices_list, output, method=method)
+
+    operands = [(tensor.data, tensor.indices) for tensor in bucket]
+    for i, j, result_indices in cp.get_path_steps(
+            indices_list, output, path):
+        result_data = einsum_sublist(
+            [operands[i], operands[j]], result_indices)
+        operands.pop(j)
+        operands.pop(i)
+        operands.append((result_data, result_indices))
+
+    result_data, result_indices = operands[0]
+    if tuple(result_indices) != output:
+        result_data = einsum_sublist(operands, output)
+
+    if len(all_indices) > 0:
+        tag = all_indices[0].identity
+    else:
+        tag = 'f'
+
+    return opt.Tensor(f'E{tag}', output,
+                      data=_detach(result_data, bucket))
+
+
+class FactorizedTensor(object):
+    """
+    Product of tensors over disjoint sets of indices, kept
+    unexpanded. The dense tensor over all indices is built only
+    by :py:meth:`expand` (or by accessing ``data``), and single
+    entries can be taken with :py:meth:`get_entries` without
+    expanding.
+
+    Parameters
+    ----------
+    factors : list of optimizer.Tensor
+           factors with disjoint indices
+    """
+    def __init__(self, factors):
+        self.factors = list(factors)
+
+    @property
+    def indices(self):
+        return tuple(sorted(
+            itertools.chain.from_iterable(
+                factor.indices for factor in self.factors), key=int))
+
+    @property
+    def nbytes(self):
+        """
+        Memory of the factors
+        """
+        return sum(np.asarray(factor.data).nbytes
+                   for factor in self.factors)
+
+    def expand(self):
+        """
+        Multiplies the factors into a dense tensor
+
+        Returns
+        -------
+        tensor : optimizer.Tensor
+        """
+        indices = self.indices
+        # smaller factors first, so the large outer products come last
+        factors = sorted(self.factors,
+                         key=lambda factor: np.size(factor.data))
+        data = _detach(einsum_sublist(
+            [(factor.data, factor.indices) for factor in factors],
+            indices), factors)
+        if len(indices) > 0:
+            tag = indices[0].identity
+        else:
+            tag = 'f'
+        return opt.Tensor(f'E{tag}', indices, data=data)
+
+    @property
+    def data(self):
+        return self.expand().data
+
+    def get_entries(self, values):
+        """
+        Evaluates entries of the product
+
+        Parameters
+        ----------
+        values : array-like
+               array of shape (n_entries, len(indices)) with values
+               of the indices, in the order of ``indices``
+
+        Returns
+        -------
+        entries : numpy.array
+        """
+        values = np.asarray(values)
+        position = {int(idx): pos for pos, idx in enumerate(self.indices)}
+        entries = 1
+        for factor in self.factors:
+            columns = [position[int(idx)] for idx in factor.indices]
+            entries = entries * np.asarray(factor.data)[
+                tuple(values[:, columns].T)]
+        return entries * np.ones(len(values))
+
+    def __str__(self):
+        return ' * '.join(str(factor) for factor in self.factors)
+
+    def __repr__(self):
+        return self.__str__()
+
+
+def process_final_bucket_np(bucket, factorize=False, method='auto'):
+    """
+    Multiplies the tensors left after the elimination of all
+    summed variables. Tensors are split into groups connected by
+    common indices; each group is contracted pairwise in the order
+    found by :py:meth:`contraction_path.get_contraction_path`.
+    Can be used as ``process_final_fn`` of
+    :py:meth:`optimizer.bucket_elimination`.
+
+    Parameters
+    ----------
+    bucket : list
+           tensors, possibly scalars
+    factorize : bool, default False
+           if True, the product of the groups is returned
+           as a :class:`FactorizedTensor` instead of a dense tensor
+    method : str, default 'auto'
+           method to find the contraction path
+
+    Returns
+    -------
+    tensor : optimizer.Tensor or FactorizedTensor
+    """
+    scalars = [tensor for tensor in bucket if len(tensor.indices) == 0]
+    tensors = [tensor for tensor in bucket if len(tensor.indices) > 0]
+
+    # group tensors connected by common indices
+    parent = list(range(len(tensors)))
+
+    def find(num):
+        while parent[num] != num:
+            parent[num] = parent[parent[num]]
+            num = parent[num]
+        return num
+
+    owner = {}
+    for num, tensor in enumerate(tensors):
+        for idx in tensor.indices:
+            other = owner.setdefault(int(idx), num)
+            parent[find(num)] = find(other)
+    groups = {}
+    for num, tensor in enumerate(tensors):
+        groups.setdefault(find(num), []).append(tensor)
+
+    factors = [process_bucket_np_path(group, no_sum=True, method=method)
+               for group in groups.values()]
+    if len(scalars) > 0:
+        scalar = functools.reduce(
+            lambda a, b: a * b, [tensor.data for tensor in scalars])
+        if len(factors) > 0:
+            # multiply the scalar into the smallest factor
+            smallest = min(range(len(factors)),
+                           key=lambda num: np.size(factors[num].data))
+            factors[smallest] = factors[smallest].copy(
+                data=factors[smallest].data * scalar)
+        else:
+            factors.append(scalars[0].copy(data=scalar))
+
+    result = FactorizedTensor(factors)
+    if factorize:
+        return result
+    return result.expand()
+
+
+def _get_gemm_layout(indices, groups):
+    """
+    Returns the permutation of axes which brings a tensor to the
+    layout given by the concatenation of groups, trying both orders
+    of the last two groups. The order which needs no transposition
+    is preferred.
+
+    Returns
+    -------
+    permutation : tuple or None
+           None if no transposition is needed
+    swapped : bool
+           if the last two groups were swapped
+    """
+    positions = {int(idx): pos for pos, idx in enumerate(indices)}
+    batch, first, second = groups
+    for swapped, layout in ((False, batch + first + second),
+                            (True, batch + second + first)):
+        permutation = tuple(positions[idx] for idx in layout)
+        if permutation == tuple(range(len(permutation))):
+            return None, swapped
+    return tuple(positions[idx] for idx in batch + first + second), False
+
+
+def _sum_private_axes(data, indices, other_indices, keep):
+    """
+    Sums over the axes of the tensor which are neither needed in
+    the result nor present in the other operand
+    """
+    other_ints = set(map(int, other_indices))
+    axes = tuple(pos for pos, idx in enumerate(indices)
+                 if int(idx) not in keep and int(idx) not in other_ints)
+    if not axes:
+        return data, indices
+    return (data.sum(axis=axes),
+            tuple(idx for pos, idx in enumerate(indices)
+                  if pos not in axes))
+
+
+def _gemm_pair(a, a_indices, b, b_indices, keep):
+    """
+    Contracts two tensors by transposing them to matrices
+    and calling :py:meth:`numpy.matmul` (transpose-transpose-GEMM).
+    The result is not transposed back: its indices are
+    ordered as (batch, free indices of a, free indices of b).
+
+    Parameters
+    ----------
+    a, b : numpy.array
+           operands
+    a_indices, b_indices : tuple
+           indices of the operands
+    keep : set
+           integer ids of indices to keep in the result
+
+    Returns
+    -------
+    data : numpy.array
+    indices : tuple
+    """
+    # sum over indices private to one operand first
+    a, a_indices = _sum_private_axes(a, a_indices, b_indices, keep)
+    b, b_indices = _sum_private_axes(b, b_indices, a_indices, keep)
+
+    a_ints = [int(idx) for idx in a_indices]
+    b_ints = [int(idx) for idx in b_indices]
+    b_set = set(b_ints)
+    a_set = set(a_ints)
+
+    # order of the shared indices is taken from the larger operand
+    reference = a_ints if a.size >= b.size else b_ints
+    batch = [idx for idx in reference if idx in a_set and idx in b_set
+             and idx in keep]
+    contracted = [idx for idx in reference
+                  if idx in a_set and idx in b_set and idx not in keep]
+    free_a = [idx for idx in a_ints if idx not in b_set]
+    free_b = [idx for idx in b_ints if idx not in a_set]
+
+    sizes = {int(idx): dim for idx, dim in zip(a_indices, a.shape)}
+    sizes.update({int(idx): dim for idx, dim in zip(b_indices, b.shape)})
+
+    def prod(group):
+        return int(np.prod([sizes[idx] for idx in group], dtype=np.int64))
+
+    n_batch, k = prod(batch), prod(contracted)
+    m, n = prod(free_a), prod(free_b)
+
+    permutation, swapped = _get_gemm_layout(
+        a_ints, (batch, free_a, contracted))
+    if permutation is not None:
+        a = a.transpose(permutation)
+    if swapped:
+        a = a.reshape(n_batch, k, m).swapaxes(-1, -2)
+    else:
+        a = a.reshape(n_batch, m, k)
+
+    permutation, swapped = _get_gemm_layout(
+        b_ints, (batch, contracted, free_b))
+    if permutation is not None:
+        b = b.transpose(permutation)
+    if swapped:
+        b = b.reshape(n_batch, n, k).swapaxes(-1, -2)
+    else:
+        b = b.reshape(n_batch, k, n)
+
+    result = np.matmul(a, b)
+
+    var_by_int = {int(idx): idx for idx in a_indices + b_indices}
+    result_ints = batch + free_a + free_b
+    result = result.reshape([sizes[idx] for idx in result_ints])
+    return result, tuple(var_by_int[idx] for idx in result_ints)
+
+
+def process_bucket_np_gemm(bucket, no_sum=False, method='auto'):
+    """
+    Process bucket in the bucket elimination algorithm.
+    Same as :py:meth:`process_bucket_np_path`, but each pairwise
+    contraction is done by reshaping tensors to matrices and calling
+    :py:meth:`numpy.matmul`, which uses (multithreaded) BLAS.
+    Indices of intermediate tensors are not sorted: each step
+    chooses the layout which needs the least transpositions.
+    The final result of the bucket elimination
+    (when ``no_sum`` is set) is sorted.
+
+    Parameters
+    ----------
+    bucket : list
+           List containing tuples of tensors (gates) with their indices.
+
+    no_sum : bool
+           If no summation should be done over the buckets's variable
+    method : str, default 'auto'
+           method to find the contraction path
+
+    Returns
+    -------
+    tensor : optimizer.Tensor
+           wrapper tensor object holding the result
+    """
+    if not no_sum:
+        bucket, no_sum = substitute_permutation(bucket)
+    bucket = apply_diagonal_factors(bucket)
+    indices_list = [tensor.indices for tensor in bucket]
+    all_indices = tuple(sorted(
+        set(itertools.chain.from_iterable(indices_list)), key=int))
+    output = all_indices if no_sum else all_indices[1:]
+
+    path = cp.get_contraction_path(indices_list, output, method=method)
+
+    operands = [(tensor.data, tuple(tensor.indices)) for tensor in bucket]
+    for i, j, result_indices in cp.get_path_steps(
+            indices_list, output, path):
+        (a, a_indices), (b, b_indices) = operands[i], operands[j]
+        result = _gemm_pair(a, a_indices, b, b_indices,
+                            set(map(int, result_indices)))
+        operands.pop(j)
+        operands.pop(i)
+        operands.append(result)
+
+    result_data, result_indices = operands[0]
+    output_ints = set(map(int, output))
+    axes = tuple(pos for pos, idx in enumerate(result_indices)
+                 if int(idx) not in output_ints)
+    if axes:
+        result_data = result_data.sum(axis=axes)
+        result_indices = tuple(idx for idx in result_indices
+                               if int(idx) in output_ints)
+
+    if no_sum:
+        # fix the layout of the final result
+        order = sorted(range(len(result_indices)),
+                       key=lambda pos: int(result_indices[pos]))
+        result_data = result_data.transpose(order)
+        result_indices = tuple(result_indices[pos] for pos in order)
+
+    if len(all_indices) > 0:
+        tag = all_indices[0].identity
+    else:
+        tag = 'f'
+
+    return opt.Tensor(f'E{tag}', result_indices,
+                      data=_detach(result_data, bucket))
+
+
+def spill_array(shape, dtype, scratch_dir=None):
+    """
+    Creates an array backed by a temporary file. On POSIX systems
+    the file is unlinked right away, so its space is reclaimed as
+    soon as the array is garbage collected, even if it was
+    not released explicitly.
+
+    Parameters
+    ----------
+    shape : tuple
+           shape of the array
+    dtype : numpy.dtype
+           type of the array
+    scratch_dir : str, optional
+           directory for the file. Defaults to the system
+           temporary directory
+
+    Returns
+    -------
+    data : numpy.memmap
+    """
+    fd, filename = tempfile.mkstemp(prefix=SPILL_PREFIX, suffix='.dat',
+                                    dir=scratch_dir)
+    os.close(fd)
+    data = np.memmap(filename, dtype=dtype, mode='w+', shape=shape)
+    if os.name == 'posix':
+        os.remove(filename)
+    return data
+
+
+def is_spilled(data):
+    """
+    Checks if the array was created by :py:meth:`spill_array`
+    """
+    return (isinstance(data, np.memmap)
+            and data.filename is not None
+            and os.path.basename(data.filename).startswith(SPILL_PREFIX))
+
+
+def release_spilled(data):
+    """
+    Removes the file behind a spilled array. The array should not
+    be used afterwards
+    """
+    if is_spilled(data) and os.path.exists(data.filename):
+        os.remove(data.filename)
+
+
+def process_bucket_np_ooc(bucket, no_sum=False,
+                          max_in_memory=SPILL_THRESHOLD,
+                          scratch_dir=None):
+    """
+    Process bucket in the bucket elimination algorithm.
+    Same as :py:meth:`process_bucket_np`, but results larger than
+    ``max_in_memory`` bytes are written to
+    :py:class:`numpy.memmap` files in ``scratch_dir``. Such
+    results, as well as buckets holding spilled tensors, are
+    evaluated in chunks along the leading index of the result, so
+    only a part of every tensor is in memory at once. Files of the
+    spilled tensors are removed as soon as the bucket is processed
+    and their space is reclaimed once
+    :py:meth:`optimizer.bucket_elimination` drops the bucket.
+
+    Use with :py:meth:`optimizer.bucket_elimination` as
+
+    >>> process_bucket_fn = functools.partial(
+    ...     process_bucket_np_ooc, max_in_memory=2**30,
+    ...     scratch_dir='/scratch')
+
+    If the final result is spilled it is up to the caller to
+    release it with :py:meth:`release_spilled`.
+
+    Parameters
+    ----------
+    bucket : list
+           List containing tuples of tensors (gates) with their indices.
+    no_sum : bool
+           If no summation should be done over the buckets's variable
+    max_in_memory : int, default :py:data:`SPILL_THRESHOLD`
+           largest result in bytes which is kept in memory
+    scratch_dir : str, optional
+           directory for spilled tensors
+
+    Returns
+    -------
+    tensor : optimizer.Tensor
+           wrapper tensor object holding the result
+    """
+    all_indices = tuple(sorted(
+        set(itertools.chain.from_iterable(
+            tensor.indices for tensor in bucket)), key=int))
+    output = all_indices if no_sum else all_indices[1:]
+
+    dtype = np.result_type(*[tensor.data for tensor in bucket])
+    shape = tuple(idx.size for idx in output)
+    result_bytes = int(np.prod(shape, dtype=object)) * dtype.itemsize
+    spilled = [tensor.data for tensor in bucket
+               if is_spilled(tensor.data)]
+
+    if result_bytes <= max_in_memory and not spilled:
+        return process_bucket_np(bucket, no_sum=no_sum)
+
+    if len(all_indices) > 0:
+        tag = all_indices[0].identity
+    else:
+        tag = 'f'
+
+    # the same passes as in process_bucket_np, before chunking
+    if not no_sum:
+        bucket, no_sum = substitute_permutation(bucket)
+        all_indices = tuple(sorted(
+            set(itertools.chain.from_iterable(
+                tensor.indices for tensor in bucket)), key=int))
+    bucket = apply_diagonal_factors(bucket)
+
+    if len(all_indices) == 0:
+        # the variable of a scalar bucket was substituted
+        result_data = einsum_sublist(
+            [(tensor.data, tensor.indices) for tensor in bucket], ())
+        for data in spilled:
+            release_spilled(data)
+        return opt.Tensor(f'E{tag}', output, data=result_data)
+
+    # Chunk along the leading index of the result. A scalar result
+    # is accumulated over the chunks of the bucket variable
+    chunk_idx = output[0] if output else all_indices[0]
+    if output:
+        row_bytes = result_bytes // chunk_idx.size
+    else:
+        row_bytes = dtype.itemsize
+    step = max(1, min(chunk_idx.size, max_in_memory // row_bytes))
+
+    if result_bytes > max_in_memory:
+        result_data = spill_array(shape, dtype, scratch_dir)
+    else:
+        result_data = np.empty(shape, dtype=dtype)
+
+    accumulator = None
+    for start in range(0, chunk_idx.size, step):
+        bound = slice(start, min(start + step, chunk_idx.size))
+        operands = []
+        for tensor in bucket:
+            data = tensor.data
+            positions = [int(idx) for idx in tensor.indices]
+            if int(chunk_idx) in positions:
+                axis = positions.index(int(chunk_idx))
+                data = data[(slice(None), ) * axis + (bound, )]
+            operands.append((data, tensor.indices))
+        part = einsum_sublist(operands, output)
+        if output:
+            result_data[bound] = part
+        elif accumulator is None:
+            accumulator = part
+        else:
+            accumulator = accumulator + part
+
+    if not output:
+        result_data = accumulator
+    elif isinstance(result_data, np.memmap):
+        result_data.flush()
+
+    # spilled inputs are consumed
+    for data in spilled:
+        release_spilled(data)
+
+    return opt.Tensor(f'E{tag}', output, data=result_data)
+
+
+def test_results_do_not_alias_inputs():
+    """
+    Checks that results of buckets are not views of the
+    (read-only, cached) input data
+    """
+    data = tc.get_gate_tensor(ops.cX(0, 1))
+    variables = [opt.Var(idx) for idx in range(3)]
+    bucket = [opt.Tensor('cX', variables, data=data)]
+    for process_bucket_fn in (process_bucket_np, process_bucket_np_path,
+                              process_bucket_np_gemm,
+                              process_bucket_np_ooc,
+                              process_final_bucket_np):
+        if process_bucket_fn is process_final_bucket_np:
+            result = process_bucket_fn(bucket)
+        else:
+            result = process_bucket_fn(bucket, no_sum=True)
+        assert not np.shares_memory(result.data, data)
+        assert result.data.flags.writeable
+        assert np.array_equal(result.data, data)
+
+    import qtree.np_plan as npp
+    plan = npp.compile_buckets([[opt.Tensor('cX', variables,
+                                            data_key='cX')], [], []],
+                               n_var_nosum=3)
+    result = npp.execute_plan(
+        plan, npp.load_plan_inputs(plan, {'cX': data}))
+    assert not np.shares_memory(result.data, data)
+    assert result.data.flags.writeable
+
+
+def test_process_bucket_np_path():
+    """
+    Compares pairwise contraction of a bucket with the sequential one
+    """
+    np.random.seed(0)
+    variables = [opt.Var(idx) for idx in range(8)]
+    for n_tensors in range(1, 9):
+        bucket = []
+        for ii in range(n_tensors):
+            rank = np.random.randint(0, 4)
+            indices = [variables[0]] + sorted(np.random.choice(
+                variables[1:], rank, replace=False), key=int)
+            data = (np.random.randn(*[2]*len(indices))
+                    + 1j*np.random.randn(*[2]*len(indices)))
+            bucket.append(opt.Tensor('T', indices, data=data))
+
+        for no_sum in (False, True):
+            reference = process_bucket_np(bucket, no_sum=no_sum)
+            for method in ('sequential', 'greedy', 'optimal'):
+                result = process_bucket_np_path(
+                    bucket, no_sum=no_sum, method=method)
+                assert result.indices == tuple(reference.indices)
+                assert np.allclose(result.data, reference.data)
+
+                # GEMM results may be transposed
+                result = process_bucket_np_gemm(
+                    bucket, no_sum=no_sum, method=method)
+                order = [result.indices.index(idx)
+                         for idx in reference.indices]
+                assert np.allclose(result.data.transpose(order),
+                                   reference.data)
+
+
+def test_bucket_elimination_gemm():
+    """
+    Checks the GEMM backend on a full circuit, where unsorted
+    intermediates are passed between buckets
+    """
+    import qtree.graph_model as gm
+
+    n_qubits = 6
+    circuit = ops.get_random_circuit(n_qubits, 8)
+    buckets, data_dict, bra_vars, ket_vars = opt.circ2buckets(
+        n_qubits, circuit)
+    graph = gm.buckets2graph(buckets, ignore_variables=bra_vars+ket_vars)
+    peo, _ = gm.get_upper_bound_peo(graph, method='min_fill')
+    perm_buckets, perm_dict = opt.reorder_buckets(
+        buckets, bra_vars + ket_vars + peo)
+    fixed_vars = [perm_dict[idx] for idx in bra_vars + ket_vars]
+
+    for state in range(4):
+        slice_dict = utils.slice_from_bits(state, fixed_vars)
+        reference = opt.bucket_elimination(
+            get_sliced_np_buckets(perm_buckets, data_dict, slice_dict),
+            process_bucket_np)
+        result = opt.bucket_elimination(
+            get_sliced_np_buckets(perm_buckets, data_dict, slice_dict),
+            process_bucket_np_gemm)
+        assert np.allclose(result.data, reference.data)
+
+
+def test_apply_diagonal_factors():
+    """
+    Checks that diagonal factors are merged and applied by
+    broadcasting with the same result as the contraction
+    """
+    a, b, c, d = [opt.Var(ii) for ii in range(4)]
+    rng = np.random.RandomState(0)
+
+    def random_tensor(indices, kind):
+        data = rng.randn(*[2] * len(indices))
+        return opt.Tensor('T', indices, data=data, kind=kind)
+
+    bucket = [random_tensor((a, b, c), 'dense'),
+              random_tensor((a, ), 'diagonal'),
+              random_tensor((a, ), 'diagonal'),
+              random_tensor((b, a), 'diagonal'),
+              random_tensor((a, d), 'diagonal')]
+    reduced = apply_diagonal_factors(bucket)
+    assert len(reduced) == 2
+    assert [tensor.kind for tensor in reduced] == ['dense', 'diagonal']
+
+    dense_bucket = [tensor.copy(kind='dense') for tensor in bucket]
+    for no_sum in (False, True):
+        reference = process_bucket_np(dense_bucket, no_sum=no_sum)
+        for result in (
+                process_bucket_np(bucket, no_sum=no_sum),
+                process_bucket_np_ooc(bucket, no_sum=no_sum,
+                                      max_in_memory=16)):
+            assert result.indices == reference.indices
+            assert np.allclose(result.data, reference.data)
+
+
+def test_substitute_permutation():
+    """
+    Checks the elimination of variables of permutation gates
+    by reindexing against the dense contraction and Cirq
+    """
+    import cirq
+    import qtree.graph_model as gm
+
+    n_qubits = 4
+    circuit = [[ops.H(qubit) for qubit in range(n_qubits)],
+               [ops.T(0), ops.ccX(1, 2, 3)],
+               [ops.cX(0, 1), ops.Y(2), ops.X_1_2(3)],
+               [ops.X(1), ops.ccX(3, 0, 2)],
+               [ops.cX(2, 3), ops.T(1), ops.Y(0)]]
+    buckets, data_dict, bra_vars, ket_vars = opt.circ2buckets(
+        n_qubits, circuit, dtype=np.complex128)
+    assert any(tensor.kind == 'permutation'
+               for bucket in buckets for tensor in bucket)
+
+    graph = gm.make_clique_on(
+        gm.buckets2graph(buckets, ignore_variables=ket_vars), bra_vars)
+    peo, _ = gm.get_upper_bound_peo(graph, method='min_fill')
+    peo = gm.get_equivalent_peo(graph, peo, bra_vars)
+    perm_buckets, perm_dict = opt.reorder_buckets(buckets, ket_vars + peo)
+    slice_dict = utils.slice_from_bits(
+        0, [perm_dict[var] for var in ket_vars])
+    free_vars = [perm_dict[var] for var in bra_vars]
+
+    # the out-of-core processing is chunked for all buckets
+    process_bucket_np_chunked = functools.partial(
+        process_bucket_np_ooc, max_in_memory=16)
+
+    results = []
+    for process_bucket_fn in (process_bucket_np, process_bucket_np_path,
+                              process_bucket_np_gemm,
+                              process_bucket_np_chunked):
+        result = opt.bucket_elimination(
+            get_sliced_np_buckets(perm_buckets, data_dict, slice_dict),
+            process_bucket_fn, n_var_nosum=n_qubits)
+        order = [[int(idx) for idx in result.indices].index(int(var))
+                 for var in free_vars]
+        results.append(result.data.transpose(order).flatten())
+
+    cirq_circuit = cirq.Circuit()
+    for layer in circuit:
+        cirq_circuit.append(op.to_cirq_1d_circ_op() for op in layer)
+    reference = cirq.Simulator(dtype=np.complex128).simulate(
+        cirq_circuit, qubit_order=cirq.LineQubit.range(n_qubits)
+    ).final_state_vector
+    for result in results:
+        assert np.allclose(result, reference)
+
+
+def test_bucket_elimination_ooc():
+    """
+    Checks the out-of-core processing with a tiny memory threshold,
+    so most intermediates are spilled to disk
+    """
+    import qtree.graph_model as gm
+
+    n_qubits = 6
+    circuit = ops.get_random_circuit(n_qubits, 8)
+    buckets, data_dict, bra_vars, ket_vars = opt.circ2buckets(
+        n_qubits, circuit)
+    free_bra_vars = bra_vars[:2]
+    bra_vars = bra_vars[2:]
+    graph = gm.make_clique_on(
+        gm.buckets2graph(buckets, ignore_variables=bra_vars+ket_vars),
+        free_bra_vars)
+    peo, _ = gm.get_upper_bound_peo(graph, method='min_fill')
+    peo = gm.get_equivalent_peo(graph, peo, free_bra_vars)
+    perm_buckets, perm_dict = opt.reorder_buckets(
+        buckets, bra_vars + ket_vars + peo)
+    fixed_vars = [perm_dict[idx] for idx in bra_vars + ket_vars]
+
+    with tempfile.TemporaryDirectory() as scratch_dir:
+        spilled = []
+
+        def process_bucket_fn(bucket, no_sum=False):
+            result = process_bucket_np_ooc(
+                bucket, no_sum=no_sum, max_in_memory=16,
+                scratch_dir=scratch_dir)
+            spilled.append(is_spilled(result.data))
+            return result
+
+        for state in range(4):
+            slice_dict = utils.slice_from_bits(state, fixed_vars)
+            reference = opt.bucket_elimination(
+                get_sliced_np_buckets(perm_buckets, data_dict,
+                                      slice_dict),
+                process_bucket_np, n_var_nosum=len(free_bra_vars))
+            result = opt.bucket_elimination(
+                get_sliced_np_buckets(perm_buckets, data_dict,
+                                      slice_dict),
+                process_bucket_fn, n_var_nosum=len(free_bra_vars))
+            assert np.allclose(result.data, reference.data)
+            release_spilled(result.data)
+            del result
+            assert len(os.listdir(scratch_dir)) == 0
+        assert any(spilled)
+
+
+def test_einsum_sublist_wide():
+    """
+    Checks contractions with many distinct indices. Most indices
+    have size 1 (as sliced variables do), so the reference can be
+    computed with :py:meth:`numpy.einsum` on squeezed arrays
+    """
+    np.random.seed(0)
+
+    def random_pair(n_a, n_b, n_shared, n_contracted):
+        identities = np.random.choice(10**5, n_a + n_b - n_shared,
+                                      replace=False)
+        variables = [opt.Var(int(idx), size=1) for idx in identities]
+        for pos in np.random.choice(len(variables), 6, replace=False):
+            variables[pos] = variables[pos].copy(size=2)
+        a_indices = variables[:n_a]
+        b_indices = variables[n_a - n_shared:]
+        contracted = a_indices[n_a - n_shared:][:n_contracted]
+        output = [idx for idx in variables if idx not in contracted]
+        np.random.shuffle(output)
+        a = np.random.randn(*[idx.size for idx in a_indices])
+        b = np.random.randn(*[idx.size for idx in b_indices])
+        return (a, a_indices), (b, b_indices), output
+
+    def squeezed_reference(operands, output):
+        squeezed = []
+        for data, indices in operands:
+            squeezed.append((data.squeeze(),
+                             [idx for idx in indices if idx.size > 1]))
+        result = einsum_sublist(
+            squeezed, [idx for idx in output if idx.size > 1])
+        return result.reshape([idx.size for idx in output])
+
+    # numpy < 2 can not iterate over more than 32 distinct indices
+    for _ in range(5):
+        a, b, output = random_pair(32, 32, 16, 16)
+        assert np.allclose(einsum_sublist([a, b], output),
+                           squeezed_reference([a, b], output))
+
+    def random_chain(n_indices, n_operands, n_bond=4, n_out=2):
+        """
+        Chain of operands with at most 32 dimensions each, where
+        neighbors share n_bond indices, and n_indices distinct
+        indices in total
+        """
+        n_private = n_indices - n_operands * n_out - (
+            n_operands - 1) * n_bond
+        identities = iter(np.random.choice(10**5, n_indices,
+                                           replace=False).tolist())
+        sizes = np.ones(n_indices, dtype=int)
+        sizes[np.random.choice(n_indices, 8, replace=False)] = 2
+        sizes = iter(sizes.tolist())
+
+        def new_vars(count):
+            return [opt.Var(next(identities), size=next(sizes))
+                    for _ in range(count)]
+
+        bonds = [new_vars(n_bond) for _ in range(n_operands - 1)]
+        operands = []
+        output = []
+        for n in range(n_operands):
+            outputs = new_vars(n_out)
+            output += outputs
+            indices = (new_vars(n_private // n_operands
+                                + (n < n_private % n_operands))
+                       + outputs + sum(bonds[max(n-1, 0):n+1], []))
+            np.random.shuffle(indices)
+            assert len(indices) <= 32
+            operands.append((
+                np.random.randn(*[idx.size for idx in indices]),
+                indices))
+        np.random.shuffle(output)
+        return operands, output
+
+    for n_indices, n_operands in ((60, 3), (80, 3), (96, 4)):
+        operands, output = random_chain(n_indices, n_operands)
+        assert n_indices > MAX_EINSUM_INDICES
+        assert np.allclose(einsum_sublist(operands, output),
+                           squeezed_reference(operands, output))
+
+    # operands with more than 32 dimensions
+    if _NP_MAXDIMS < 64:
+        import pytest
+        pytest.skip('numpy < 2 does not support arrays with more '
+                    'than 32 dimensions')
+
+    for n_indices in (60, 80, 96):
+        n_shared = 32
+        n_dims = (n_indices + n_shared) // 2
+        a, b, output = random_pair(n_dims, n_dims, n_shared,
+                                   max(16, n_indices - 64))
+        assert np.allclose(einsum_sublist([a, b], output),
+                           squeezed_reference([a, b], output))
+
+
+def test_process_final_bucket_np():
+    """
+    Checks the final stage on a circuit made of two independent parts
+    """
+    import qtree.graph_model as gm
+
+    n_qubits = 6
+    circuit = [[ops.H(qubit) for qubit in range(n_qubits)],
+               [ops.cZ(0, 1), ops.cZ(3, 4)],
+               [ops.X_1_2(0), ops.T(1), ops.Y_1_2(2), ops.W_1_2(4)],
+               [ops.cZ(1, 2), ops.cZ(4, 5)],
+               [ops.X_1_2(1), ops.Y_1_2(3), ops.T(5)]]
+    buckets, data_dict, bra_vars, ket_vars = opt.circ2buckets(
+        n_qubits, circuit, dtype=np.complex128)
+
+    graph = gm.make_clique_on(
+        gm.buckets2graph(buckets, ignore_variables=ket_vars), bra_vars)
+    peo, _ = gm.get_upper_bound_peo(graph, method='min_fill')
+    peo = gm.get_equivalent_peo(graph, peo, bra_vars)
+    perm_buckets, perm_dict = opt.reorder_buckets(buckets,
+                                                  ket_vars + peo)
+    ket_vars = [perm_dict[var] for var in ket_vars]
+    bra_vars = [perm_dict[var] for var in bra_vars]
+
+    slice_dict = utils.slice_from_bits(0, ket_vars)
+    slice_dict.update({var: slice(None) for var in bra_vars})
+
+    def evaluate(**kwargs):
+        sliced_buckets = get_sliced_np_buckets(
+            perm_buckets, data_dict, slice_dict)
+        return opt.bucket_elimination(
+            sliced_buckets, process_bucket_np,
+            n_var_nosum=len(bra_vars), **kwargs)
+
+    reference = evaluate()
+    result = evaluate(process_final_fn=process_final_bucket_np)
+    assert result.indices == reference.indices
+    assert np.allclose(result.data, reference.data)
+
+    factorized = evaluate(process_final_fn=functools.partial(
+        process_final_bucket_np, factorize=True))
+    assert len(factorized.factors) >= 2
+    assert factorized.nbytes < reference.data.nbytes
+    assert factorized.indices == reference.indices
+    assert np.allclose(factorized.data, reference.data)
+
+    values = np.random.RandomState(0).randint(2, size=(10, n_qubits))
+    assert np.allclose(factorized.get_entries(values),
+                       reference.data[tuple(values.T)])
@@ -0,0 +1,409 @@
+"""
+This module implements parallel evaluation of sliced contractions
+on a single machine. The compiled plan
+(see :py:mod:`np_plan`) and the tensor data are placed in
+a :py:mod:`multiprocessing.shared_memory` block once, so worker
+processes attach to them instead of receiving copies. Slices
+generated by :py:meth:`utils.slice_values_generator` are handed to
+the workers dynamically in small chunks and the partial sums are
+reduced pairwise as a binary tree. The part of the contraction
+which does not depend on the parallel variables is evaluated once
+per worker (see :py:class:`np_plan.HoistedPlan`).
+
+>>> plan = compile_buckets(perm_buckets, slice_dict, n_var_nosum)
+>>> with SliceExecutor(plan, data_dict, n_processes=4) as executor:
+...     result = executor.run(slice_dict, vars_parallel)
+"""
+
+import sys
+import itertools
+import multiprocessing
+import multiprocessing.util
+import pickle
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+import qtree.optimizer as opt
+import qtree.np_plan as npp
+import qtree.tensor_cache as tc
+import qtree.utils as utils
+
+# Alignment of the arrays in the shared block, in bytes
+SHARED_ALIGNMENT = 64
+
+# state of the worker process, set by the initializer
+_worker_state = {}
+
+
+class TreeReducer(object):
+    """
+    Sums values pairwise as in a binary tree, but without
+    storing all of them: at most log2(n) partial sums are kept.
+    The rounding error grows as O(log n) instead of O(n) for the
+    sequential summation.
+    """
+    def __init__(self):
+        self._stack = []
+
+    def add(self, value, weight=1):
+        """
+        Adds a value which is the sum of ``weight`` leaves
+        """
+        while self._stack and self._stack[-1][1] <= weight:
+            other, other_weight = self._stack.pop()
+            value = other + value
+            weight += other_weight
+        self._stack.append((value, weight))
+
+    @property
+    def count(self):
+        return sum(weight for _, weight in self._stack)
+
+    def result(self):
+        """
+        Returns the total sum or None if nothing was added
+        """
+        value = None
+        for other, _ in reversed(self._stack):
+            value = other if value is None else other + value
+        return value
+
+
+def share_data(plan, data_dict):
+    """
+    Copies the data of the plan inputs and the pickled plan
+    into a shared memory block.
+
+    Parameters
+    ----------
+    plan : np_plan.ContractionPlan
+            compiled plan
+    data_dict : dict
+            dictionary containing values for the placeholder Tensors
+
+    Returns
+    -------
+    shm : multiprocessing.shared_memory.SharedMemory
+            the block. The caller is responsible for unlinking it
+    header_size : int
+            size of the pickled header at the beginning of the block
+    """
+    keys = sorted(set(plan_input.data_key for plan_input in plan.inputs),
+                  key=str)
+    arrays = {key: np.ascontiguousarray(data_dict[key]) for key in keys}
+
+    layout = {}
+    offset = 0
+    for key in keys:
+        layout[key] = (offset, arrays[key].shape, arrays[key].dtype.str)
+        offset += -(-arrays[key].nbytes // SHARED_ALIGNMENT) \
+            * SHARED_ALIGNMENT
+
+    header = pickle.dumps((plan, layout), pickle.HIGHEST_PROTOCOL)
+    header_size = -(-len(header) // SHARED_ALIGNMENT) * SHARED_ALIGNMENT
+
+    shm = shared_memory.SharedMemory(create=True,
+                                     size=max(header_size + offset, 1))
+    shm.buf[:len(header)] = header
+    for key in keys:
+        start, shape, dtype = layout[key]
+        view = np.ndarray(shape, dtype=dtype, buffer=shm.buf,
+                          offset=header_size + start)
+        view[...] = arrays[key]
+        del view
+    return shm, header_size
+
+
+def attach_data(shm, header_size):
+    """
+    Restores the plan and read-only views of the data
+    from a shared memory block created by :py:meth:`share_data`
+
+    Returns
+    -------
+    plan : np_plan.ContractionPlan
+    data_dict : dict
+    """
+    plan, layout = pickle.loads(shm.buf[:header_size])
+    data_dict = {}
+    for key, (start, shape, dtype) in layout.items():
+        data = np.ndarray(shape, dtype=dtype, buffer=shm.buf,
+                          offset=header_size + start)
+        data.flags.writeable = False
+        data_dict[key] = data
+    return plan, data_dict
+
+
+def _attach_shared_memory(name):
+    """
+    Attaches to a block created by another process without
+    registering it with the resource tracker: only the creating
+    process unlinks the block
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    # Older versions register every attached block. The tracker
+    # is inherited from the parent, so unregistering the block
+    # afterwards would drop the registration of the creator too.
+    # Skip the registration instead (the initializer runs before
+    # any other thread of the worker is started)
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+def _close_worker():
+    """
+    Drops the views of the shared block and closes it
+    at the exit of the worker
+    """
+    shm = _worker_state.pop('shm', None)
+    _worker_state.clear()
+    # cached variants may refer to the shared data
+    tc.clear_caches()
+    if shm is not None:
+        shm.close()
+
+
+def _init_worker(shm_name, header_size):
+    shm = _attach_shared_memory(shm_name)
+    plan, data_dict = attach_data(shm, header_size)
+    _worker_state.update(shm=shm, plan=plan, data_dict=data_dict)
+    # finalizers with a priority are run when the worker exits
+    multiprocessing.util.Finalize(None, _close_worker, exitpriority=10)
+
+
+def _get_invariants(slice_dict, vars_parallel, arrays):
+    """
+    Returns the hoisted plan and its slice-invariant intermediates,
+    which are computed once per worker for the same slices of the
+    variables other than the parallel ones
+    """
+    parallel = set(map(int, vars_parallel))
+    key = (tuple(sorted(parallel)), tuple(sorted(
+        (int(var), (bound.start, bound.stop, bound.step)
+         if isinstance(bound, slice) else bound)
+        for var, bound in slice_dict.items()
+        if int(var) not in parallel)))
+    cached = _worker_state.get('invariants')
+    if cached is None or cached[0] != key:
+        hoisted = npp.HoistedPlan(_worker_state['plan'], vars_parallel)
+        cached = (key, hoisted, hoisted.precompute(arrays))
+        _worker_state['invariants'] = cached
+    return cached[1], cached[2]
+
+
+def _run_slices(task):
+    """
+    Evaluates slices ``start .. stop-1`` of the parallel variables
+    and returns their tree-reduced sum and count
+    """
+    slice_dict, vars_parallel, start, stop, accumulate_dtype = task
+    plan = _worker_state['plan']
+    data_dict = _worker_state['data_dict']
+
+    reducer = TreeReducer()
+    slices = itertools.islice(
+        utils.slice_values_generator(vars_parallel, start, 1),
+        stop - start)
+    for parallel_slice_dict in slices:
+        slice_dict.update(parallel_slice_dict)
+        arrays = npp.load_plan_inputs(plan, data_dict, slice_dict)
+        hoisted, invariants = _get_invariants(slice_dict, vars_parallel,
+                                              arrays)
+        result = hoisted.execute(arrays, invariants)
+        if result is not None:
+            data = result.data
+            if accumulate_dtype is not None:
+                data = np.asarray(data, dtype=accumulate_dtype)
+            reducer.add(data)
+    return reducer.result(), stop - start
+
+
+class SliceExecutor(object):
+    """
+    Pool of worker processes evaluating slices of a compiled
+    contraction plan. The plan and the data are shared between
+    the workers through shared memory. Should be used as a context
+    manager or closed explicitly with :py:meth:`close`.
+
+    Parameters
+    ----------
+    plan : np_plan.ContractionPlan
+            compiled plan. Parallel variables have to be sliced
+            with slices of width 1 during compilation
+    data_dict : dict
+            dictionary containing values for the placeholder Tensors
+    n_processes : int, optional
+            number of workers. Defaults to the number of CPUs
+    start_method : str, optional
+            start method of the processes, see
+            :py:meth:`multiprocessing.get_context`
+    """
+    def __init__(self, plan, data_dict, n_processes=None,
+                 start_method=None):
+        self.plan = plan
+        if n_processes is None:
+            n_processes = multiprocessing.cpu_count()
+        self.n_processes = n_processes
+
+        self._shm, header_size = share_data(plan, data_dict)
+        context = multiprocessing.get_context(start_method)
+        try:
+            self._pool = context.Pool(
+                n_processes, initializer=_init_worker,
+                initargs=(self._shm.name, header_size))
+        except Exception:
+            self._release()
+            raise
+
+    def run(self, slice_dict, vars_parallel, chunk_size=None,
+            accumulate_dtype=None):
+        """
+        Sums the results of the plan over all values of
+        the parallel variables.
+
+        Parameters
+        ----------
+        slice_dict : dict
+                slices of the other sliced variables
+        vars_parallel : list
+                variables to parallelize over
+        chunk_size : int, optional
+                number of slices in one task. By default tasks are
+                small enough to give every worker about
+                4 tasks
+        accumulate_dtype : numpy.dtype, optional
+                precision of the partial sums over slices, e.g.
+                numpy.complex128 for a calculation in
+                numpy.complex64. By default the precision of the
+                results is used
+
+        Returns
+        -------
+        result : optimizer.Tensor
+                same as returned by :py:meth:`np_plan.execute_plan`,
+                summed over the slices
+        """
+        total_tasks = int(np.prod([var.size for var in vars_parallel]))
+        if chunk_size is None:
+            chunk_size = max(1, total_tasks // (4 * self.n_processes))
+
+        tasks = ((slice_dict, vars_parallel, start,
+                  min(start + chunk_size, total_tasks), accumulate_dtype)
+                 for start in range(0, total_tasks, chunk_size))
+
+        reducer = TreeReducer()
+        for partial, count in self._pool.imap_unordered(
+                _run_slices, tasks):
+            if partial is not None:
+                reducer.add(partial, count)
+
+        result_data = reducer.result()
+        if result_data is None:
+            return None
+        return opt.Tensor('E', self.plan.result_indices,
+                          data=result_data)
+
+    def _release(self):
+        # the executor created the block, so it unlinks it
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+    def close(self):
+        """
+        Stops the workers and frees the shared memory
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        self._release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def test_tree_reducer():
+    """
+    Checks the tree summation against the sequential one
+    """
+    for n in (0, 1, 2, 7, 64, 100):
+        reducer = TreeReducer()
+        for value in range(n):
+            reducer.add(value)
+        assert reducer.count == n
+        assert reducer.result() == (sum(range(n)) if n else None)
+
+
+def test_slice_executor():
+    """
+    Compares the parallel sum over slices with the sequential one
+    """
+    import qtree.operators as ops
+    import qtree.graph_model as gm
+    import functools
+
+    n_qubits = 5
+    circuit = ops.get_random_circuit(n_qubits, 6)
+    buckets, data_dict, bra_vars, ket_vars = opt.circ2buckets(
+        n_qubits, circuit)
+
+    graph = gm.buckets2graph(buckets,
+                             ignore_variables=bra_vars+ket_vars)
+    peo_function = functools.partial(gm.get_upper_bound_peo,
+                                     method='min_fill')
+    vars_parallel, graph_reduced = gm.split_graph_by_metric_greedy(
+        graph, 3, metric_fn=gm.splitters.get_node_by_mem_reduction,
+        peo_function=peo_function)
+    peo, _ = peo_function(graph_reduced)
+
+    perm_buckets, perm_dict = opt.reorder_buckets(
+        buckets, ket_vars + bra_vars + vars_parallel + peo)
+    ket_vars = [perm_dict[var] for var in ket_vars]
+    bra_vars = [perm_dict[var] for var in bra_vars]
+    vars_parallel = [perm_dict[var] for var in vars_parallel]
+
+    slice_dict = utils.slice_from_bits(0, ket_vars)
+    slice_dict.update(utils.slice_from_bits(0, bra_vars))
+    slice_dict.update(utils.slice_from_bits(0, vars_parallel))
+    plan = npp.compile_buckets(perm_buckets, slice_dict)
+
+    executor = SliceExecutor(plan, data_dict, n_processes=2)
+    shm_name = executor._shm.name
+    with executor:
+        for target_state in (0, 5, 2**n_qubits - 1):
+            slice_dict.update(
+                utils.slice_from_bits(target_state, bra_vars))
+            reference = 0
+            for parallel_slice_dict in utils.slice_values_generator(
+                    vars_parallel, 0, 1):
+                slice_dict.update(parallel_slice_dict)
+                reference += npp.execute_plan(
+                    plan, npp.load_plan_inputs(
+                        plan, data_dict, slice_dict)).data
+
+            for chunk_size in (None, 3):
+                result = executor.run(slice_dict, vars_parallel,
+                                      chunk_size=chunk_size)
+                assert np.allclose(result.data, reference)
+            result = executor.run(slice_dict, vars_parallel,
+                                  accumulate_dtype=np.complex128)
+            assert result.data.dtype == np.complex128
+            assert np.allclose(result.data, reference)
+
+    # the workers are stopped and the block is removed
+    try:
+        _attach_shared_memory(shm_name).close()
+    except FileNotFoundError:
+        pass
+    else:
+        raise AssertionError('Shared memory block is not unlinked')
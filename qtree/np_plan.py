@@ -0,0 +1,1365 @@
+"""
+This module implements compilation of the bucket elimination
+algorithm into a static program which can be replayed against
+Numpy arrays. The structure of the buckets (indices, einsum
+subscripts, shapes and destination buckets of intermediate results)
+is analyzed only once, so repeated evaluations of the same network
+with different slices or amplitudes only pay for the contractions.
+
+The usage is similar to :py:meth:`optimizer.bucket_elimination`:
+
+>>> plan = compile_buckets(perm_buckets, slice_dict, n_var_nosum)
+>>> for slice_dict in slices:
+...     arrays = load_plan_inputs(plan, data_dict, slice_dict)
+...     result = execute_plan(plan, arrays)
+"""
+
+import itertools
+import concurrent.futures as futures
+import numpy as np
+import qtree.optimizer as opt
+import qtree.system_defs as defs
+import qtree.np_framework as npfr
+import qtree.contraction_path as cp
+import qtree.tensor_cache as tc
+
+# the tracker is shared with opt.bucket_elimination
+from qtree.optimizer import MemoryBudgetError, MemoryTracker
+
+
+class PlanInput(object):
+    """
+    Describes how an input array of the plan is obtained
+    from the data dictionary
+
+    Attributes
+    ----------
+    data_key : hashable
+            key of the tensor data in the data dictionary
+    transpose_order : tuple or None
+            permutation which sorts the axes of the data by variable.
+            None if the data is already sorted
+    sliced_axes : tuple
+            pairs (axis, variable) of the axes which are sliced
+    """
+    __slots__ = ('data_key', 'transpose_order', 'sliced_axes')
+
+    def __init__(self, data_key, transpose_order, sliced_axes):
+        self.data_key = data_key
+        self.transpose_order = transpose_order
+        self.sliced_axes = sliced_axes
+
+    def __repr__(self):
+        return 'PlanInput({}, {}, {})'.format(
+            self.data_key, self.transpose_order, self.sliced_axes)
+
+
+class PlanOp(object):
+    """
+    Single contraction step of the plan. Arrays stored in the slots
+    ``operands`` are contracted with :py:meth:`numpy.einsum`
+    using integer subscripts and the result is stored in the
+    slot ``result``.
+
+    Attributes
+    ----------
+    operands : tuple
+            slots of the operands
+    subscripts : tuple of tuples
+            integer einsum subscripts of the operands
+    output : tuple
+            integer einsum subscripts of the result
+    result : int
+            slot of the result
+    shape : tuple
+            shape of the result
+    bucket : int
+            bucket which this step belongs to
+    target : int or None
+            bucket which receives the result. None for scalars
+            and for the final result
+    kind : str
+            'einsum', 'wide', 'broadcast' or 'permutation'. Wide
+            operations have too many indices for
+            :py:meth:`numpy.einsum` and are evaluated with
+            :py:meth:`np_framework.einsum_sublist`.
+            Broadcast operations multiply the first operand
+            elementwise by a diagonal factor, whose indices are
+            a subset of the indices of the first operand.
+            Permutation operations process a whole bucket holding
+            a permutation tensor with
+            :py:meth:`np_framework.process_bucket_np_path`, which
+            eliminates the variable by reindexing if the sliced
+            tensor allows it
+    kinds : tuple or None
+            kinds of the operands of permutation operations
+    """
+    __slots__ = ('operands', 'subscripts', 'output', 'result',
+                 'shape', 'bucket', 'target', 'kind', 'kinds')
+
+    def __init__(self, operands, subscripts, output, result,
+                 shape, bucket, target=None, kind='einsum',
+                 kinds=None):
+        self.operands = operands
+        self.subscripts = subscripts
+        self.output = output
+        self.result = result
+        self.shape = shape
+        self.bucket = bucket
+        self.target = target
+        self.kind = kind
+        self.kinds = kinds
+
+    def __repr__(self):
+        return 'PlanOp({} -> {}: {}->{})'.format(
+            self.operands, self.result, self.subscripts, self.output)
+
+
+class ContractionPlan(object):
+    """
+    Static program of the bucket elimination. Slots
+    ``0 .. len(inputs)-1`` hold input arrays, the rest are
+    intermediate results.
+
+    Attributes
+    ----------
+    inputs : list of PlanInput
+            description of the input arrays
+    ops : list of PlanOp
+            contraction steps in the order of execution
+    scalars : list
+            slots holding scalar results, which are multiplied
+            into the final result
+    result_slot : int or None
+            slot of the final (not summed) tensor, if any
+    result_indices : tuple
+            indices of the final tensor
+    n_slots : int
+            total number of slots
+    """
+    def __init__(self, inputs, ops, scalars, result_slot,
+                 result_indices, n_slots):
+        self.inputs = inputs
+        self.ops = ops
+        self.scalars = scalars
+        self.result_slot = result_slot
+        self.result_indices = tuple(result_indices)
+        self.n_slots = n_slots
+
+    def __repr__(self):
+        return 'ContractionPlan(inputs={}, ops={}, result={})'.format(
+            len(self.inputs), len(self.ops), self.result_indices)
+
+
+def _make_op(operands, output_indices, result_slot, bucket):
+    """
+    Creates a :class:`PlanOp` for operands given as pairs
+    (slot, indices). Variables are remapped to the smallest
+    integers, as einsum does not like large numbers
+    """
+    all_indices = sorted(
+        set(itertools.chain.from_iterable(
+            indices for _, indices in operands)), key=int)
+    idx_to_least_idx = {int(idx): num for num, idx
+                        in enumerate(all_indices)}
+
+    subscripts = tuple(
+        tuple(idx_to_least_idx[int(idx)] for idx in indices)
+        for _, indices in operands)
+    output = tuple(idx_to_least_idx[int(idx)] for idx in output_indices)
+    shape = tuple(idx.size for idx in output_indices)
+    kind = ('wide' if len(all_indices) > npfr.MAX_EINSUM_INDICES
+            else 'einsum')
+
+    return PlanOp(tuple(slot for slot, _ in operands),
+                  subscripts, output, result_slot, shape, bucket,
+                  kind=kind)
+
+
+def _make_broadcast_op(dense, diagonal, result_slot, bucket):
+    """
+    Creates a :class:`PlanOp` multiplying the dense operand by the
+    diagonal one with broadcasting. Operands are pairs (slot, indices)
+    """
+    op = _make_op([dense, diagonal], dense[1], result_slot, bucket)
+    op.kind = 'broadcast'
+    return op
+
+
+def _compile_diagonal_factors(bucket, kinds, ops, next_slot,
+                              bucket_idx):
+    """
+    Emits operations which premultiply the diagonal tensors of
+    the bucket and apply them to dense tensors, grouped as in
+    :py:meth:`np_framework.apply_diagonal_factors`. Returns the
+    new bucket and the first free slot
+    """
+    diagonal = [(slot, indices) for slot, indices in bucket
+                if kinds.get(slot) == 'diagonal']
+    if len(diagonal) == 0:
+        return bucket, next_slot
+    dense = [(slot, indices) for slot, indices in bucket
+             if kinds.get(slot) != 'diagonal']
+
+    def get_size(indices):
+        return int(np.prod([idx.size for idx in indices], dtype=object))
+
+    # premultiply diagonal factors, larger ones absorb smaller ones
+    merged = []
+    for slot, indices in sorted(diagonal, key=lambda item: -len(item[1])):
+        index_set = set(map(int, indices))
+        for pos, other in enumerate(merged):
+            if index_set <= set(map(int, other[1])):
+                ops.append(_make_broadcast_op(
+                    other, (slot, indices), next_slot, bucket_idx))
+                kinds[next_slot] = 'diagonal'
+                merged[pos] = (next_slot, other[1])
+                next_slot += 1
+                break
+        else:
+            merged.append((slot, indices))
+
+    for slot, indices in merged:
+        index_set = set(map(int, indices))
+        candidates = [pos for pos, (_, other) in enumerate(dense)
+                      if index_set <= set(map(int, other))]
+        if candidates:
+            pos = min(candidates, key=lambda pos: get_size(dense[pos][1]))
+            ops.append(_make_broadcast_op(
+                dense[pos], (slot, indices), next_slot, bucket_idx))
+            dense[pos] = (next_slot, dense[pos][1])
+            next_slot += 1
+        else:
+            dense.append((slot, indices))
+    return dense, next_slot
+
+
+def _compile_bucket(bucket, ops, next_slot, bucket_idx, no_sum=False,
+                    path_method='auto', kinds=None):
+    """
+    Emits operations which process a bucket: tensors are
+    multiplied pairwise in the order given by the contraction path
+    and the lowest variable is summed over as soon as possible.
+
+    Parameters
+    ----------
+    bucket : list
+           pairs (slot, indices) of the bucket tensors
+    ops : list
+           list of operations to append to
+    next_slot : int
+           first free slot
+    bucket_idx : int
+           index of the processed bucket
+    no_sum : bool
+           If no summation should be done over the buckets's variable
+    path_method : str, default 'auto'
+           method of :py:meth:`contraction_path.get_contraction_path`
+    kinds : dict, optional
+           kinds of the tensors in the slots, see
+           :py:class:`optimizer.Tensor`. Dense by default
+
+    Returns
+    -------
+    slot : int
+           slot of the result
+    indices : tuple
+           indices of the result
+    next_slot : int
+           first free slot after this bucket
+    """
+    all_indices = tuple(sorted(
+        set(itertools.chain.from_iterable(
+            indices for _, indices in bucket)), key=int))
+    output = all_indices if no_sum else all_indices[1:]
+
+    if kinds is not None and not no_sum and any(
+            kinds.get(slot) == 'permutation' for slot, _ in bucket):
+        # the variable is substituted at run time, as the values
+        # of the permutation depend on the slices
+        op = _make_op(bucket, output, next_slot, bucket_idx)
+        op.kind = 'permutation'
+        op.kinds = tuple(kinds.get(slot, 'dense') for slot, _ in bucket)
+        ops.append(op)
+        return next_slot, output, next_slot + 1
+
+    if kinds is not None:
+        bucket, next_slot = _compile_diagonal_factors(
+            bucket, kinds, ops, next_slot, bucket_idx)
+
+    indices_list = [indices for _, indices in bucket]
+    path = cp.get_contraction_path(indices_list, output,
+                                   method=path_method)
+
+    operands = list(bucket)
+    for i, j, result_indices in cp.get_path_steps(
+            indices_list, output, path):
+        ops.append(_make_op([operands[i], operands[j]],
+                            result_indices, next_slot, bucket_idx))
+        operands.pop(j)
+        operands.pop(i)
+        operands.append((next_slot, result_indices))
+        next_slot += 1
+
+    acc_slot, acc_indices = operands[0]
+    if tuple(acc_indices) != output:
+        # a single tensor, only sum over the variable
+        ops.append(_make_op([(acc_slot, acc_indices)],
+                            output, next_slot, bucket_idx))
+        acc_slot, acc_indices = next_slot, output
+        next_slot += 1
+
+    return acc_slot, acc_indices, next_slot
+
+
+def get_sliced_indices(tensor, slice_dict):
+    """
+    Calculates symbolically the layout of a tensor as produced by
+    :py:meth:`np_framework.get_sliced_np_buckets`
+
+    Parameters
+    ----------
+    tensor : optimizer.Tensor
+           placeholder tensor
+    slice_dict : dict
+           slices in the form {variable: slice}
+
+    Returns
+    -------
+    plan_input : PlanInput
+           description of the input
+    indices_sliced : tuple
+           indices of the sliced tensor
+    """
+    indices = tensor.indices
+    transpose_order = tuple(sorted(range(len(indices)),
+                                   key=lambda pp: int(indices[pp])))
+    indices_sorted = [indices[pp] for pp in transpose_order]
+
+    sliced_axes = []
+    indices_sliced = []
+    for axis, idx in enumerate(indices_sorted):
+        if idx in slice_dict:
+            bound = slice_dict[idx]
+            sliced_axes.append((axis, idx))
+            if isinstance(bound, slice):
+                size = len(range(*bound.indices(idx.size)))
+                indices_sliced.append(idx.copy(size=size))
+        else:
+            indices_sliced.append(idx)
+
+    if transpose_order == tuple(range(len(indices))):
+        transpose_order = None
+
+    return (PlanInput(tensor.data_key, transpose_order,
+                      tuple(sliced_axes)),
+            tuple(indices_sliced))
+
+
+def compile_buckets(buckets, slice_dict=None, n_var_nosum=0,
+                    path_method='auto'):
+    """
+    Walks the buckets symbolically and emits a static program
+    equivalent to
+    :py:meth:`optimizer.bucket_elimination` with
+    :py:meth:`np_framework.process_bucket_np_path` applied to
+    the buckets returned by
+    :py:meth:`np_framework.get_sliced_np_buckets`.
+
+    Only the structure of the slices is used: any slice dictionary
+    with the same keys and the same slice widths can be used with
+    the compiled plan.
+
+    Parameters
+    ----------
+    buckets : list of lists
+              placeholder buckets as returned by
+              :py:meth:`optimizer.circ2buckets`
+              and :py:meth:`optimizer.reorder_buckets`.
+    slice_dict : dict, optional
+              slices in the form {variable: slice}
+    n_var_nosum : int, optional
+              number of variables that have to be left in the
+              result. Expected at the end of bucket list
+    path_method : str, default 'auto'
+              how tensors are ordered inside buckets. See
+              :py:meth:`contraction_path.get_contraction_path`.
+              'sequential' reproduces the order of
+              :py:meth:`np_framework.process_bucket_np`
+    Returns
+    -------
+    plan : ContractionPlan
+    """
+    if slice_dict is None:
+        slice_dict = {}
+
+    # Lay out inputs
+    inputs = []
+    sym_buckets = []
+    kinds = {}
+    for bucket in buckets:
+        sym_bucket = []
+        for tensor in bucket:
+            plan_input, indices = get_sliced_indices(tensor, slice_dict)
+            kinds[len(inputs)] = tensor.kind
+            sym_bucket.append((len(inputs), indices))
+            inputs.append(plan_input)
+        sym_buckets.append(sym_bucket)
+
+    # Walk the buckets
+    n_var_contract = len(sym_buckets) - n_var_nosum
+    next_slot = len(inputs)
+    ops = []
+    scalars = []
+    for n, bucket in enumerate(sym_buckets[:n_var_contract]):
+        if len(bucket) == 0:
+            continue
+        n_ops = len(ops)
+        slot, indices, next_slot = _compile_bucket(
+            bucket, ops, next_slot, n, path_method=path_method,
+            kinds=kinds)
+        if len(indices) > 0:
+            # Move the result to appropriate bucket
+            target = int(indices[0])
+            sym_buckets[target].append((slot, indices))
+        else:
+            target = None
+            scalars.append(slot)
+        for op in ops[n_ops:]:
+            op.target = target
+
+    # form a single list of the rest if any
+    rest = list(itertools.chain.from_iterable(
+        sym_buckets[n_var_contract:]))
+    if len(rest) > 0:
+        result_slot, result_indices, next_slot = _compile_bucket(
+            rest, ops, next_slot, n_var_contract, no_sum=True,
+            path_method=path_method, kinds=kinds)
+    else:
+        result_slot, result_indices = None, ()
+
+    return ContractionPlan(inputs, ops, scalars, result_slot,
+                           result_indices, next_slot)
+
+
+def load_plan_inputs(plan, data_dict, slice_dict=None):
+    """
+    Takes the data of the input tensors of the plan, transposes and
+    slices it.
+
+    Parameters
+    ----------
+    plan : ContractionPlan
+              compiled plan
+    data_dict : dict
+              dictionary containing values for the placeholder Tensors
+    slice_dict : dict, optional
+              Current subtensor along the sliced variables
+              in the form {variable: slice}. Has to contain
+              the same variables as the one used in compilation
+    Returns
+    -------
+    arrays : list
+              input arrays of the plan
+    """
+    arrays = []
+    for plan_input in plan.inputs:
+        bounds = []
+        if plan_input.sliced_axes:
+            bounds = [slice(None)] * (plan_input.sliced_axes[-1][0] + 1)
+            for axis, var in plan_input.sliced_axes:
+                bounds[axis] = slice_dict[var]
+        arrays.append(tc.get_tensor_variant(
+            plan_input.data_key, data_dict[plan_input.data_key],
+            plan_input.transpose_order, bounds))
+    return arrays
+
+
+def _run_op(op, slots):
+    """
+    Executes a single operation of the plan on the slots
+    """
+    if op.kind == 'permutation':
+        bucket = []
+        for slot, subscripts, kind in zip(op.operands, op.subscripts,
+                                          op.kinds):
+            data = slots[slot]
+            indices = [opt.Var(idx, size=size)
+                       for idx, size in zip(subscripts, data.shape)]
+            bucket.append(opt.Tensor('T', indices, data=data, kind=kind))
+            slots[slot] = None
+        slots[op.result] = npfr.process_bucket_np_path(bucket).data
+        return
+    if op.kind == 'broadcast':
+        dense, diagonal = op.operands
+        slots[op.result] = slots[dense] * npfr.broadcast_data(
+            slots[diagonal], op.subscripts[1], op.subscripts[0])
+        slots[dense] = slots[diagonal] = None
+        return
+    if op.kind == 'wide':
+        slots[op.result] = npfr.einsum_sublist(
+            [(slots[slot], subscripts) for slot, subscripts
+             in zip(op.operands, op.subscripts)], op.output)
+        for slot in op.operands:
+            slots[slot] = None
+        return
+    args = []
+    for slot, subscripts in zip(op.operands, op.subscripts):
+        args.append(slots[slot])
+        args.append(subscripts)
+        # every slot is consumed exactly once, free it
+        slots[slot] = None
+    args.append(op.output)
+    result = np.einsum(*args)
+    # einsum of a single operand may return a view of the
+    # (read-only, cached) input
+    if len(op.operands) == 1 and np.may_share_memory(result, args[0]):
+        result = np.array(result)
+    slots[op.result] = result
+
+
+def _collect_result(plan, slots):
+    """
+    Multiplies scalars and the final tensor of the executed plan
+    """
+    result_data = None
+    for slot in plan.scalars:
+        if result_data is None:
+            result_data = slots[slot]
+        else:
+            result_data = result_data * slots[slot]
+    if plan.result_slot is not None:
+        if result_data is None:
+            result_data = slots[plan.result_slot]
+        else:
+            result_data = result_data * slots[plan.result_slot]
+
+    if result_data is None:
+        return None
+    # a result which is an input of the plan is cached data
+    if any(slots[slot] is result_data
+           for slot in range(len(plan.inputs))):
+        result_data = np.array(result_data)
+    return opt.Tensor('E', plan.result_indices, data=result_data)
+
+
+def _get_itemsize(arrays):
+    """
+    Size of the elements of the intermediates in bytes. Defaults
+    to the precision of :py:data:`system_defs.NP_ARRAY_TYPE`
+    """
+    if len(arrays) > 0:
+        return np.result_type(*arrays).itemsize
+    return np.dtype(defs.NP_ARRAY_TYPE).itemsize
+
+
+def _op_nbytes(op, itemsize):
+    return int(np.prod(op.shape, dtype=object)) * itemsize
+
+
+def _track_plan(plan, tracker, itemsize, run_op=None):
+    """
+    Walks the operations of the plan, registers their results
+    in the tracker before they are computed and frees the consumed
+    intermediates. Returns bytes of the intermediates left at
+    the end
+    """
+    n_inputs = len(plan.inputs)
+    nbytes = {}
+    for num, op in enumerate(plan.ops):
+        nbytes[op.result] = _op_nbytes(op, itemsize)
+        tracker.allocate(nbytes[op.result],
+                         f'Step {num} of the plan (bucket {op.bucket})')
+        if run_op is not None:
+            run_op(op)
+        for slot in op.operands:
+            if slot >= n_inputs:
+                tracker.free(nbytes.pop(slot))
+    return sum(nbytes.values())
+
+
+def get_plan_memory(plan, itemsize=None, budget=None):
+    """
+    Calculates the memory of live intermediates during the execution
+    of the plan from the shapes only, without running it.
+
+    Parameters
+    ----------
+    plan : ContractionPlan
+              compiled plan
+    itemsize : int, optional
+              size of array elements in bytes. Defaults to the
+              precision of :py:data:`system_defs.NP_ARRAY_TYPE`
+    budget : int, optional
+              memory budget. If set, :class:`MemoryBudgetError` is
+              raised if the plan does not fit
+
+    Returns
+    -------
+    tracker : MemoryTracker
+              tracker with the live memory after every step
+              in ``history`` and its maximum in ``peak``
+    """
+    if itemsize is None:
+        itemsize = _get_itemsize([])
+    tracker = MemoryTracker(budget)
+    tracker.free(_track_plan(plan, tracker, itemsize))
+    return tracker
+
+
+def execute_plan(plan, arrays, tracker=None):
+    """
+    Replays the plan against the input arrays.
+
+    Parameters
+    ----------
+    plan : ContractionPlan
+              compiled plan
+    arrays : list
+              input arrays as returned by :py:meth:`load_plan_inputs`
+    tracker : MemoryTracker, optional
+              if given, live memory is tracked and the budget of
+              the tracker is checked before each step. The tracker
+              can be shared by many executions to collect the peak
+
+    Returns
+    -------
+    result : optimizer.Tensor
+              same as returned by
+              :py:meth:`optimizer.bucket_elimination`
+    """
+    slots = list(arrays)
+    slots.extend([None] * (plan.n_slots - len(slots)))
+
+    if tracker is None:
+        for op in plan.ops:
+            _run_op(op, slots)
+    else:
+        itemsize = _get_itemsize(arrays)
+        # the result is handed over to the caller
+        tracker.free(_track_plan(
+            plan, tracker, itemsize,
+            run_op=lambda op: _run_op(op, slots)))
+
+    return _collect_result(plan, slots)
+
+
+class PlanTask(object):
+    """
+    Operations of a single bucket: a node of the elimination tree
+
+    Attributes
+    ----------
+    ops : list of PlanOp
+            operations of the bucket in the order of execution
+    dependencies : set
+            numbers of the tasks producing the operands
+    inputs : list
+            slots of the input arrays consumed by the bucket
+    output : int
+            slot of the result of the bucket
+    output_size : int
+            number of elements of the result
+    peak_size : int
+            largest number of elements of the intermediates
+            of the bucket which are alive at the same time,
+            including the operands of the operation in progress
+    """
+    __slots__ = ('ops', 'dependencies', 'inputs', 'output',
+                 'output_size', 'peak_size')
+
+    def __init__(self, ops, dependencies, inputs, output, output_size,
+                 peak_size):
+        self.ops = ops
+        self.dependencies = dependencies
+        self.inputs = inputs
+        self.output = output
+        self.output_size = output_size
+        self.peak_size = peak_size
+
+    def __repr__(self):
+        return 'PlanTask({} ops, deps={})'.format(
+            len(self.ops), sorted(self.dependencies))
+
+
+def get_plan_tasks(plan):
+    """
+    Splits the plan into tasks, one per processed bucket, and
+    finds dependencies between them. Tasks which do not depend on
+    each other are independent branches of the elimination tree and
+    can be executed concurrently.
+
+    Parameters
+    ----------
+    plan : ContractionPlan
+              compiled plan
+
+    Returns
+    -------
+    tasks : list of PlanTask
+              in a topological order
+    """
+    groups = []
+    for op in plan.ops:
+        if groups and groups[-1][0].bucket == op.bucket:
+            groups[-1].append(op)
+        else:
+            groups.append([op])
+
+    n_inputs = len(plan.inputs)
+    producer = {}
+    tasks = []
+    for num, ops in enumerate(groups):
+        internal = set(op.result for op in ops)
+        dependencies = set()
+        inputs = []
+        live = 0
+        peak = 0
+        sizes = {}
+        for op in ops:
+            size = int(np.prod(op.shape, dtype=object))
+            # operands are freed only after the result is computed
+            peak = max(peak, live + size)
+            for slot in op.operands:
+                if slot in producer:
+                    dependencies.add(producer[slot])
+                elif slot < n_inputs:
+                    inputs.append(slot)
+                live -= sizes.pop(slot, 0)
+            sizes[op.result] = size
+            live += size
+        output = ops[-1].result
+        for slot in internal:
+            producer[slot] = num
+        tasks.append(PlanTask(ops, dependencies, inputs, output,
+                              sizes[output], peak))
+    return tasks
+
+
+def execute_plan_threaded(plan, arrays, n_threads=None,
+                          max_concurrent_bytes=None):
+    """
+    Replays the plan executing independent branches of the
+    elimination tree concurrently on a pool of threads. Numpy
+    releases the GIL inside contractions, so buckets
+    of different branches overlap.
+
+    A task is admitted only if the live memory (results waiting for
+    their consumer or consumed by a running task, input arrays of
+    the running tasks and their peak memory) stays within
+    ``max_concurrent_bytes``. If nothing is running the next task is
+    always admitted, so the execution degrades to the sequential one
+    for small limits.
+
+    Buckets of uncompiled lists can be processed concurrently with
+    the ``n_threads`` argument of
+    :py:meth:`optimizer.bucket_elimination`.
+
+    Parameters
+    ----------
+    plan : ContractionPlan
+              compiled plan
+    arrays : list
+              input arrays as returned by :py:meth:`load_plan_inputs`
+    n_threads : int, optional
+              number of threads. Defaults to the number of CPUs
+    max_concurrent_bytes : int, optional
+              throttle on the live memory in bytes: tasks wait
+              until the memory is released. Unlimited by default
+
+    Returns
+    -------
+    result : optimizer.Tensor
+              same as returned by :py:meth:`execute_plan`
+    """
+    slots = list(arrays)
+    slots.extend([None] * (plan.n_slots - len(slots)))
+    itemsize = _get_itemsize(arrays)
+
+    tasks = get_plan_tasks(plan)
+    if max_concurrent_bytes is None:
+        max_concurrent_bytes = float('inf')
+
+    def run_task(task):
+        for op in task.ops:
+            _run_op(op, slots)
+
+    def get_task_bytes(task):
+        return task.peak_size * itemsize + sum(
+            arrays[slot].nbytes for slot in task.inputs)
+
+    n_pending = [len(task.dependencies) for task in tasks]
+    consumers = [[] for _ in tasks]
+    for num, task in enumerate(tasks):
+        for dep in task.dependencies:
+            consumers[dep].append(num)
+
+    # ready tasks are started in the order of buckets
+    ready = [num for num, count in enumerate(n_pending) if count == 0]
+    running = {}
+    live_bytes = 0
+    with futures.ThreadPoolExecutor(n_threads) as pool:
+        while ready or running:
+            while ready:
+                task = tasks[ready[0]]
+                task_bytes = get_task_bytes(task)
+                if (running and
+                        live_bytes + task_bytes > max_concurrent_bytes):
+                    break
+                num = ready.pop(0)
+                live_bytes += task_bytes
+                running[pool.submit(run_task, task)] = num
+
+            done, _ = futures.wait(running,
+                                   return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                num = running.pop(future)
+                future.result()
+                task = tasks[num]
+                # only the result of the task stays alive
+                live_bytes += (task.output_size * itemsize
+                               - get_task_bytes(task))
+                for dep in task.dependencies:
+                    live_bytes -= tasks[dep].output_size * itemsize
+                for consumer in consumers[num]:
+                    n_pending[consumer] -= 1
+                    if n_pending[consumer] == 0:
+                        ready.append(consumer)
+                ready.sort()
+
+    return _collect_result(plan, slots)
+
+
+class HoistedPlan(object):
+    """
+    Plan split into a part which does not depend on the slices of
+    the varying variables and the rest. The slice-invariant
+    intermediates are computed once with :py:meth:`precompute` and
+    only the slice-dependent operations are replayed for
+    every slice with :py:meth:`execute`. The invariant intermediates
+    consumed by the slice-dependent part are kept in memory.
+
+    >>> hoisted = HoistedPlan(plan, vars_parallel)
+    >>> invariants = hoisted.precompute(
+    ...     load_plan_inputs(plan, data_dict, slice_dict))
+    >>> for parallel_slice_dict in slices:
+    ...     slice_dict.update(parallel_slice_dict)
+    ...     result = hoisted.execute(
+    ...         load_plan_inputs(plan, data_dict, slice_dict), invariants)
+
+    Parameters
+    ----------
+    plan : ContractionPlan
+            compiled plan
+    varying_vars : list
+            sliced variables whose slices change between executions
+
+    Attributes
+    ----------
+    invariant_ops : list of PlanOp
+            operations independent of the varying variables
+    variant_ops : list of PlanOp
+            operations replayed for every slice
+    kept_slots : list
+            slots of the invariant intermediates used by the
+            slice-dependent part or by the result
+    """
+    def __init__(self, plan, varying_vars):
+        self.plan = plan
+        varying = set(map(int, varying_vars))
+        n_inputs = len(plan.inputs)
+
+        variant = set(
+            num for num, plan_input in enumerate(plan.inputs)
+            if any(int(var) in varying
+                   for _, var in plan_input.sliced_axes))
+        self.invariant_ops = []
+        self.variant_ops = []
+        for op in plan.ops:
+            if variant.intersection(op.operands):
+                variant.add(op.result)
+                self.variant_ops.append(op)
+            else:
+                self.invariant_ops.append(op)
+
+        needed = set(slot for op in self.variant_ops
+                     for slot in op.operands)
+        needed.update(plan.scalars)
+        if plan.result_slot is not None:
+            needed.add(plan.result_slot)
+        self.kept_slots = sorted(slot for slot in needed
+                                 if slot >= n_inputs
+                                 and slot not in variant)
+
+    def precompute(self, arrays):
+        """
+        Runs the slice-invariant operations
+
+        Parameters
+        ----------
+        arrays : list
+                input arrays as returned by :py:meth:`load_plan_inputs`
+                for any slice of the varying variables
+
+        Returns
+        -------
+        invariants : dict
+                intermediates needed by :py:meth:`execute`
+                in the form {slot: array}
+        """
+        slots = list(arrays)
+        slots.extend([None] * (self.plan.n_slots - len(slots)))
+        for op in self.invariant_ops:
+            _run_op(op, slots)
+        return {slot: slots[slot] for slot in self.kept_slots}
+
+    def execute(self, arrays, invariants):
+        """
+        Runs the slice-dependent operations
+
+        Parameters
+        ----------
+        arrays : list
+                input arrays as returned by :py:meth:`load_plan_inputs`
+        invariants : dict
+                as returned by :py:meth:`precompute`
+
+        Returns
+        -------
+        result : optimizer.Tensor
+                same as returned by :py:meth:`execute_plan`
+        """
+        slots = list(arrays)
+        slots.extend([None] * (self.plan.n_slots - len(slots)))
+        for slot, value in invariants.items():
+            slots[slot] = value
+        for op in self.variant_ops:
+            _run_op(op, slots)
+        return _collect_result(self.plan, slots)
+
+    def __repr__(self):
+        return 'HoistedPlan(invariant={}, variant={} ops)'.format(
+            len(self.invariant_ops), len(self.variant_ops))
+
+
+class IncrementalPlan(object):
+    """
+    Plan evaluated for many values of sliced variables (usually
+    bra variables of single bits), which recomputes only the
+    intermediates depending on changed values. Every intermediate is
+    keyed by the values of the variables it depends on, and
+    the intermediates consumed by operations with more dependencies
+    are kept between evaluations.
+
+    >>> incremental = IncrementalPlan(plan, bra_vars)
+    >>> for bits in get_trie_order(bitstrings, incremental.get_bit_costs()):
+    ...     slice_dict.update(utils.slice_from_bits(bits, bra_vars))
+    ...     result = incremental.execute(
+    ...         load_plan_inputs(plan, data_dict, slice_dict), bits)
+
+    Parameters
+    ----------
+    plan : ContractionPlan
+            compiled plan
+    varying_vars : list
+            sliced variables whose values change between evaluations
+
+    Attributes
+    ----------
+    n_executed : int
+            number of operations executed so far
+    n_skipped : int
+            number of operations reused from the cache so far
+    """
+    def __init__(self, plan, varying_vars):
+        self.plan = plan
+        position = {int(var): pos for pos, var in enumerate(varying_vars)}
+        self.n_bits = len(position)
+
+        dependencies = {}
+        for num, plan_input in enumerate(plan.inputs):
+            dependencies[num] = frozenset(
+                position[int(var)] for _, var in plan_input.sliced_axes
+                if int(var) in position)
+        consumer = {}
+        for op in plan.ops:
+            dependencies[op.result] = frozenset().union(
+                *(dependencies[slot] for slot in op.operands))
+            for slot in op.operands:
+                consumer[slot] = op.result
+        self._dependencies = {
+            op.result: tuple(sorted(dependencies[op.result]))
+            for op in plan.ops}
+
+        # operands with less dependencies than their consumers
+        # may be needed when they are not recomputed
+        final = set(plan.scalars)
+        if plan.result_slot is not None:
+            final.add(plan.result_slot)
+        self._kept = set(
+            op.result for op in plan.ops
+            if op.result in final
+            or dependencies[op.result] != dependencies[consumer[op.result]])
+
+        self._keys = {}
+        self._values = {}
+        self.n_executed = 0
+        self.n_skipped = 0
+
+    def get_bit_costs(self):
+        """
+        Estimates the work invalidated by a change of each of the
+        varying variables, as the total size of the results of
+        the dependent operations
+
+        Returns
+        -------
+        costs : numpy.array
+        """
+        costs = np.zeros(self.n_bits)
+        for op in self.plan.ops:
+            size = float(np.prod(op.shape, dtype=object))
+            for pos in self._dependencies[op.result]:
+                costs[pos] += size
+        return costs
+
+    def execute(self, arrays, bits):
+        """
+        Evaluates the plan, reusing intermediates of the
+        previous evaluations
+
+        Parameters
+        ----------
+        arrays : list
+                input arrays as returned by :py:meth:`load_plan_inputs`
+        bits : sequence
+                values of the varying variables, as used for slicing
+                the inputs
+
+        Returns
+        -------
+        result : optimizer.Tensor
+                same as returned by :py:meth:`execute_plan`
+        """
+        bits = tuple(int(bit) for bit in bits)
+        slots = list(arrays)
+        slots.extend([None] * (self.plan.n_slots - len(slots)))
+        for op in self.plan.ops:
+            key = tuple(bits[pos] for pos in self._dependencies[op.result])
+            if self._keys.get(op.result) == key:
+                if op.result in self._kept:
+                    slots[op.result] = self._values[op.result]
+                self.n_skipped += 1
+                continue
+            _run_op(op, slots)
+            self.n_executed += 1
+            self._keys[op.result] = key
+            if op.result in self._kept:
+                self._values[op.result] = slots[op.result]
+        return _collect_result(self.plan, slots)
+
+    def clear(self):
+        """
+        Drops the cached intermediates
+        """
+        self._keys.clear()
+        self._values.clear()
+
+
+def get_trie_order(bits, costs):
+    """
+    Orders bitstrings as leaves of a prefix trie in which the bits
+    with the largest cost are at the top, so consecutive
+    bitstrings differ mostly in cheap bits.
+
+    Parameters
+    ----------
+    bits : numpy.array
+            array of bitstrings of shape (n_bitstrings, n_bits)
+    costs : sequence
+            cost of a change of every bit
+
+    Returns
+    -------
+    order : numpy.array
+            permutation of the bitstrings
+    """
+    bits = np.asarray(bits)
+    # most expensive bit is the primary key, np.lexsort takes it last
+    columns = np.argsort(-np.asarray(costs), kind='stable')
+    return np.lexsort(tuple(bits[:, col] for col in columns[::-1]))
+
+
+def get_gray_code_order(costs):
+    """
+    Enumerates all bitstrings in the Gray code order, such that
+    the cheapest bit changes most often
+
+    Parameters
+    ----------
+    costs : sequence
+            cost of a change of every bit
+
+    Returns
+    -------
+    bits : numpy.array
+            array of shape (2**n_bits, n_bits)
+    """
+    n_bits = len(costs)
+    codes = np.arange(2**n_bits, dtype=np.uint64)
+    codes ^= codes >> np.uint64(1)
+    # bit k of the code goes to the k-th cheapest position
+    positions = np.argsort(np.asarray(costs), kind='stable')
+    bits = np.empty((len(codes), n_bits), dtype=np.uint8)
+    for k, pos in enumerate(positions):
+        bits[:, pos] = (codes >> np.uint64(k)) & np.uint64(1)
+    return bits
+
+
+def test_compiled_plan():
+    """
+    Compares replays of a compiled plan with the bucket elimination
+    """
+    import qtree.operators as ops
+    import qtree.graph_model as gm
+    import qtree.utils as utils
+
+    n_qubits = 5
+    circuit = ops.get_random_circuit(n_qubits, 6)
+    # permutation gates
+    circuit.insert(3, [ops.cX(0, 1), ops.X(2), ops.ccX(1, 3, 4)])
+    circuit.append([ops.X(0), ops.cX(3, 2)])
+    buckets, data_dict, bra_vars, ket_vars = opt.circ2buckets(
+        n_qubits, circuit)
+
+    # free the first bra qubit to test the final stage
+    free_bra_vars = bra_vars[:1]
+    bra_vars = bra_vars[1:]
+    graph = gm.make_clique_on(
+        gm.buckets2graph(buckets, ignore_variables=bra_vars+ket_vars),
+        free_bra_vars)
+    peo, _ = gm.get_upper_bound_peo(graph, method='min_fill')
+    peo = gm.get_equivalent_peo(graph, peo, free_bra_vars)
+
+    perm_buckets, perm_dict = opt.reorder_buckets(
+        buckets, bra_vars + ket_vars + peo)
+    ket_vars = sorted([perm_dict[idx] for idx in ket_vars], key=str)
+    bra_vars = sorted([perm_dict[idx] for idx in bra_vars], key=str)
+    free_bra_vars = [perm_dict[idx] for idx in free_bra_vars]
+
+    slice_dict = utils.slice_from_bits(0, ket_vars + bra_vars)
+    slice_dict.update({var: slice(None) for var in free_bra_vars})
+    plans = [compile_buckets(perm_buckets, slice_dict,
+                             n_var_nosum=len(free_bra_vars),
+                             path_method=method)
+             for method in ('sequential', 'auto')]
+    # diagonal gates are applied by broadcasting and variables
+    # of permutation gates are substituted
+    assert any(op.kind == 'broadcast' for op in plans[1].ops)
+    assert any(op.kind == 'permutation' for op in plans[1].ops)
+
+    for target_state in range(2**len(bra_vars)):
+        slice_dict.update(utils.slice_from_bits(target_state, bra_vars))
+        sliced_buckets = npfr.get_sliced_np_buckets(
+            perm_buckets, data_dict, slice_dict)
+        reference = opt.bucket_elimination(
+            sliced_buckets, npfr.process_bucket_np,
+            n_var_nosum=len(free_bra_vars))
+        for plan in plans:
+            result = execute_plan(
+                plan, load_plan_inputs(plan, data_dict, slice_dict))
+            assert np.allclose(result.data.flatten(),
+                               reference.data.flatten())
+
+        # threaded execution, unlimited and with the smallest limit
+        for max_concurrent_bytes in (None, 0):
+            result = execute_plan_threaded(
+                plans[1], load_plan_inputs(plans[1], data_dict,
+                                           slice_dict),
+                n_threads=4, max_concurrent_bytes=max_concurrent_bytes)
+            assert np.allclose(result.data.flatten(),
+                               reference.data.flatten())
+
+
+def test_plan_memory():
+    """
+    Checks the memory tracking and the budget
+    """
+    import qtree.operators as ops
+    import qtree.graph_model as gm
+
+    n_qubits = 6
+    circuit = ops.get_random_circuit(n_qubits, 8)
+    buckets, data_dict, bra_vars, ket_vars = opt.circ2buckets(
+        n_qubits, circuit, dtype=np.complex64)
+    graph = gm.buckets2graph(buckets,
+                             ignore_variables=bra_vars+ket_vars)
+    peo, _ = gm.get_upper_bound_peo(graph, method='min_fill')
+    perm_buckets, perm_dict = opt.reorder_buckets(
+        buckets, bra_vars + ket_vars + peo)
+    plan = compile_buckets(perm_buckets)
+    arrays = load_plan_inputs(plan, data_dict)
+
+    estimate = get_plan_memory(plan, itemsize=8)
+    tracker = MemoryTracker()
+    reference = execute_plan(plan, arrays, tracker=tracker)
+    assert tracker.peak == estimate.peak > 0
+    assert tracker.history == estimate.history
+    assert tracker.live == 0
+
+    # estimates and executions follow the same precision policy
+    policy_dict = opt.circ2buckets(n_qubits, circuit)[1]
+    tracker = MemoryTracker()
+    execute_plan(plan, load_plan_inputs(plan, policy_dict),
+                 tracker=tracker)
+    assert get_plan_memory(plan).peak == tracker.peak
+
+    # the budget is checked before the allocation
+    tracker = MemoryTracker(budget=estimate.peak)
+    result = execute_plan(plan, arrays, tracker=tracker)
+    assert np.allclose(result.data, reference.data)
+    try:
+        execute_plan(plan, arrays,
+                     tracker=MemoryTracker(budget=estimate.peak - 1))
+    except MemoryBudgetError as error:
+        assert error.required == estimate.peak
+    else:
+        assert False, 'Budget was not enforced'
+
+
+def test_plan_tasks():
+    """
+    Checks that tasks of the plan cover all operations and
+    are topologically ordered
+    """
+    import qtree.operators as ops
+    import qtree.graph_model as gm
+
+    n_qubits = 6
+    circuit = ops.get_random_circuit(n_qubits, 8)
+    buckets, data_dict, bra_vars, ket_vars = opt.circ2buckets(
+        n_qubits, circuit)
+    graph = gm.buckets2graph(buckets,
+                             ignore_variables=bra_vars+ket_vars)
+    peo, _ = gm.get_upper_bound_peo(graph, method='min_fill')
+    perm_buckets, perm_dict = opt.reorder_buckets(
+        buckets, bra_vars + ket_vars + peo)
+    plan = compile_buckets(perm_buckets)
+
+    tasks = get_plan_tasks(plan)
+    assert sum(len(task.ops) for task in tasks) == len(plan.ops)
+    inputs = sorted(slot for task in tasks for slot in task.inputs)
+    assert inputs == sorted(set(inputs))
+    assert all(slot < len(plan.inputs) for slot in inputs)
+    for num, task in enumerate(tasks):
+        assert all(dep < num for dep in task.dependencies)
+        assert task.peak_size >= task.output_size
+    # the elimination tree has independent branches
+    assert any(len(task.dependencies) == 0 for task in tasks[1:])
+
+
+def test_hoisted_plan():
+    """
+    Compares hoisted execution over slices with the full one
+    """
+    import qtree.operators as ops
+    import qtree.graph_model as gm
+    import qtree.utils as utils
+    import functools
+
+    n_qubits = 6
+    circuit = ops.get_random_circuit(n_qubits, 8)
+    buckets, data_dict, bra_vars, ket_vars = opt.circ2buckets(
+        n_qubits, circuit, dtype=np.complex128)
+    graph = gm.buckets2graph(buckets,
+                             ignore_variables=bra_vars+ket_vars)
+    peo_function = functools.partial(gm.get_upper_bound_peo,
+                                     method='min_fill')
+    vars_parallel, graph_reduced = gm.split_graph_by_metric_greedy(
+        graph, 2, metric_fn=gm.splitters.get_node_by_mem_reduction,
+        peo_function=peo_function)
+    peo, _ = peo_function(graph_reduced)
+
+    perm_buckets, perm_dict = opt.reorder_buckets(
+        buckets, ket_vars + bra_vars + vars_parallel + peo)
+    ket_vars = [perm_dict[var] for var in ket_vars]
+    bra_vars = [perm_dict[var] for var in bra_vars]
+    vars_parallel = [perm_dict[var] for var in vars_parallel]
+
+    slice_dict = utils.slice_from_bits(0, ket_vars)
+    slice_dict.update(utils.slice_from_bits(3, bra_vars))
+    slice_dict.update(utils.slice_from_bits(0, vars_parallel))
+    plan = compile_buckets(perm_buckets, slice_dict)
+
+    hoisted = HoistedPlan(plan, vars_parallel)
+    assert len(hoisted.invariant_ops) > 0
+    assert (len(hoisted.invariant_ops) + len(hoisted.variant_ops)
+            == len(plan.ops))
+    invariants = hoisted.precompute(
+        load_plan_inputs(plan, data_dict, slice_dict))
+
+    reference = 0
+    total = 0
+    for parallel_slice_dict in utils.slice_values_generator(
+            vars_parallel, 0, 1):
+        slice_dict.update(parallel_slice_dict)
+        arrays = load_plan_inputs(plan, data_dict, slice_dict)
+        reference += execute_plan(plan, arrays).data
+        total += hoisted.execute(arrays, invariants).data
+    assert np.isclose(total, reference)
+
+    # nothing varies, everything is precomputed
+    hoisted = HoistedPlan(plan, [])
+    assert len(hoisted.variant_ops) == 0
+    arrays = load_plan_inputs(plan, data_dict, slice_dict)
+    assert np.isclose(
+        hoisted.execute(arrays, hoisted.precompute(arrays)).data,
+        execute_plan(plan, arrays).data)
+
+
+def test_incremental_plan():
+    """
+    Checks the reuse of intermediates in incremental evaluation
+    """
+    import qtree.operators as ops
+    import qtree.graph_model as gm
+    import qtree.utils as utils
+
+    n_qubits = 6
+    circuit = ops.get_random_circuit(n_qubits, 6)
+    buckets, data_dict, bra_vars, ket_vars = opt.circ2buckets(
+        n_qubits, circuit, dtype=np.complex128)
+    graph = gm.buckets2graph(buckets,
+                             ignore_variables=bra_vars+ket_vars)
+    peo, _ = gm.get_upper_bound_peo(graph, method='min_fill')
+    perm_buckets, perm_dict = opt.reorder_buckets(
+        buckets, bra_vars + ket_vars + peo)
+    ket_vars = [perm_dict[var] for var in ket_vars]
+    bra_vars = [perm_dict[var] for var in bra_vars]
+
+    slice_dict = utils.slice_from_bits(0, ket_vars + bra_vars)
+    plan = compile_buckets(perm_buckets, slice_dict)
+    incremental = IncrementalPlan(plan, bra_vars)
+    costs = incremental.get_bit_costs()
+
+    bits = get_gray_code_order(costs)
+    assert len(np.unique(bits, axis=0)) == 2**n_qubits
+    assert np.all(np.abs(np.diff(bits.astype(int), axis=0)).sum(1) == 1)
+    # the cheapest bit changes in every second step
+    cheapest = np.argmin(costs)
+    assert np.sum(np.diff(bits[:, cheapest]) != 0) == 2**(n_qubits-1)
+
+    for bitstring in bits:
+        slice_dict.update({var: slice(int(bit), int(bit)+1)
+                           for var, bit in zip(bra_vars, bitstring)})
+        arrays = load_plan_inputs(plan, data_dict, slice_dict)
+        result = incremental.execute(arrays, bitstring)
+        assert np.isclose(result.data, execute_plan(plan, arrays).data)
+    assert incremental.n_skipped > 0
+    assert incremental.n_executed < len(bits) * len(plan.ops)
+
+    bits = np.random.RandomState(0).randint(2, size=(30, n_qubits))
+    order = get_trie_order(bits, costs)
+    assert sorted(order) == list(range(len(bits)))
+    primary = np.argmax(costs)
+    assert np.all(np.diff(bits[order, primary].astype(int)) >= 0)
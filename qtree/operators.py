@@ -3,6 +3,7 @@ This module implements quantum gates from the CMON set of Google
 """
 import numpy as np
 import re
+import hashlib
 import cirq
 
 from fractions import Fraction
@@ -32,6 +33,15 @@ class Gate:
             Tuple of ints which states what qubit's bases are changed
             (along which qubits the gate is not diagonal).
 
+    is_diagonal : bool
+            True if the gate does not change any basis
+
+    is_permutation : bool
+            True if the gate permutes basis states, possibly
+            with phases (like X, cX). Each entry of its tensor is
+            determined by the others, so it can be applied by
+            reindexing instead of contraction
+
     cirq_op: Cirq.GridQubit
             Cirq 2D gate. Used for unit tests. Optional
 
@@ -114,6 +124,17 @@ class Gate:
     def changed_qubits(self):
         return tuple(self._qubits[idx] for idx in self._changes_qubits)
 
+    @property
+    def is_diagonal(self):
+        """
+        True if the gate does not change the basis of any qubit
+        (like Z, T, cZ). Its tensor then holds only the diagonal
+        """
+        return len(self._changes_qubits) == 0
+
+    # Permutation gates override this
+    is_permutation = False
+
     def to_cirq_1d_circ_op(self):
         return self.cirq_op(
             *[cirq.LineQubit(qubit) for qubit in self._qubits]
@@ -247,7 +268,7 @@ class M(Gate):
     it forces the introduction of a variable in the graphical model
     """
     def gen_tensor(self):
-        return np.array([[1, 0], [0, 1]], dtype=defs.NP_ARRAY_TYPE)
+        return np.array([[1, 0], [0, 1]], dtype=defs.NP_GATE_TYPE)
 
     _changes_qubits = (0, )
     cirq_op = cirq.I
@@ -255,7 +276,7 @@ class M(Gate):
 
 class I(Gate):
     def gen_tensor(self):
-        return np.array([1, 1], dtype=defs.NP_ARRAY_TYPE)
+        return np.array([1, 1], dtype=defs.NP_GATE_TYPE)
 
     _changes_qubits = tuple()
     cirq_op = cirq.I
@@ -268,7 +289,7 @@ class H(Gate):
     def gen_tensor(self):
         return 1/np.sqrt(2) * np.array([[1,  1],
                                         [1, -1]],
-                                       dtype=defs.NP_ARRAY_TYPE)
+                                       dtype=defs.NP_GATE_TYPE)
     _changes_qubits = (0, )
     cirq_op = cirq.H
 
@@ -279,7 +300,7 @@ class Z(Gate):
     """
     def gen_tensor(self):
         return np.array([1, -1],
-                        dtype=defs.NP_ARRAY_TYPE)
+                        dtype=defs.NP_GATE_TYPE)
 
     _changes_qubits = tuple()
     cirq_op = cirq.Z
@@ -293,7 +314,7 @@ class cZ(Gate):
     def gen_tensor(self):
         return np.array([[1, 1],
                          [1, -1]],
-                        dtype=defs.NP_ARRAY_TYPE)
+                        dtype=defs.NP_GATE_TYPE)
     _changes_qubits = tuple()
     cirq_op = cirq.CZ
 
@@ -304,7 +325,7 @@ class T(Gate):
     """
     def gen_tensor(self):
         return np.array([1, np.exp(1.j*np.pi/4)],
-                        dtype=defs.NP_ARRAY_TYPE)
+                        dtype=defs.NP_GATE_TYPE)
 
     _changes_qubits = tuple()
     cirq_op = cirq.T
@@ -317,7 +338,7 @@ class Tdag(Gate):
     def gen_tensor(self):
         pass
         return np.array([1, np.exp(-1.j*np.pi/4)],
-                        dtype=defs.NP_ARRAY_TYPE)
+                        dtype=defs.NP_GATE_TYPE)
 
     _changes_qubits = tuple()
     cirq_op = cirq.inverse(cirq.T)
@@ -329,7 +350,7 @@ class S(Gate):
     """
     def gen_tensor(self):
         return np.array([1, 1j],
-                        dtype=defs.NP_ARRAY_TYPE)
+                        dtype=defs.NP_GATE_TYPE)
 
     _changes_qubits = tuple()
     cirq_op = cirq.S
@@ -341,7 +362,7 @@ class Sdag(Gate):
     """
     def gen_tensor(self):
         return np.array([1, -1j],
-                        dtype=defs.NP_ARRAY_TYPE)
+                        dtype=defs.NP_GATE_TYPE)
 
     _changes_qubits = tuple()
     cirq_op = cirq.inverse(cirq.S)
@@ -356,7 +377,7 @@ class X_1_2(Gate):
         return (Fraction(1, 2) *
                 np.array([[1 + 1j, 1 - 1j],
                           [1 - 1j, 1 + 1j]])
-        ).astype(defs.NP_ARRAY_TYPE)
+        ).astype(defs.NP_GATE_TYPE)
 
     _changes_qubits = (0, )
 
@@ -371,7 +392,7 @@ class Y_1_2(Gate):
         return (Fraction(1, 2) *
                 np.array([[1 + 1j, -1 - 1j],
                           [1 + 1j, 1 + 1j]])
-        ).astype(defs.NP_ARRAY_TYPE)
+        ).astype(defs.NP_GATE_TYPE)
 
     _changes_qubits = (0, )
 
@@ -385,7 +406,7 @@ class W_1_2(Gate):
         return (1/np.sqrt(2)*
                 np.array([[1 , -sqj],
                           [nsqj, 1]])
-        ).astype(defs.NP_ARRAY_TYPE)
+        ).astype(defs.NP_GATE_TYPE)
 
     _changes_qubits = (0, )
 
@@ -396,9 +417,10 @@ class X(Gate):
     def gen_tensor(self):
         return np.array([[0, 1],
                          [1, 0]],
-                        dtype=defs.NP_ARRAY_TYPE)
+                        dtype=defs.NP_GATE_TYPE)
 
     _changes_qubits = (0, )
+    is_permutation = True
 
     def cirq_op(self, x): return cirq.X(x)
 
@@ -411,15 +433,20 @@ class cX(Gate):
                           [1., 0.]]])
 
     _changes_qubits = (1, )
+    is_permutation = True
     cirq_op = cirq.CNOT
 
 
 class ccX(Gate):
     def gen_tensor(self):
-        #TODO: tensor shapes
-        return np.array([])
+        tensor = np.zeros([2] * 4)
+        tensor[..., :, :] = np.eye(2)
+        tensor[1, 1] = [[0., 1.],
+                        [1., 0.]]
+        return tensor
 
     _changes_qubits = (2, )
+    is_permutation = True
     cirq_op = cirq.CCNOT
 
 
@@ -427,9 +454,10 @@ class Y(Gate):
     def gen_tensor(self):
         return np.array([[0, -1j],
                          [1j, 0]],
-                        dtype=defs.NP_ARRAY_TYPE)
+                        dtype=defs.NP_GATE_TYPE)
 
     _changes_qubits = (0, )
+    is_permutation = True
 
     def cirq_op(self, x): return cirq.Y(x)
 
@@ -606,6 +634,44 @@ class SWAP(Gate):
 
 
 
+class FusedGate(Gate):
+    """
+    Gate with a precomputed tensor, usually a product of
+    several gates. See :py:meth:`circuit_passes.fuse_gates`.
+    Qubits in ``changed_qubits`` have two indices
+    (output, input) in the tensor, the others only one.
+
+    Parameters
+    ----------
+    qubits: ints
+            qubits the gate acts on
+    tensor: numpy.array
+            tensor of the gate in the layout of the other gates
+    changes_qubits: tuple
+            positions (in qubits) of the qubits whose basis is changed
+    matrix: numpy.array, optional
+            full matrix of the gate of shape (2**n, 2**n), used
+            to build the Cirq operation
+    """
+    def __init__(self, *qubits, tensor, changes_qubits, matrix=None):
+        self._tensor = tensor
+        self._changes_qubits = tuple(changes_qubits)
+        self._matrix = matrix
+        super().__init__(*qubits)
+        # the name is a part of the key of the tensor data
+        self.name = 'F{}_{}'.format(
+            len(qubits), hashlib.sha1(
+                tensor.tobytes()
+                + str(self._changes_qubits).encode()).hexdigest()[:12])
+
+    def gen_tensor(self):
+        return self._tensor
+
+    def to_cirq_1d_circ_op(self):
+        return cirq.MatrixGate(self._matrix).on(
+            *[cirq.LineQubit(qubit) for qubit in self._qubits])
+
+
 class U(ParametricGate):
     """ Arbitrary single qubit unitary operator
     U(t, p, l) =
@@ -790,6 +856,46 @@ def circuit_to_text(circuit, n_qubits):
     return file
 
 
+def get_random_circuit(qubit_count, depth, seed=0):
+    """
+    Generates a random circuit in the style of the Google supremacy
+    circuits on a line of qubits: a layer of Hadamards followed by
+    layers of :math:`cZ` gates on alternating pairs of qubits and
+    random single qubit gates.
+
+    Parameters
+    ----------
+    qubit_count : int
+             number of qubits
+    depth : int
+             number of layers after the initial Hadamard layer
+    seed : int, default 0
+             random seed
+
+    Returns
+    -------
+    circuit : list of lists
+            quantum circuit as a list of layers of gates
+    """
+    rng = np.random.RandomState(seed)
+    single_qubit_gates = [T, X_1_2, Y_1_2, W_1_2, H, Z]
+
+    circuit = [[H(qubit) for qubit in range(qubit_count)]]
+    for layer_idx in range(depth):
+        layer = []
+        for qubit in range(layer_idx % 2, qubit_count - 1, 2):
+            layer.append(cZ(qubit, qubit + 1))
+        busy_qubits = set(qubit for op in layer for qubit in op.qubits)
+        for qubit in range(qubit_count):
+            if qubit not in busy_qubits:
+                gate_cls = single_qubit_gates[
+                    rng.randint(len(single_qubit_gates))]
+                layer.append(gate_cls(qubit))
+        circuit.append(layer)
+
+    return circuit
+
+
 def read_qasm_file(filename, max_ins=None):
     """
     Read circuit file in the QASM format and return
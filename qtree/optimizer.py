@@ -7,8 +7,12 @@ go here.
 import functools
 import itertools
 import random
+import concurrent.futures as futures
+import numpy as np
 import networkx as nx
 import qtree.operators as ops
+import qtree.system_defs as defs
+import qtree.tensor_cache as tc
 
 from qtree.logger_setup import log
 
@@ -85,7 +89,7 @@ class Tensor(object):
     tensors kind of symbolically and to not move around numpy arrays
     """
     def __init__(self, name, indices,
-                 data_key=None, data=None):
+                 data_key=None, data=None, kind='dense'):
         """
         Initialize the tensor
         name: str,
@@ -100,11 +104,19 @@ class Tensor(object):
         data: np.array
               Actual data of the tensor. Default None.
               Usually is not supplied at initialization.
+        kind: str, optional
+              'dense' (default), 'diagonal' or 'permutation'.
+              Diagonal tensors come from gates which do not change
+              the basis, hold the diagonal of the gate and can be
+              applied by elementwise multiplication. Permutation
+              tensors have a single nonzero entry along their
+              indices and can be applied by reindexing.
         """
         self._name = name
         self._indices = tuple(indices)
         self._data_key = data_key
         self._data = data
+        self._kind = kind
         self._order_key = hash((self.data_key, self.name))
 
     @property
@@ -127,7 +139,12 @@ class Tensor(object):
     def data(self):
         return self._data
 
-    def copy(self, name=None, indices=None, data_key=None, data=None):
+    @property
+    def kind(self):
+        return self._kind
+
+    def copy(self, name=None, indices=None, data_key=None, data=None,
+             kind=None):
         if name is None:
             name = self.name
         if indices is None:
@@ -136,7 +153,9 @@ class Tensor(object):
             data_key = self.data_key
         if data is None:
             data = self.data
-        return Tensor(name, indices, data_key, data)
+        if kind is None:
+            kind = self.kind
+        return Tensor(name, indices, data_key, data, kind)
 
     def __str__(self):
         return '{}({})'.format(self._name, ','.join(
@@ -167,7 +186,8 @@ class Tensor(object):
                 and self.data == other.data)
 
 
-def circ2buckets(qubit_count, circuit, pdict={}, max_depth=None):
+def circ2buckets(qubit_count, circuit, pdict={}, max_depth=None,
+                 dtype=None):
     """
     Takes a circuit in the form of list of lists, builds
     corresponding buckets. Buckets contain Tensors
@@ -188,12 +208,18 @@ def circ2buckets(qubit_count, circuit, pdict={}, max_depth=None):
 
     max_depth : int
             Maximal depth of the circuit which should be used
+    dtype : numpy.dtype, optional
+            Precision of the tensor data. Defaults to
+            :py:data:`system_defs.NP_ARRAY_TYPE`
     Returns
     -------
     buckets : list of lists
             list of lists (buckets)
     data_dict : dict
-            Dictionary with all tensor data
+            Dictionary with all tensor data. The arrays are
+            read-only and shared with other circuits through
+            :py:mod:`tensor_cache`. Copy an array before
+            modifying it
     bra_variables : list
             variables of the output qubits
     ket_variables: list
@@ -204,6 +230,8 @@ def circ2buckets(qubit_count, circuit, pdict={}, max_depth=None):
 
     if max_depth is None:
         max_depth = len(circuit)
+    if dtype is None:
+        dtype = defs.NP_ARRAY_TYPE
 
     data_dict = {}
 
@@ -272,11 +300,17 @@ def circ2buckets(qubit_count, circuit, pdict={}, max_depth=None):
             data_key = (op.name,
                         hash((op.name, tuple(op.parameters.items()))))
             # Build a tensor
+            if op.is_diagonal:
+                kind = 'diagonal'
+            elif op.is_permutation:
+                kind = 'permutation'
+            else:
+                kind = 'dense'
             t = Tensor(op.name, variables,
-                       data_key=data_key)
+                       data_key=data_key, kind=kind)
 
             # Insert tensor data into data dict
-            data_dict[data_key] = op.gen_tensor()
+            data_dict[data_key] = tc.get_gate_tensor(op, dtype)
 
             # Append tensor to buckets
             # first_qubit_var = layer_variables[op.qubits[0]]
@@ -296,8 +330,7 @@ def circ2buckets(qubit_count, circuit, pdict={}, max_depth=None):
 
     op = ops.M(0)  # create a single measurement gate object
     data_key = (op.name, hash((op.name, tuple(op.parameters.items()))))
-    data_dict.update(
-        {data_key: op.gen_tensor()})
+    data_dict.update({data_key: tc.get_gate_tensor(op, dtype)})
 
     for qubit in range(qubit_count):
         var = layer_variables[qubit]
@@ -316,8 +349,276 @@ def circ2buckets(qubit_count, circuit, pdict={}, max_depth=None):
     return buckets, data_dict, bra_variables, ket_variables
 
 
+class MemoryBudgetError(MemoryError):
+    """
+    Raised before a contraction step which would take the memory
+    of live intermediates over the budget
+
+    Attributes
+    ----------
+    required : int
+            live memory in bytes including the requested step
+    budget : int
+            memory budget in bytes
+    """
+    def __init__(self, message, required, budget):
+        super().__init__(message)
+        self.required = required
+        self.budget = budget
+
+
+class MemoryTracker(object):
+    """
+    Tracks memory of the intermediate arrays during bucket
+    elimination or the execution of plans. The memory of the
+    inputs, which are views of the data dictionary, is not counted.
+
+    Parameters
+    ----------
+    budget : int, optional
+            Hard limit on the live memory in bytes. An allocation
+            exceeding it raises :class:`MemoryBudgetError`
+            before the array is created
+
+    Attributes
+    ----------
+    live : int
+            memory of currently live intermediates in bytes
+    peak : int
+            largest live memory seen
+    history : list
+            live memory after each step
+    """
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.live = 0
+        self.peak = 0
+        self.history = []
+
+    def allocate(self, nbytes, label=''):
+        """
+        Registers an allocation of nbytes
+        """
+        required = self.live + nbytes
+        if self.budget is not None and required > self.budget:
+            raise MemoryBudgetError(
+                f'{label} needs {nbytes} bytes with {self.live} bytes'
+                f' live, which exceeds the memory budget of'
+                f' {self.budget} bytes. Slice more variables',
+                required, self.budget)
+        self.live = required
+        self.peak = max(self.peak, self.live)
+        self.history.append(self.live)
+
+    def free(self, nbytes):
+        """
+        Registers a deallocation of nbytes
+        """
+        self.live -= nbytes
+
+    def __repr__(self):
+        return 'MemoryTracker(live={}, peak={}, budget={})'.format(
+            self.live, self.peak, self.budget)
+
+
+def _get_itemsize(buckets):
+    """
+    Size in bytes of the elements of the intermediates
+    """
+    dtypes = set(tensor.data.dtype for bucket in buckets
+                 for tensor in bucket
+                 if isinstance(tensor.data, np.ndarray))
+    if len(dtypes) == 0:
+        return np.dtype(defs.NP_ARRAY_TYPE).itemsize
+    return functools.reduce(np.promote_types, dtypes).itemsize
+
+
+def _get_dims(tensors):
+    """
+    Sizes of the indices of the tensors by their numbers
+    """
+    dims = {}
+    for tensor in tensors:
+        shape = getattr(tensor.data, 'shape', None)
+        if shape is None or len(shape) != len(tensor.indices):
+            shape = tensor.shape
+        dims.update(zip(map(int, tensor.indices), shape))
+    return dims
+
+
+def _get_result_bytes(bucket, itemsize, no_sum=False):
+    """
+    Size in bytes of the result of processing the bucket,
+    found before it is processed
+    """
+    dims = _get_dims(bucket)
+    # the variable of the bucket is its lowest index
+    if not no_sum and len(dims) > 0:
+        dims.pop(min(dims))
+    return int(np.prod(list(dims.values()), dtype=object)) * itemsize
+
+
+def get_elimination_tree(buckets, n_var_contract):
+    """
+    Finds the elimination tree of the buckets without processing
+    them. The result of a bucket goes to the bucket of its lowest
+    index, so buckets in different branches of the tree do not
+    depend on each other.
+
+    Parameters
+    ----------
+    buckets : list of lists
+    n_var_contract : int
+              number of buckets to process
+
+    Returns
+    -------
+    targets : list
+              bucket receiving the result of every processed bucket,
+              None if the result is a scalar or the bucket is empty
+    dependencies : list of lists
+              processed buckets sending their results to every bucket
+    result_sizes : list
+              number of elements of the result of every processed
+              bucket
+    """
+    # sizes of the indices of the results sent to every bucket
+    received = [{} for _ in buckets]
+    targets = [None] * n_var_contract
+    dependencies = [[] for _ in buckets]
+    result_sizes = [0] * n_var_contract
+    for n, bucket in enumerate(buckets[:n_var_contract]):
+        if len(bucket) == 0 and len(dependencies[n]) == 0:
+            continue
+        dims = received[n]
+        dims.update(_get_dims(bucket))
+        # the variable of the bucket is its lowest index
+        if len(dims) > 0:
+            dims.pop(min(dims))
+        result_sizes[n] = int(np.prod(list(dims.values()), dtype=object))
+        if len(dims) > 0:
+            targets[n] = min(dims)
+            received[targets[n]].update(dims)
+            dependencies[targets[n]].append(n)
+    return targets, dependencies, result_sizes
+
+
+def _fits_budget(tracker, nbytes):
+    """
+    Checks if nbytes can be allocated in the tracker
+    """
+    return tracker.budget is None or tracker.live + nbytes <= tracker.budget
+
+
+def _eliminate_concurrently(buckets, process_bucket_fn, n_var_contract,
+                            n_threads, max_concurrent_bytes,
+                            tracker, itemsize, tracked):
+    """
+    Processes the first n_var_contract buckets on a pool of threads.
+    A bucket is started once all results sent to it are
+    computed. It is admitted only if the memory of the live
+    intermediates (results waiting for their bucket and the inputs
+    and results of the running buckets) stays within
+    max_concurrent_bytes. If nothing is running the next bucket
+    is always admitted. Results are allocated in the tracker
+    when their buckets are admitted, buckets exceeding its budget
+    wait for the running ones. The results moved to the rest
+    are recorded in tracked.
+    Returns new buckets with the results of the processed
+    buckets moved to the rest and the product of scalar results
+    """
+    targets, dependencies, result_sizes = get_elimination_tree(
+        buckets, n_var_contract)
+    if max_concurrent_bytes is None:
+        max_concurrent_bytes = float('inf')
+
+    def get_input_bytes(n):
+        return sum(getattr(tensor.data, 'nbytes', 0)
+                   for tensor in buckets[n])
+
+    # results sent to every bucket, by the number of the sender
+    received = [{} for _ in buckets]
+    scalars = {}
+
+    def run_bucket(n):
+        bucket = list(buckets[n]) + [received[n][sender] for sender
+                                     in sorted(received[n])]
+        return process_bucket_fn(bucket)
+
+    n_pending = [len(senders) for senders in dependencies]
+    ready = [n for n in range(n_var_contract)
+             if n_pending[n] == 0 and len(buckets[n]) > 0]
+    running = {}
+    live_bytes = 0
+    with futures.ThreadPoolExecutor(n_threads) as pool:
+        while ready or running:
+            while ready:
+                n = ready[0]
+                task_bytes = (result_sizes[n] * itemsize
+                              + get_input_bytes(n))
+                # the budget of the tracker is a hard limit, wait
+                # for the running buckets before failing
+                if running and (
+                        live_bytes + task_bytes > max_concurrent_bytes
+                        or not _fits_budget(
+                            tracker, result_sizes[n] * itemsize)):
+                    break
+                tracker.allocate(result_sizes[n] * itemsize,
+                                 f'Bucket {n}')
+                ready.pop(0)
+                live_bytes += task_bytes
+                running[pool.submit(run_bucket, n)] = n
+
+            done, _ = futures.wait(running,
+                                   return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                n = running.pop(future)
+                tensor = future.result()
+                # inputs are released, the result waits for its bucket
+                live_bytes -= get_input_bytes(n)
+                for sender in received[n]:
+                    live_bytes -= result_sizes[sender] * itemsize
+                    tracker.free(result_sizes[sender] * itemsize)
+                received[n] = {}
+
+                if len(tensor.indices) == 0:
+                    live_bytes -= result_sizes[n] * itemsize
+                    tracker.free(result_sizes[n] * itemsize)
+                    scalars[n] = tensor
+                    continue
+                target = min(map(int, tensor.indices))
+                if target != targets[n]:
+                    raise ValueError(
+                        f'Result of bucket {n} has indices'
+                        f' {tensor.indices}, expected to go to'
+                        f' bucket {targets[n]}')
+                received[target][n] = tensor
+                if target < n_var_contract:
+                    n_pending[target] -= 1
+                    if n_pending[target] == 0:
+                        ready.append(target)
+                else:
+                    tracked[id(tensor)] = result_sizes[n] * itemsize
+                ready.sort()
+
+    new_buckets = [[] for _ in range(n_var_contract)]
+    for bucket, results in zip(buckets[n_var_contract:],
+                               received[n_var_contract:]):
+        new_buckets.append(list(bucket) + [results[sender] for sender
+                                           in sorted(results)])
+    result = None
+    for n in sorted(scalars):
+        if result is not None:
+            result *= scalars[n]
+        else:
+            result = scalars[n]
+    return new_buckets, result
+
+
 def bucket_elimination(buckets, process_bucket_fn,
-                       n_var_nosum=0):
+                       n_var_nosum=0, process_final_fn=None,
+                       n_threads=1, max_concurrent_bytes=None,
+                       tracker=None):
     """
     Algorithm to evaluate a contraction of a large number of tensors.
     The variables to contract over are assigned ``buckets`` which
@@ -328,11 +629,35 @@ def bucket_elimination(buckets, process_bucket_fn,
     Parameters
     ----------
     buckets : list of lists
+              buckets to process. They are not modified
     process_bucket_fn : function
               function that will process this kind of buckets
     n_var_nosum : int, optional
               number of variables that have to be left in the
               result. Expected at the end of bucket list
+    process_final_fn : function, optional
+              function which multiplies the tensors left in the
+              buckets of the not summed variables (and the scalar
+              result, if any). By default they are processed with
+              process_bucket_fn(rest, no_sum=True)
+    n_threads : int, default 1
+              number of threads processing buckets. If it is not 1,
+              buckets of independent branches of the elimination
+              tree are processed concurrently, see
+              :py:meth:`get_elimination_tree`. None stands for
+              the number of CPUs
+    max_concurrent_bytes : int, optional
+              throttle on the memory of live intermediates in bytes
+              if buckets are processed concurrently: buckets wait
+              until the memory is released. Unlimited by default
+    tracker : MemoryTracker, optional
+              records the memory of intermediates, which is
+              computed from the shape of each result before its
+              bucket is processed. If the tracker has a budget,
+              :class:`MemoryBudgetError` is raised before a bucket
+              exceeding it is processed. Concurrent buckets wait
+              instead while other buckets are running. The peak
+              is available in the tracker afterwards
     Returns
     -------
     result : numpy.array
@@ -340,17 +665,40 @@ def bucket_elimination(buckets, process_bucket_fn,
     # import pdb
     # pdb.set_trace()
     n_var_contract = len(buckets) - n_var_nosum
+    if tracker is None:
+        tracker = MemoryTracker()
+    itemsize = _get_itemsize(buckets)
+    # bytes of the live intermediates by their ids
+    tracked = {}
 
     result = None
+    if n_threads != 1:
+        buckets, result = _eliminate_concurrently(
+            buckets, process_bucket_fn, n_var_contract,
+            n_threads, max_concurrent_bytes, tracker, itemsize, tracked)
+        # the buckets to contract are empty now
+    else:
+        # processed tensors are released from a copy, the buckets
+        # of the caller are not modified
+        buckets = [list(bucket) for bucket in buckets]
     for n, bucket in enumerate(buckets[:n_var_contract]):
         if len(bucket) > 0:
+            nbytes = _get_result_bytes(bucket, itemsize)
+            tracker.allocate(nbytes, f'Bucket {n}')
             tensor = process_bucket_fn(bucket)
+            # release the processed tensors
+            buckets[n] = []
+            for processed in bucket:
+                tracker.free(tracked.pop(id(processed), 0))
             if len(tensor.indices) > 0:
                 # tensor is not scalar.
-                # Move it to appropriate bucket
-                first_index = int(tensor.indices[0])
+                # Move it to appropriate bucket. Indices of the
+                # result may be unsorted, take the lowest one
+                first_index = min(map(int, tensor.indices))
                 buckets[first_index].append(tensor)
+                tracked[id(tensor)] = nbytes
             else:   # tensor is scalar
+                tracker.free(nbytes)
                 if result is not None:
                     result *= tensor
                 else:
@@ -358,6 +706,15 @@ def bucket_elimination(buckets, process_bucket_fn,
 
     # form a single list of the rest if any
     rest = list(itertools.chain.from_iterable(buckets[n_var_contract:]))
+    if len(rest) > 0:
+        nbytes = _get_result_bytes(rest, itemsize, no_sum=True)
+        tracker.allocate(nbytes, 'Final step')
+        # the result is handed to the caller
+        tracker.free(nbytes + sum(tracked.values()))
+    if len(rest) > 0 and process_final_fn is not None:
+        if result is not None:
+            rest.append(result)
+        return process_final_fn(rest)
     if len(rest) > 0:
         # only multiply tensors
         tensor = process_bucket_fn(rest, no_sum=True)
@@ -514,5 +871,94 @@ def test_bucket_graph_conversion(filename):
         nx.is_isomorphic(graph, graph_from_buckets)))
 
 
+def test_bucket_elimination_threaded():
+    """
+    Compares concurrent processing of buckets with the sequential one
+    """
+    import qtree.graph_model as gm
+    import qtree.np_framework as npfr
+    import qtree.utils as utils
+
+    n_qubits = 8
+    circuit = ops.get_random_circuit(n_qubits, 10)
+    buckets, data_dict, bra_vars, ket_vars = circ2buckets(
+        n_qubits, circuit, dtype=np.complex128)
+    free_bra_vars = bra_vars[:2]
+    bra_vars = bra_vars[2:]
+    graph = gm.make_clique_on(
+        gm.buckets2graph(buckets, ignore_variables=bra_vars+ket_vars),
+        free_bra_vars)
+    peo, _ = gm.get_upper_bound_peo(graph, method='min_fill')
+    peo = gm.get_equivalent_peo(graph, peo, free_bra_vars)
+    perm_buckets, perm_dict = reorder_buckets(
+        buckets, bra_vars + ket_vars + peo)
+    fixed_vars = [perm_dict[idx] for idx in bra_vars + ket_vars]
+    slice_dict = utils.slice_from_bits(5, fixed_vars)
+    slice_dict.update({perm_dict[var]: slice(None)
+                       for var in free_bra_vars})
+
+    def get_buckets():
+        return npfr.get_sliced_np_buckets(perm_buckets, data_dict,
+                                          slice_dict)
+
+    n_var_contract = len(perm_buckets) - len(free_bra_vars)
+    targets, dependencies, _ = get_elimination_tree(
+        get_buckets(), n_var_contract)
+    # independent branches
+    assert sum(1 for n in range(n_var_contract)
+               if len(dependencies[n]) == 0
+               and len(perm_buckets[n]) > 0) > 1
+    assert all(target is None or target > n
+               for n, target in enumerate(targets))
+
+    def check_unchanged(sliced_buckets):
+        assert all(len(bucket) == len(original) for bucket, original
+                   in zip(sliced_buckets, perm_buckets))
+
+    result_bytes = []
+
+    def process_bucket(bucket, no_sum=False):
+        tensor = npfr.process_bucket_np(bucket, no_sum=no_sum)
+        result_bytes.append(tensor.data.nbytes)
+        return tensor
+
+    sliced_buckets = get_buckets()
+    tracker = MemoryTracker()
+    reference = bucket_elimination(
+        sliced_buckets, process_bucket,
+        n_var_nosum=len(free_bra_vars), tracker=tracker)
+    check_unchanged(sliced_buckets)
+    assert tracker.live == 0
+    assert tracker.peak >= max(result_bytes)
+    peak = tracker.peak
+    for n_threads, max_concurrent_bytes, budget in (
+            (1, None, peak), (4, None, None), (4, 0, peak)):
+        sliced_buckets = get_buckets()
+        tracker = MemoryTracker(budget=budget)
+        result = bucket_elimination(
+            sliced_buckets, npfr.process_bucket_np,
+            n_var_nosum=len(free_bra_vars), n_threads=n_threads,
+            max_concurrent_bytes=max_concurrent_bytes, tracker=tracker)
+        assert result.indices == reference.indices
+        assert np.allclose(result.data, reference.data)
+        check_unchanged(sliced_buckets)
+        assert tracker.live == 0
+
+    # the budget is checked before the bucket is processed
+    result_bytes = []
+    try:
+        bucket_elimination(
+            get_buckets(), process_bucket,
+            n_var_nosum=len(free_bra_vars),
+            tracker=MemoryTracker(budget=peak - 1))
+    except MemoryBudgetError as error:
+        assert error.required == peak
+        assert error.budget == peak - 1
+    else:
+        assert False, 'budget is not enforced'
+    assert len(result_bytes) < sum(
+        1 for bucket in perm_buckets[:n_var_contract] if len(bucket) > 0)
+
+
 if __name__ == '__main__':
     test_bucket_graph_conversion('inst_2x2_7_0.txt')
@@ -0,0 +1,202 @@
+"""
+This module implements sampling of bitstrings from the output
+distribution |<x|U|0>|^2 of a circuit with the frugal rejection
+sampling. Amplitudes are evaluated in batches over a few open
+qubits (see :py:class:`simulator.BatchEvaluator`), so a single
+contraction gives 2^k candidates. A candidate x is accepted with the
+probability min(1, N p(x) / M), where N = 2^n_qubits and M bounds
+N p(x). For chaotic circuits (Porter-Thomas statistics) M = 10
+makes the bias negligible, and about M / 2^k contractions are spent
+per sample.
+
+>>> sampler = FrugalSampler(n_qubits, circuit, n_batch_qubits=6)
+>>> for bitstring in sampler.samples(1000):
+...     print(bitstring)
+>>> sampler.contractions_per_sample
+"""
+
+import numpy as np
+
+import qtree.graph_model as gm
+import qtree.simulator as sim
+
+from qtree.logger_setup import log
+
+
+class FrugalSampler(object):
+    """
+    Streams samples of bitstrings drawn from the output distribution
+    of a circuit.
+
+    Samples accepted from the same batch share the values of the
+    fixed qubits. Use ``max_samples_per_batch=1`` if
+    independent samples are required.
+
+    Parameters
+    ----------
+    n_qubits: int
+             Number of qubits in the circuit
+    circuit: list of lists
+             List of lists of gates
+    n_batch_qubits: int, default None
+             number of qubits left open. If None, min(n_qubits, 6)
+             qubits are used
+    batch_qubits: list, default None
+             qubits left open. If None, the last n_batch_qubits
+             qubits are used
+    max_ratio: float, default 10.
+             the bound M of N p(x). Candidates with a larger value
+             are counted in ``n_overflows``; if there are any,
+             the samples are biased
+    max_samples_per_batch: int, default None
+             maximal number of samples accepted from a batch
+    seed: int, default None
+             seed of the random number generator
+    initial_state, pdict, peo_function, path_method, dtype:
+             see :py:class:`simulator.BatchEvaluator`
+
+    Attributes
+    ----------
+    n_samples: int
+             number of samples produced so far
+    n_candidates: int
+             number of candidates tested so far
+    n_overflows: int
+             number of candidates with N p(x) > M
+    """
+    def __init__(self, n_qubits, circuit, n_batch_qubits=None,
+                 batch_qubits=None, max_ratio=10.,
+                 max_samples_per_batch=None, seed=None,
+                 initial_state=0, pdict={}, peo_function=gm.get_peo,
+                 path_method='auto', dtype=None):
+        if batch_qubits is None:
+            if n_batch_qubits is None:
+                n_batch_qubits = min(n_qubits, 6)
+            batch_qubits = range(n_qubits - n_batch_qubits, n_qubits)
+        self.n_qubits = n_qubits
+        self.max_ratio = max_ratio
+        self.max_samples_per_batch = max_samples_per_batch
+        self.evaluator = sim.BatchEvaluator(
+            n_qubits, circuit, batch_qubits,
+            initial_state=initial_state, pdict=pdict,
+            peo_function=peo_function, path_method=path_method,
+            dtype=dtype)
+
+        self.n_samples = 0
+        self.n_candidates = 0
+        self.n_overflows = 0
+        self._random = np.random.RandomState(seed)
+
+        # values of the bitstrings of the batch
+        batch_bits = sim.get_bitstring_array(
+            np.arange(2**len(self.evaluator.batch_qubits)),
+            len(self.evaluator.batch_qubits))
+        self._batch_values = self._get_values(
+            batch_bits, self.evaluator.batch_qubits)
+
+    def _get_values(self, bits, qubits):
+        weights = np.array([1 << (self.n_qubits - 1 - qubit)
+                            for qubit in qubits], dtype=object)
+        return bits.astype(object) @ weights
+
+    @property
+    def n_contractions(self):
+        return self.evaluator.n_contractions
+
+    @property
+    def contractions_per_sample(self):
+        if self.n_samples == 0:
+            return float('inf')
+        return self.n_contractions / self.n_samples
+
+    def samples(self, n_samples=None):
+        """
+        Generates samples. The statistics of the sampler are
+        updated as samples are produced.
+
+        Parameters
+        ----------
+        n_samples: int, default None
+                 number of samples. If None, the generator is infinite
+
+        Yields
+        ------
+        bitstring: int
+                 sampled final state, qubit 0 is the most
+                 significant bit
+        """
+        n_produced = 0
+        n_fixed = len(self.evaluator.fixed_qubits)
+        while n_samples is None or n_produced < n_samples:
+            fixed_bits = self._random.randint(2, size=n_fixed)
+            amplitudes = self.evaluator.evaluate(fixed_bits).ravel()
+
+            ratios = (2**self.n_qubits / self.max_ratio
+                      * np.abs(amplitudes)**2)
+            self.n_candidates += len(ratios)
+            self.n_overflows += int(np.count_nonzero(ratios > 1))
+
+            accepted = np.flatnonzero(
+                self._random.random_sample(len(ratios)) < ratios)
+            accepted = self._random.permutation(accepted)
+            if self.max_samples_per_batch is not None:
+                accepted = accepted[:self.max_samples_per_batch]
+
+            offset = self._get_values(fixed_bits[None, :],
+                                      self.evaluator.fixed_qubits)[0]
+            for idx in accepted:
+                if n_samples is not None and n_produced >= n_samples:
+                    break
+                n_produced += 1
+                self.n_samples += 1
+                yield int(offset + self._batch_values[idx])
+
+        log.info(f'Sampled {n_produced} bitstrings with'
+                 f' {self.contractions_per_sample:.2f} contractions'
+                 ' per sample')
+
+
+def test_frugal_sampler():
+    """
+    Compares the sampled distribution with the exact one
+    """
+    import functools
+    import qtree.operators as ops
+
+    n_qubits = 5
+    circuit = ops.get_random_circuit(n_qubits, 8)
+    peo_function = functools.partial(gm.get_upper_bound_peo,
+                                     method='min_fill')
+    probabilities = np.abs(sim.eval_amplitudes_batch(
+        n_qubits, circuit, np.arange(2**n_qubits),
+        batch_qubits=range(n_qubits), peo_function=peo_function,
+        dtype=np.complex128))**2
+    assert np.isclose(probabilities.sum(), 1)
+
+    # a bound above the maximum makes the sampling exact
+    max_ratio = 2**n_qubits * probabilities.max() * 1.01
+    sampler = FrugalSampler(n_qubits, circuit, n_batch_qubits=2,
+                            max_ratio=max_ratio, seed=0,
+                            peo_function=peo_function,
+                            dtype=np.complex128)
+    n_samples = 4000
+    samples = list(sampler.samples(n_samples))
+    assert len(samples) == n_samples == sampler.n_samples
+    assert sampler.n_overflows == 0
+
+    frequencies = np.bincount(samples, minlength=2**n_qubits) / n_samples
+    assert 0.5 * np.abs(frequencies - probabilities).sum() < 0.05
+
+    # about M / 2^k contractions per sample
+    expected = max_ratio / 2**2
+    assert 0.8 * expected < sampler.contractions_per_sample < 1.2 * expected
+
+    # streaming continues, and at most one sample is taken per batch
+    sampler = FrugalSampler(n_qubits, circuit, n_batch_qubits=2,
+                            max_ratio=max_ratio, seed=1,
+                            max_samples_per_batch=1,
+                            peo_function=peo_function)
+    stream = sampler.samples()
+    first = [next(stream) for _ in range(10)]
+    assert len(first) == 10
+    assert sampler.n_contractions >= 10
@@ -3,11 +3,15 @@ Test programs to demonstrate various use cases of the
 Qtree quantum circuit simulator. Functions in this file
 can be used as main functions in the final simulator program
 """
+import numpy as np
+
 import qtree.operators as ops
 import qtree.optimizer as opt
 import qtree.graph_model as gm
 import qtree.np_framework as npfr
+import qtree.np_plan as npp
 import qtree.utils as utils
+import qtree.system_defs as defs
 
 from qtree.logger_setup import log
 
@@ -37,7 +41,9 @@ def get_amplitudes_from_cirq(filename, initial_state=0):
 
 def eval_circuit(n_qubits, circuit, final_state,
                  initial_state=0, measured_final=None,
-                 measured_initial=None, pdict={}):
+                 measured_initial=None, pdict={},
+                 peo_function=gm.get_peo, dtype=None,
+                 n_threads=1, max_concurrent_bytes=None, tracker=None):
     """
     Evaluate a circuit with specified initial and final states.
 
@@ -64,6 +70,22 @@ def eval_circuit(n_qubits, circuit, final_state,
              initially. If not all are measured, then the resulting
              amplitudes will be evaluated for a subset of initial states.
     pdict: dict, default {}
+    peo_function: function, default :py:meth:`graph_model.get_peo`
+             function to calculate PEO. Should have signature
+             lambda (graph): return peo, treewidth
+    dtype: numpy.dtype, optional
+             precision of the calculation. Defaults to
+             :py:data:`system_defs.NP_ARRAY_TYPE`
+    n_threads: int, default 1
+             number of threads processing independent buckets,
+             see :py:meth:`optimizer.bucket_elimination`
+    max_concurrent_bytes: int, optional
+             throttle on the memory of live intermediates in bytes
+             if buckets are processed concurrently
+    tracker: optimizer.MemoryTracker, optional
+             records the peak memory of intermediates. If it has a
+             budget, :class:`optimizer.MemoryBudgetError` is raised
+             before the budget is exceeded
     Returns
     -------
     amplitudes: numpy.array
@@ -86,7 +108,7 @@ def eval_circuit(n_qubits, circuit, final_state,
 
     # Prepare graphical model
     buckets, data_dict, bra_vars, ket_vars = opt.circ2buckets(
-        n_qubits, circuit, pdict=pdict)
+        n_qubits, circuit, pdict=pdict, dtype=dtype)
 
     # Collect free qubit variables
     free_final = sorted(all_qubits - set(measured_final))
@@ -112,7 +134,7 @@ def eval_circuit(n_qubits, circuit, final_state,
     graph = gm.make_clique_on(graph_initial, free_bra_vars+free_ket_vars)
 
     # Get PEO
-    peo_initial, treewidth = gm.get_peo(graph)
+    peo_initial, treewidth = peo_function(graph)
 
     # transform peo so free_bra_vars and free_ket_vars are at the end
     # this fixes the layout of the tensor
@@ -143,11 +165,374 @@ def eval_circuit(n_qubits, circuit, final_state,
         perm_buckets, data_dict, slice_dict)
     result = opt.bucket_elimination(
         sliced_buckets, npfr.process_bucket_np,
-        n_var_nosum=len(free_bra_vars+free_ket_vars))
+        n_var_nosum=len(free_bra_vars+free_ket_vars),
+        process_final_fn=npfr.process_final_bucket_np,
+        n_threads=n_threads, max_concurrent_bytes=max_concurrent_bytes,
+        tracker=tracker)
 
     return result.data
 
 
+def get_bitstring_array(bitstrings, n_qubits):
+    """
+    Converts bitstrings to a 2D array of bits
+
+    Parameters
+    ----------
+    bitstrings: array-like
+             Either integers, where qubit 0 is the most significant
+             bit (as in :py:meth:`eval_circuit`), or
+             an array of shape (n_bitstrings, n_qubits) of zeros and ones
+    n_qubits: int
+             Number of qubits
+    Returns
+    -------
+    bits: numpy.array
+             array of shape (n_bitstrings, n_qubits) of dtype uint8
+    """
+    bitstrings = np.atleast_1d(np.asarray(bitstrings))
+    if bitstrings.ndim == 2:
+        if bitstrings.shape[1] != n_qubits:
+            raise ValueError(f'Bitstrings of length {bitstrings.shape[1]}'
+                             f' given for {n_qubits} qubits')
+        return bitstrings.astype(np.uint8)
+
+    if n_qubits <= 64 and bitstrings.dtype != object:
+        bitstrings = bitstrings.astype(np.uint64)
+        shifts = np.arange(n_qubits - 1, -1, -1, dtype=np.uint64)
+        one = np.uint64(1)
+    else:
+        # wider bitstrings are shifted as Python ints
+        bitstrings = np.array([int(value) for value in bitstrings],
+                              dtype=object)
+        shifts = np.arange(n_qubits - 1, -1, -1).astype(object)
+        one = 1
+    return ((bitstrings[:, None] >> shifts) & one).astype(np.uint8)
+
+
+def choose_batch_qubits(bits, n_batch_qubits, max_sample=10000):
+    """
+    Greedily chooses qubits which are left open in batched
+    evaluation: at each step the qubit minimizing the number of
+    distinct values of the remaining (fixed) qubits is added.
+
+    Parameters
+    ----------
+    bits: numpy.array
+             array of bitstrings of shape (n_bitstrings, n_qubits)
+    n_batch_qubits: int
+             number of qubits to choose
+    max_sample: int, default 10000
+             number of bitstrings used to evaluate the choice
+
+    Returns
+    -------
+    batch_qubits: list
+             sorted list of chosen qubits
+    """
+    n_qubits = bits.shape[1]
+    if len(bits) > max_sample:
+        sample = np.random.RandomState(0).choice(
+            len(bits), max_sample, replace=False)
+        bits = bits[sample]
+
+    batch_qubits = []
+    for _ in range(min(n_batch_qubits, n_qubits)):
+        best = None
+        for qubit in range(n_qubits):
+            if qubit in batch_qubits:
+                continue
+            fixed = [q for q in range(n_qubits)
+                     if q not in batch_qubits and q != qubit]
+            n_groups = len(np.unique(bits[:, fixed], axis=0))
+            if best is None or n_groups < best[0]:
+                best = (n_groups, qubit)
+        batch_qubits.append(best[1])
+
+    return sorted(batch_qubits)
+
+
+class BatchEvaluator(object):
+    """
+    Compiled contraction of the circuit with the batch qubits left
+    open and the other (fixed) qubits set to given values in the bra.
+    Every call of :py:meth:`evaluate` is a single contraction giving
+    2^k amplitudes.
+
+    Parameters
+    ----------
+    n_qubits: int
+             Number of qubits in the circuit
+    circuit: list of lists
+             List of lists of gates
+    batch_qubits: list
+             Qubits to leave open
+    initial_state: int
+             Values of the qubits at the beginning of the
+             circuit (ket). Bitwise coded, qubit 0 is the most
+             significant bit.
+    pdict: dict, default {}
+    peo_function: function, default :py:meth:`graph_model.get_peo`
+             function to calculate PEO. Should have signature
+             lambda (graph): return peo, treewidth
+    path_method: str, default 'auto'
+             contraction order inside buckets.
+             See :py:meth:`np_plan.compile_buckets`
+    dtype: numpy.dtype, optional
+             precision of the calculation. Defaults to
+             :py:data:`system_defs.NP_ARRAY_TYPE`
+
+    Attributes
+    ----------
+    fixed_qubits: list
+             qubits which are not in the batch
+    n_contractions: int
+             number of contractions done so far
+    """
+    def __init__(self, n_qubits, circuit, batch_qubits,
+                 initial_state=0, pdict={}, peo_function=gm.get_peo,
+                 path_method='auto', dtype=None):
+        self.batch_qubits = sorted(batch_qubits)
+        self.fixed_qubits = [qubit for qubit in range(n_qubits)
+                             if qubit not in self.batch_qubits]
+        self.n_contractions = 0
+
+        # Prepare graphical model
+        buckets, data_dict, bra_vars, ket_vars = opt.circ2buckets(
+            n_qubits, circuit, pdict=pdict, dtype=dtype)
+
+        free_bra_vars = [bra_vars[qubit] for qubit in self.batch_qubits]
+        fixed_bra_vars = [bra_vars[qubit] for qubit in self.fixed_qubits]
+
+        graph = gm.make_clique_on(
+            gm.buckets2graph(buckets,
+                             ignore_variables=fixed_bra_vars+ket_vars),
+            free_bra_vars)
+        peo_initial, treewidth = peo_function(graph)
+        peo = gm.get_equivalent_peo(graph, peo_initial, free_bra_vars)
+
+        perm_buckets, perm_dict = opt.reorder_buckets(
+            buckets, fixed_bra_vars + ket_vars + peo)
+        ket_vars = [perm_dict[var] for var in ket_vars]
+        fixed_bra_vars = [perm_dict[var] for var in fixed_bra_vars]
+        free_bra_vars = [perm_dict[var] for var in free_bra_vars]
+
+        # Compile the contraction once
+        slice_dict = utils.slice_from_bits(initial_state, ket_vars)
+        slice_dict.update(utils.slice_from_bits(0, fixed_bra_vars))
+        slice_dict.update({var: slice(None) for var in free_bra_vars})
+        self.plan = npp.compile_buckets(perm_buckets, slice_dict,
+                                        n_var_nosum=len(free_bra_vars),
+                                        path_method=path_method)
+
+        # axes of the batch qubits in the result
+        result_positions = {int(var): pos for pos, var
+                            in enumerate(self.plan.result_indices)}
+        self._batch_axes = [result_positions[int(var)]
+                            for var in free_bra_vars]
+        self._data_dict = data_dict
+        self._slice_dict = slice_dict
+        self._fixed_bra_vars = fixed_bra_vars
+
+    def evaluate(self, fixed_bits):
+        """
+        Evaluates amplitudes of all values of the batch qubits
+
+        Parameters
+        ----------
+        fixed_bits: sequence
+                 values of the fixed qubits
+
+        Returns
+        -------
+        amplitudes: numpy.array
+                 array of shape [2]*len(batch_qubits), axes are
+                 in the order of batch_qubits
+        """
+        self._slice_dict.update({
+            var: slice(int(bit), int(bit)+1)
+            for var, bit in zip(self._fixed_bra_vars, fixed_bits)})
+        result = npp.execute_plan(
+            self.plan, npp.load_plan_inputs(
+                self.plan, self._data_dict, self._slice_dict))
+        self.n_contractions += 1
+        return np.transpose(result.data, self._batch_axes)
+
+
+def eval_amplitudes_batch(n_qubits, circuit, bitstrings,
+                          initial_state=0, n_batch_qubits=None,
+                          batch_qubits=None, pdict={},
+                          peo_function=gm.get_peo, path_method='auto',
+                          dtype=None):
+    """
+    Evaluates amplitudes for a list of arbitrary final bitstrings.
+    The contraction is prepared and compiled once. Bitstrings are then
+    grouped by the values of all qubits except ``batch_qubits``;
+    for each group the batch qubits are left open, all 2^k amplitudes
+    are computed in one contraction and the requested
+    entries are gathered.
+
+    Parameters
+    ----------
+    n_qubits: int
+             Number of qubits in the circuit
+    circuit: list of lists
+             List of lists of gates
+    bitstrings: array-like
+             Final states. See :py:meth:`get_bitstring_array`
+    initial_state: int
+             Values of the qubits at the beginning of the
+             circuit (ket). Bitwise coded, qubit 0 is the most
+             significant bit.
+    n_batch_qubits: int, default None
+             Number of qubits to leave open. If None, it is
+             chosen as min(log2(number of bitstrings), 10)
+    batch_qubits: list, default None
+             Qubits to leave open. If None they are chosen
+             with :py:meth:`choose_batch_qubits`
+    pdict: dict, default {}
+    peo_function: function, default :py:meth:`graph_model.get_peo`
+             function to calculate PEO. Should have signature
+             lambda (graph): return peo, treewidth
+    path_method: str, default 'auto'
+             contraction order inside buckets.
+             See :py:meth:`np_plan.compile_buckets`
+    dtype: numpy.dtype, optional
+             precision of the calculation. Defaults to
+             :py:data:`system_defs.NP_ARRAY_TYPE`
+
+    Returns
+    -------
+    amplitudes: numpy.array
+             amplitudes in the order of bitstrings
+    """
+    bits = get_bitstring_array(bitstrings, n_qubits)
+    n_bitstrings = len(bits)
+
+    if batch_qubits is None:
+        if n_batch_qubits is None:
+            n_batch_qubits = min(
+                10, int(np.log2(max(n_bitstrings, 1))))
+        batch_qubits = choose_batch_qubits(bits, n_batch_qubits)
+
+    evaluator = BatchEvaluator(
+        n_qubits, circuit, batch_qubits, initial_state=initial_state,
+        pdict=pdict, peo_function=peo_function,
+        path_method=path_method, dtype=dtype)
+    batch_qubits = evaluator.batch_qubits
+    fixed_qubits = evaluator.fixed_qubits
+
+    groups, group_of_bitstring = np.unique(
+        bits[:, fixed_qubits], axis=0, return_inverse=True)
+    group_of_bitstring = group_of_bitstring.ravel()
+    log.info(f'Evaluate {n_bitstrings} amplitudes in {len(groups)}'
+             f' contractions over qubits {batch_qubits}')
+
+    if dtype is None:
+        dtype = defs.NP_ARRAY_TYPE
+    amplitudes = np.empty(n_bitstrings, dtype=dtype)
+    order = np.argsort(group_of_bitstring, kind='stable')
+    bounds = np.searchsorted(group_of_bitstring[order],
+                             np.arange(len(groups) + 1))
+    for group_idx, group_bits in enumerate(groups):
+        data = evaluator.evaluate(group_bits)
+        members = order[bounds[group_idx]:bounds[group_idx+1]]
+        amplitudes[members] = data[
+            tuple(bits[members][:, batch_qubits].T)]
+
+    return amplitudes
+
+
+def eval_amplitudes_incremental(n_qubits, circuit, bitstrings=None,
+                                initial_state=0, pdict={},
+                                peo_function=gm.get_peo,
+                                path_method='auto', dtype=None):
+    """
+    Evaluates amplitudes for many final bitstrings, recomputing
+    for each bitstring only the intermediates which depend on
+    the bits changed since the previous one
+    (see :py:class:`np_plan.IncrementalPlan`). A requested list
+    of bitstrings is visited in the prefix trie order, and all
+    bitstrings are visited in the Gray code order. In both cases
+    bits invalidating less work change more often.
+
+    Parameters
+    ----------
+    n_qubits: int
+             Number of qubits in the circuit
+    circuit: list of lists
+             List of lists of gates
+    bitstrings: array-like, default None
+             Final states. See :py:meth:`get_bitstring_array`.
+             If None, all 2^n_qubits amplitudes are evaluated
+    initial_state: int
+             Values of the qubits at the beginning of the
+             circuit (ket). Bitwise coded, qubit 0 is the most
+             significant bit.
+    pdict: dict, default {}
+    peo_function: function, default :py:meth:`graph_model.get_peo`
+             function to calculate PEO. Should have signature
+             lambda (graph): return peo, treewidth
+    path_method: str, default 'auto'
+             contraction order inside buckets.
+             See :py:meth:`np_plan.compile_buckets`
+    dtype: numpy.dtype, optional
+             precision of the calculation. Defaults to
+             :py:data:`system_defs.NP_ARRAY_TYPE`
+
+    Returns
+    -------
+    amplitudes: numpy.array
+             amplitudes in the order of bitstrings, or of the
+             integer value of the bitstring if all are evaluated
+    """
+    # Prepare graphical model
+    buckets, data_dict, bra_vars, ket_vars = opt.circ2buckets(
+        n_qubits, circuit, pdict=pdict, dtype=dtype)
+
+    graph = gm.buckets2graph(buckets,
+                             ignore_variables=bra_vars+ket_vars)
+    peo, treewidth = peo_function(graph)
+
+    perm_buckets, perm_dict = opt.reorder_buckets(
+        buckets, bra_vars + ket_vars + peo)
+    ket_vars = [perm_dict[var] for var in ket_vars]
+    bra_vars = [perm_dict[var] for var in bra_vars]
+
+    slice_dict = utils.slice_from_bits(initial_state, ket_vars)
+    slice_dict.update(utils.slice_from_bits(0, bra_vars))
+    plan = npp.compile_buckets(perm_buckets, slice_dict,
+                               path_method=path_method)
+    incremental = npp.IncrementalPlan(plan, bra_vars)
+    costs = incremental.get_bit_costs()
+
+    if bitstrings is None:
+        bits = npp.get_gray_code_order(costs)
+        # amplitudes are stored by the value of the bitstring
+        weights = 2**np.arange(n_qubits - 1, -1, -1)
+        positions = bits.astype(np.int64) @ weights
+    else:
+        bits = get_bitstring_array(bitstrings, n_qubits)
+        positions = npp.get_trie_order(bits, costs)
+        bits = bits[positions]
+
+    if dtype is None:
+        dtype = defs.NP_ARRAY_TYPE
+    amplitudes = np.empty(len(bits), dtype=dtype)
+    for position, bitstring in zip(positions, bits):
+        slice_dict.update({var: slice(int(bit), int(bit)+1)
+                           for var, bit in zip(bra_vars, bitstring)})
+        result = incremental.execute(
+            npp.load_plan_inputs(plan, data_dict, slice_dict),
+            bitstring)
+        amplitudes[position] = result.data
+
+    log.info(f'Evaluated {len(bits)} amplitudes with'
+             f' {incremental.n_executed} of'
+             f' {len(bits) * len(plan.ops)} contraction steps')
+    return amplitudes
+
+
 def test_parametric_gates():
     """
     Tests circuit evaluation
@@ -227,5 +612,141 @@ def test_eval_circuit(filename='inst_2x2_7_0.txt'):
     print(np.max(np.abs(result - reference)))
 
 
+def test_eval_amplitudes_batch():
+    """
+    Compares batched amplitudes with single amplitude evaluation
+    """
+    import functools
+
+    n_qubits = 5
+    circuit = ops.get_random_circuit(n_qubits, 6)
+    peo_function = functools.partial(gm.get_upper_bound_peo,
+                                     method='min_fill')
+
+    reference = np.array([
+        eval_circuit(n_qubits, circuit, final_state=state,
+                     peo_function=peo_function).flatten()[0]
+        for state in range(2**n_qubits)])
+
+    bitstrings = np.random.RandomState(0).randint(
+        2**n_qubits, size=40)
+    for n_batch_qubits in (0, 2, n_qubits):
+        amplitudes = eval_amplitudes_batch(
+            n_qubits, circuit, bitstrings,
+            n_batch_qubits=n_batch_qubits, peo_function=peo_function)
+        assert np.allclose(amplitudes, reference[bitstrings])
+
+    bits = get_bitstring_array(bitstrings, n_qubits)
+    amplitudes = eval_amplitudes_batch(
+        n_qubits, circuit, bits, batch_qubits=[1, 3],
+        peo_function=peo_function)
+    assert np.allclose(amplitudes, reference[bitstrings])
+
+    assert get_bitstring_array(5, 3).tolist() == [[1, 0, 1]]
+    # more than 64 qubits
+    wide = get_bitstring_array([2**70 + 3], 72)
+    assert wide.shape == (1, 72)
+    assert np.flatnonzero(wide[0]).tolist() == [1, 70, 71]
+
+
+def test_eval_circuit_threaded():
+    """
+    Compares concurrent processing of buckets with the sequential one
+    """
+    import functools
+
+    n_qubits = 7
+    circuit = ops.get_random_circuit(n_qubits, 8)
+    peo_function = functools.partial(gm.get_upper_bound_peo,
+                                     method='min_fill')
+    kwargs = dict(final_state=3, measured_final=[0, 2, 3, 5, 6],
+                  peo_function=peo_function, dtype=np.complex128)
+
+    tracker = opt.MemoryTracker()
+    reference = eval_circuit(n_qubits, circuit, tracker=tracker, **kwargs)
+    assert tracker.peak > 0
+    peak = tracker.peak
+    for max_concurrent_bytes in (None, 2**10):
+        tracker = opt.MemoryTracker()
+        amplitudes = eval_circuit(
+            n_qubits, circuit, n_threads=4,
+            max_concurrent_bytes=max_concurrent_bytes,
+            tracker=tracker, **kwargs)
+        assert np.allclose(amplitudes, reference)
+        assert tracker.live == 0
+    amplitudes = eval_circuit(n_qubits, circuit,
+                              tracker=opt.MemoryTracker(budget=peak),
+                              **kwargs)
+    assert np.allclose(amplitudes, reference)
+    try:
+        eval_circuit(n_qubits, circuit,
+                     tracker=opt.MemoryTracker(budget=peak - 1),
+                     **kwargs)
+    except opt.MemoryBudgetError:
+        pass
+    else:
+        assert False, 'budget is not enforced'
+
+
+def test_dtype_policy():
+    """
+    Checks that the requested precision is kept through
+    the whole calculation
+    """
+    import functools
+
+    n_qubits = 5
+    circuit = ops.get_random_circuit(n_qubits, 6)
+    circuit.append([ops.ZPhase(0, alpha=0.3), ops.cX(1, 2)])
+    peo_function = functools.partial(gm.get_upper_bound_peo,
+                                     method='min_fill')
+    bitstrings = np.arange(2**n_qubits)
+
+    results = {}
+    for dtype in (np.complex64, np.complex128):
+        _, data_dict, _, _ = opt.circ2buckets(n_qubits, circuit,
+                                              dtype=dtype)
+        assert all(data.dtype == dtype for data in data_dict.values())
+        results[dtype] = eval_amplitudes_batch(
+            n_qubits, circuit, bitstrings, n_batch_qubits=2,
+            peo_function=peo_function, dtype=dtype)
+        assert results[dtype].dtype == dtype
+
+    assert np.allclose(results[np.complex64], results[np.complex128],
+                       atol=1e-6)
+    # default is the global policy
+    amplitudes = eval_amplitudes_batch(
+        n_qubits, circuit, bitstrings[:4], peo_function=peo_function)
+    assert amplitudes.dtype == defs.NP_ARRAY_TYPE
+
+
+def test_eval_amplitudes_incremental():
+    """
+    Compares incremental evaluation with the batched one
+    """
+    import functools
+
+    n_qubits = 5
+    circuit = ops.get_random_circuit(n_qubits, 6)
+    peo_function = functools.partial(gm.get_upper_bound_peo,
+                                     method='min_fill')
+    reference = eval_amplitudes_batch(
+        n_qubits, circuit, np.arange(2**n_qubits),
+        batch_qubits=range(n_qubits), peo_function=peo_function,
+        dtype=np.complex128)
+
+    amplitudes = eval_amplitudes_incremental(
+        n_qubits, circuit, peo_function=peo_function,
+        dtype=np.complex128)
+    assert np.allclose(amplitudes, reference)
+
+    bitstrings = np.random.RandomState(0).randint(
+        2**n_qubits, size=20)
+    amplitudes = eval_amplitudes_incremental(
+        n_qubits, circuit, bitstrings, peo_function=peo_function,
+        dtype=np.complex128)
+    assert np.allclose(amplitudes, reference[bitstrings])
+
+
 if __name__ == "__main__":
     test_eval_circuit()
@@ -43,7 +43,14 @@ except Exception as e:
     log.warn(f'Tamaki solver is unavailable: {e}')
 
 MAXIMAL_MEMORY = 1e22   # 100000000 64bit complex numbers
+
+# Default precision of the tensor data and of the intermediates.
+# Can be overridden by the dtype argument of
+# optimizer.circ2buckets and of the simulator functions
 NP_ARRAY_TYPE = np.complex64
+# Precision in which gate tensors are generated before they are
+# cast to the working precision
+NP_GATE_TYPE = np.complex128
 
 try:
     import tensorflow as tf
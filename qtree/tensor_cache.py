@@ -0,0 +1,304 @@
+"""
+This module implements process-wide caches of tensor data.
+Gate tensors are generated once per (gate class, parameters, dtype)
+and shared between all circuits. Transposed and sliced variants
+of the data, as used by :py:meth:`np_framework.get_sliced_np_buckets`
+and :py:meth:`np_plan.load_plan_inputs`, are memoized as well. All
+cached arrays are read-only, so they can be shared safely.
+
+Both caches are bounded by the total size of the stored arrays and
+evict the least recently used entries.
+"""
+
+import collections
+import threading
+import weakref
+import numpy as np
+
+import qtree.system_defs as defs
+
+# Maximal size of the cached gate tensors, in bytes
+GATE_CACHE_SIZE = 2**26
+# Maximal size of the cached transposed and sliced variants, in bytes
+VARIANT_CACHE_SIZE = 2**28
+
+
+class LRUCache(object):
+    """
+    Least recently used cache of arrays bounded by their total size.
+    Values larger than the bound are not stored.
+
+    Parameters
+    ----------
+    max_bytes : int
+            maximal total size of the stored values
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, _ = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, nbytes):
+        """
+        Stores a value of size nbytes, evicting old entries
+        """
+        with self._lock:
+            if key in self._entries:
+                self._nbytes -= self._entries.pop(key)[1]
+            if nbytes > self.max_bytes:
+                return
+            self._entries[key] = (value, nbytes)
+            self._nbytes += nbytes
+            self._evict()
+
+    def _evict(self):
+        while self._nbytes > self.max_bytes:
+            _, (_, nbytes) = self._entries.popitem(last=False)
+            self._nbytes -= nbytes
+
+    def resize(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+
+gate_cache = LRUCache(GATE_CACHE_SIZE)
+variant_cache = LRUCache(VARIANT_CACHE_SIZE)
+
+
+def _freeze(array):
+    array.flags.writeable = False
+    return array
+
+
+def get_gate_tensor(op, dtype=None):
+    """
+    Returns the tensor of a gate from the cache, generating
+    it if necessary
+
+    Parameters
+    ----------
+    op : operators.Gate
+            gate with numerical parameters
+    dtype : numpy.dtype, optional
+            type of the tensor. Defaults to
+            :py:data:`system_defs.NP_ARRAY_TYPE`
+
+    Returns
+    -------
+    tensor : numpy.array
+            read-only tensor
+    """
+    if dtype is None:
+        dtype = defs.NP_ARRAY_TYPE
+    dtype = np.dtype(dtype)
+
+    # the name distinguishes instances modified with dagger_me
+    key = (type(op), op.name, tuple(op.parameters.items()), dtype.str)
+    try:
+        hash(key)
+    except TypeError:
+        # unhashable parameters, like arrays
+        return _freeze(np.array(op.gen_tensor(), dtype=dtype))
+
+    tensor = gate_cache.get(key)
+    if tensor is None:
+        tensor = _freeze(np.array(op.gen_tensor(), dtype=dtype))
+        gate_cache.put(key, tensor, tensor.nbytes)
+    return tensor
+
+
+def _slice_pattern(slice_bounds):
+    return tuple((bound.start, bound.stop, bound.step)
+                 if isinstance(bound, slice) else bound
+                 for bound in slice_bounds)
+
+
+def get_tensor_variant(data_key, data, transpose_order=None,
+                       slice_bounds=()):
+    """
+    Returns data transposed and sliced, from the cache if possible.
+    Variants are memoized only for read-only data (as produced by
+    :py:meth:`get_gate_tensor`), as writable data may change
+    after the variant is stored.
+
+    Parameters
+    ----------
+    data_key : hashable
+            key of the data in the data dictionary
+    data : numpy.array
+            the data
+    transpose_order : sequence, optional
+            permutation of the axes
+    slice_bounds : sequence, default ()
+            slices or integers applied to the leading axes
+            of the transposed data
+
+    Returns
+    -------
+    variant : numpy.array
+    """
+    if transpose_order is not None:
+        transpose_order = tuple(int(axis) for axis in transpose_order)
+        if transpose_order == tuple(range(len(transpose_order))):
+            transpose_order = None
+    if (transpose_order is None
+            and all(bound == slice(None) for bound in slice_bounds)):
+        return data
+
+    def make_variant():
+        variant = data
+        if transpose_order is not None:
+            variant = variant.transpose(transpose_order)
+        if len(slice_bounds) > 0:
+            variant = variant[tuple(slice_bounds)]
+        return variant
+
+    if data.flags.writeable:
+        return make_variant()
+
+    key = (data_key, transpose_order, _slice_pattern(slice_bounds))
+    try:
+        entry = variant_cache.get(key)
+    except TypeError:
+        return make_variant()
+    # the same key may refer to other data in a different circuit
+    if entry is not None and entry[0]() is data:
+        return entry[1]
+
+    variant = _freeze(np.ascontiguousarray(make_variant()))
+    # the source is referenced weakly, so that the cache holds
+    # only the memory of the variants it accounts for
+    variant_cache.put(key, (weakref.ref(data), variant), variant.nbytes)
+    return variant
+
+
+def clear_caches():
+    """
+    Empties both caches
+    """
+    gate_cache.clear()
+    variant_cache.clear()
+
+
+def test_gate_cache():
+    """
+    Checks that gate tensors are shared and evicted
+    """
+    import qtree.operators as ops
+
+    clear_caches()
+    first = get_gate_tensor(ops.H(0))
+    assert get_gate_tensor(ops.H(3)) is first
+    assert not first.flags.writeable
+    assert np.allclose(first, ops.H(0).gen_tensor())
+    assert get_gate_tensor(ops.H(0), np.complex128) is not first
+    assert get_gate_tensor(ops.H(0).dagger_me()) is not first
+
+    other = get_gate_tensor(ops.ZPhase(0, alpha=0.25))
+    assert get_gate_tensor(ops.ZPhase(1, alpha=0.25)) is other
+    assert not np.allclose(
+        get_gate_tensor(ops.ZPhase(1, alpha=0.5)), other)
+
+    cache = LRUCache(32)
+    for key in range(4):
+        cache.put(key, key, 16)
+    assert len(cache) == 2 and cache.nbytes == 32
+    assert 0 not in cache and 3 in cache
+    cache.get(2)
+    cache.put(4, 4, 16)
+    assert 2 in cache and 3 not in cache
+    cache.put(5, 5, 64)
+    assert 5 not in cache
+
+
+def test_tensor_variants():
+    """
+    Compares cached variants with the directly computed ones
+    and checks the results of bucket elimination with the cache
+    """
+    import qtree.operators as ops
+    import qtree.optimizer as opt
+    import qtree.np_framework as npfr
+    import qtree.utils as utils
+
+    clear_caches()
+    data = get_gate_tensor(ops.cX(0, 1))
+    variant = get_tensor_variant('cX', data, (2, 0, 1),
+                                 (slice(0, 1), slice(None)))
+    assert np.array_equal(variant, data.transpose(2, 0, 1)[0:1, :])
+    assert not variant.flags.writeable
+    assert get_tensor_variant('cX', data, (2, 0, 1),
+                              (slice(0, 1), slice(None))) is variant
+    assert get_tensor_variant('cX', data, (0, 1, 2)) is data
+
+    # other data under the same key is not confused
+    other = _freeze(data * 2)
+    assert np.array_equal(
+        get_tensor_variant('cX', other, (2, 0, 1),
+                           (slice(0, 1), slice(None))),
+        other.transpose(2, 0, 1)[0:1, :])
+
+    # the source data is not kept alive by its variants
+    source = weakref.ref(other)
+    del other
+    assert source() is None
+
+    # writable data is not memoized
+    writable = np.array(data)
+    get_tensor_variant('w', writable, (1, 0, 2))
+    assert not any(key[0] == 'w' for key in variant_cache._entries)
+
+    n_qubits = 4
+    circuit = ops.get_random_circuit(n_qubits, 5)
+    buckets, data_dict, bra_vars, ket_vars = opt.circ2buckets(
+        n_qubits, circuit)
+    assert all(not data.flags.writeable for data in data_dict.values())
+    # the second circuit shares the tensors
+    _, data_dict_other, _, _ = opt.circ2buckets(n_qubits, circuit)
+    for key, data in data_dict.items():
+        assert data_dict_other[key] is data
+
+    def evaluate(buckets):
+        slice_dict = utils.slice_from_bits(0, ket_vars)
+        slice_dict.update(utils.slice_from_bits(5, bra_vars))
+        sliced_buckets = npfr.get_sliced_np_buckets(
+            buckets, data_dict, slice_dict)
+        return opt.bucket_elimination(
+            sliced_buckets, npfr.process_bucket_np).data
+
+    first = evaluate(buckets)
+    hits = variant_cache.hits
+    assert np.isclose(evaluate(buckets), first)
+    assert variant_cache.hits > hits
@@ -203,7 +203,7 @@ def cost_estimator(graph):
 
     Parameters
     ----------
-    old_graph : networkx.Graph or networkx.MultiGraph
+    graph : networkx.Graph or networkx.MultiGraph
                Graph containing the information about the contraction
     Returns
     -------
@@ -212,7 +212,8 @@ def cost_estimator(graph):
     flops : list
               Flop cost for steps of the bucket elimination algorithm
     """
-    return gm.cost_estimator(graph)
+    memory, flops = gm.estimate_contraction_costs(graph)
+    return memory.tolist(), flops.tolist()
 
 
 if __name__ == "__main__":